@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""balances.py
+
+Elastic Republic Profile balances and BalanceHistory rows, shared by the
+API and the background jobs in tasks.py
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import collections
+import datetime
+
+from google.appengine.ext import ndb
+
+from ledger import ONE_BALLOT
+from ledger import Balance
+from ledger import Supply
+from ledger import nextBalance
+from models import BalanceHistory
+from models import BalanceHistoryBlock
+from settings import BALANCE_HISTORY_STORAGE
+from stats import countDaysReplayed
+
+# blocks read per round trip when paging monthly storage
+BLOCKS_PER_PAGE = 12
+
+
+def packedStorage():
+    """True when BalanceHistorys are saved packed in monthly blocks."""
+    return BALANCE_HISTORY_STORAGE == 'monthly'
+
+
+def initialBalanceHistory(profile_key):
+    """Build an Initial BalanceHistory, unsaved."""
+    #today's initial balance of one Ballot and no relations
+    return BalanceHistory.fromBalance(
+        profile_key, Balance(datetime.date.today(), ONE_BALLOT, 0))
+
+
+@ndb.tasklet
+def getBalanceHistoryAsync(profile_key, date):
+    """Get a Profile's BalanceHistory for a date, None if there isn't one."""
+    row = BalanceHistory.keyFor(profile_key, date).get_async()
+    if not packedStorage():
+        bal_hist = yield row
+        raise ndb.Return(bal_hist)
+
+    #days not packed by the migration yet are still daily rows
+    block, bal_hist = yield BalanceHistoryBlock.keyFor(profile_key, date).get_async(), row
+    if block and block.hasDay(date):
+        bal_hist = block.getDay(date)
+    raise ndb.Return(bal_hist)
+
+
+@ndb.tasklet
+def _latestPackedBalanceHistoryAsync(profile_key):
+    """Get the last BalanceHistory in a Profile's latest block."""
+    block = yield BalanceHistoryBlock.query(ancestor=profile_key) \
+                                     .order(-BalanceHistoryBlock.month) \
+                                     .get_async()
+    bal_hists = list(block.balanceHistorys()) if block else []
+    raise ndb.Return(bal_hists[-1] if bal_hists else None)
+
+
+@ndb.tasklet
+def getMostRecentBalanceHistoryAsync(profile):
+    """Get a profile's most recent BalanceHistory."""
+    key = profile.MostRecentBalanceHistoryKey
+    if packedStorage() and len(key.pairs()) == 2:
+        #flat keys name the day, wherever it's stored
+        date = datetime.datetime.strptime(key.id(), '%Y-%m-%d').date()
+        bal_hist = yield getBalanceHistoryAsync(profile.key, date)
+    else:
+        bal_hist = yield key.get_async(use_cache=False, use_memcache=False)
+
+    #an old chained key may have just been flattened by the migration,
+    #so fall back to the latest BalanceHistory under the Profile
+    if bal_hist is None:
+        latest = [BalanceHistory.query(ancestor=profile.key)
+                                .order(-BalanceHistory.date)
+                                .get_async()]
+        if packedStorage():
+            latest.append(_latestPackedBalanceHistoryAsync(profile.key))
+        latest = yield latest
+        latest = [bh for bh in latest if bh]
+        bal_hist = max(latest, key=lambda bh: bh.date) if latest else None
+    raise ndb.Return(bal_hist)
+
+
+@ndb.tasklet
+def getBalanceAsync(profile):
+    """Get a profile's materialized Balance."""
+    balance = profile.balanceSnapshot
+    if balance is None:
+        #profiles saved before balances were materialized
+        bal_hist = yield getMostRecentBalanceHistoryAsync(profile)
+        balance = bal_hist.balance
+    raise ndb.Return(balance)
+
+
+@ndb.tasklet
+def todaysBalanceHistoryAsync(profile):
+    """Build today's BalanceHistory from a profile's Balance, unsaved."""
+    balance = yield getBalanceAsync(profile)
+    raise ndb.Return(BalanceHistory.fromBalance(
+        profile.key, balance.on(datetime.date.today())))
+
+
+@ndb.tasklet
+def addTodaysFlowAsync(profile, flow):
+    """Add a flow from today to a profile's materialized Balance.
+
+    Returns the change in the profile's share of the money supply. The
+    flow is added to the balance rather than copied from today's
+    BalanceHistory, which may still be waiting for a backdated recompute.
+    """
+    balance = yield getBalanceAsync(profile)
+    balance = balance.on(datetime.date.today())
+    changed = balance.withFlowFrom(balance.date, flow)
+    profile.setBalanceSnapshot(changed)
+    raise ndb.Return(Supply.ofBalance(changed) - Supply.ofBalance(balance))
+
+
+def latestBalanceHistorys(balhists):
+    """Keep one BalanceHistory per date, ordered by date."""
+    # while chained keys are being migrated a day can exist both
+    # nested and flat under the Profile; the flat one is current
+    by_date = {}
+    for bh in balhists:
+        kept = by_date.get(bh.date)
+        if kept is None or kept.isChained:
+            by_date[bh.date] = bh
+    return [by_date[d] for d in sorted(by_date)]
+
+
+def _withPackedBalanceHistorys(bal_hists, blocks, start=None, end=None):
+    """Merge daily rows and blocks into one BalanceHistory per date, ordered by date."""
+    #packed days are written after the daily rows they replace
+    by_date = dict((bh.date, bh) for bh in latestBalanceHistorys(bal_hists))
+    for block in blocks:
+        for bh in block.balanceHistorys(start, end):
+            by_date[bh.date] = bh
+    return [by_date[d] for d in sorted(by_date)]
+
+
+def _balanceHistoryQueries(profile_key, start=None, end=None):
+    """Daily row and block queries for a Profile's BalanceHistorys, inclusive dates."""
+    rows = BalanceHistory.query(ancestor=profile_key)
+    blocks = BalanceHistoryBlock.query(ancestor=profile_key)
+    if start:
+        rows = rows.filter(BalanceHistory.date >= start)
+        blocks = blocks.filter(BalanceHistoryBlock.month >= start.replace(day=1))
+    if end:
+        rows = rows.filter(BalanceHistory.date <= end)
+        blocks = blocks.filter(BalanceHistoryBlock.month <= end)
+    return rows.order(BalanceHistory.date), blocks.order(BalanceHistoryBlock.month)
+
+
+@ndb.tasklet
+def balanceHistorysAsync(profile_key, start=None, end=None):
+    """Get a Profile's BalanceHistorys from start to end, one per date."""
+    rows, blocks = _balanceHistoryQueries(profile_key, start, end)
+    if not packedStorage():
+        bal_hists = yield rows.fetch_async()
+        raise ndb.Return(latestBalanceHistorys(bal_hists))
+
+    bal_hists, blocks = yield rows.fetch_async(), blocks.fetch_async()
+    raise ndb.Return(_withPackedBalanceHistorys(bal_hists, blocks, start, end))
+
+
+@ndb.tasklet
+def packedBalanceHistoryPageAsync(profile_key, page_size, start=None, end=None):
+    """Get a page of a Profile's BalanceHistorys in monthly storage.
+
+    Returns (BalanceHistorys, date the next page starts on or None).
+    """
+    rows, blocks = _balanceHistoryQueries(profile_key, start, end)
+    bal_hists = rows.fetch_async(page_size + 1)
+
+    #read blocks until they hold more days than fit on the page
+    page_blocks, packed_days = [], 0
+    cursor, more = None, True
+    while more and packed_days <= page_size:
+        fetched, cursor, more = yield blocks.fetch_page_async(
+            BLOCKS_PER_PAGE, start_cursor=cursor)
+        more = more and cursor is not None
+        page_blocks.extend(fetched)
+        packed_days += sum(1 for b in fetched for _ in b.balanceHistorys(start, end))
+
+    bal_hists = yield bal_hists
+    page = _withPackedBalanceHistorys(bal_hists, page_blocks, start, end)
+    next_date = page[page_size].date if len(page) > page_size else None
+    raise ndb.Return((page[:page_size], next_date))
+
+
+@ndb.tasklet
+def packBalanceHistorysAsync(profile_key, bal_hists, keep_existing=False):
+    """Pack a Profile's BalanceHistorys into its blocks; call in a transaction.
+
+    With keep_existing days already in a block are left alone.
+    """
+    block_dates = {}
+    for bh in bal_hists:
+        block_dates.setdefault(BalanceHistoryBlock.keyFor(profile_key, bh.date), bh.date)
+    keys = block_dates.keys()
+    loaded = yield ndb.get_multi_async(keys)
+    blocks = dict((key, block or BalanceHistoryBlock.forDate(profile_key, block_dates[key]))
+                  for key, block in zip(keys, loaded))
+
+    for bh in bal_hists:
+        block = blocks[BalanceHistoryBlock.keyFor(profile_key, bh.date)]
+        if not (keep_existing and block.hasDay(bh.date)):
+            block.setDay(bh)
+    yield ndb.put_multi_async(blocks.values())
+
+
+@ndb.tasklet
+def putBalanceHistorysAsync(bal_hists):
+    """Save BalanceHistorys as daily rows or packed into their Profiles' blocks."""
+    if not packedStorage():
+        yield ndb.put_multi_async(bal_hists)
+    else:
+        by_profile = collections.defaultdict(list)
+        for bh in bal_hists:
+            by_profile[bh.key.root()].append(bh)
+        if ndb.in_transaction():
+            yield [packBalanceHistorysAsync(k, bhs) for k, bhs in by_profile.items()]
+        else:
+            #blocks are read, changed and written back, so each
+            #Profile's are packed in a transaction of their own
+            yield [ndb.transaction_async(lambda k=k, bhs=bhs: packBalanceHistorysAsync(k, bhs))
+                   for k, bhs in by_profile.items()]
+
+
+def missedBalanceHistorys(profile_key, balance, until, flow_changes=None):
+    """Build the BalanceHistorys for each day after a Balance up to until, unsaved.
+
+    flow_changes maps a date to the (flow, relation keys) that start on it.
+    """
+    # Prosesses UBI and money tax for each day
+    flow_changes = flow_changes or {}
+    #put one day into memory
+    one_day = datetime.timedelta(days=1)
+    bh_date, bh_eodBalance, bh_DailyNetIncomingBFlow = balance
+
+    #build every missed day in memory
+    bal_hists = []
+    while bh_date < until:
+        #Increment date to next day so we can add a Balance History for that day
+        bh_date += one_day
+
+        #relations starting today count towards today's balance
+        flow, relation_keys = flow_changes.get(bh_date, (0, []))
+        bh_DailyNetIncomingBFlow += flow
+        bh_eodBalance = nextBalance(bh_eodBalance, bh_DailyNetIncomingBFlow)
+
+        bal_hist = BalanceHistory.fromBalance(profile_key, Balance(
+            bh_date, bh_eodBalance, bh_DailyNetIncomingBFlow))
+        bal_hist.relationsChangedKeys = list(relation_keys)
+        bal_hists.append(bal_hist)
+
+    countDaysReplayed(len(bal_hists))
+    return bal_hists
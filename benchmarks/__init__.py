@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""benchmarks
+
+Elastic Republic benchmark scripts, run against the App Engine testbed stubs
+from the app directory, e.g.
+
+    $ GAE_SDK=~/google_appengine python -m benchmarks.catchup
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import os
+import sys
+import time
+
+
+def _fixSysPath():
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    try:
+        import dev_appserver
+    except ImportError:
+        sdk = os.environ.get('GAE_SDK')
+        if not sdk:
+            raise SystemExit('Set GAE_SDK to the App Engine SDK directory')
+        sys.path.insert(0, os.path.expanduser(sdk))
+        import dev_appserver
+    dev_appserver.fix_sys_path()
+
+_fixSysPath()
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+def setUpTestbed():
+    """Activate a testbed with fresh Datastore, memcache and urlfetch stubs."""
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_urlfetch_stub()
+    ndb.get_context().clear_cache()
+    return tb
+
+
+def signIn(email):
+    """Make endpoints.get_current_user() return the user with this email."""
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+
+
+def timed(func, *args, **kwargs):
+    """Return (seconds, result) of one call to func."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an ordered list."""
+    return ordered[max(0, int(round(fraction * len(ordered))) - 1)]
+
+
+def report(title, header, rows):
+    """Print benchmark rows as an aligned table."""
+    print(title)
+    widths = [max(len(str(c)) for c in col) for col in zip(header, *rows)]
+    for row in [header] + list(rows):
+        print('  '.join(str(c).rjust(w) for c, w in zip(row, widths)))
+    print('')
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""backdate.py -- cost of a backdated relation against how far back it goes
+
+Two users with 1100 days of BalanceHistory get a relation backdated
+7 to 1000 days. Times the createRelation call, which changes both
+balances in closed form, then the queued recompute chunks that rewrite
+their rows. Compares that with replaying the days one at a time, and
+checks every rewritten row against the replay. Then backdates a
+relation STALE_BACK days for two users whose balance settlement left
+STALE_DAYS old, settles them, and checks every row from the old
+balance on against a day-by-day replay.
+
+"""
+
+import datetime
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+
+from balances import balanceHistorysAsync
+from balances import missedBalanceHistorys
+from balances import putBalanceHistorysAsync
+from elasticrepublic import ElasticRepublicApi
+from ledger import ONE_BALLOT
+from ledger import Balance
+from models import BalanceRecompute
+from models import Profile
+from models import RelationForm
+from recompute import recomputeChunk
+from settlement import settleProfiles
+from stats import RpcCounter
+
+HISTORY_DAYS = 1100
+DISTANCES = (7, 30, 90, 365, 1000)
+DAILY_RATE = 250
+STALE_DAYS = 30                 # days since a stale profile's balance
+STALE_BACK = 10                 # days back its relation starts
+
+
+def _makeUser(user_id, today, stale_days=0):
+    """Save a Profile with HISTORY_DAYS of BalanceHistory up to stale_days ago."""
+    key = ndb.Key(Profile, user_id)
+    first = Balance(today - datetime.timedelta(days=HISTORY_DAYS), ONE_BALLOT, 0)
+    bal_hists = missedBalanceHistorys(key, first,
+                                      today - datetime.timedelta(days=stale_days))
+    putBalanceHistorysAsync(bal_hists).get_result()
+    profile = Profile(key=key, userId=user_id, displayName=user_id, mainEmail=user_id,
+                      MostRecentBalanceHistoryKey=bal_hists[-1].key)
+    profile.setBalanceSnapshot(bal_hists[-1].balance)
+    profile.put()
+    return key
+
+
+def _recompute(profile_keys):
+    """Run every queued recompute chunk for the profiles; return the chunk count."""
+    chunks = 0
+    for key in profile_keys:
+        for job_key in BalanceRecompute.query(ancestor=key).fetch(keys_only=True):
+            more = True
+            while more:
+                _, more = recomputeChunk(job_key)
+                chunks += 1
+    return chunks
+
+
+def _run(distance):
+    tb = setUpTestbed()
+    tb.init_taskqueue_stub(root_path='.')
+    today = datetime.date.today()
+    start = today - datetime.timedelta(days=distance)
+    cons_key = _makeUser('constit@example.com', today)
+    repr_key = _makeUser('rep@example.com', today)
+    before = balanceHistorysAsync(cons_key, start - datetime.timedelta(days=1)).get_result()
+    ndb.get_context().clear_cache()
+
+    signIn('constit@example.com')
+    api = ElasticRepublicApi()
+    request = RelationForm(name='backdated', dailyRate=DAILY_RATE,
+                           repUserId='rep@example.com', startDate=start.isoformat())
+    with RpcCounter() as request_rpcs:
+        request_secs, _ = timed(api.createRelation, request)
+    with RpcCounter() as recompute_rpcs:
+        recompute_secs, chunks = timed(_recompute, [cons_key, repr_key])
+
+    # the constituent's days, replayed one by one from the day before
+    flow_changes = {start: (-DAILY_RATE, [])}
+    replay_secs, replayed = timed(missedBalanceHistorys, cons_key, before[0].balance,
+                                  today, flow_changes)
+    rewritten = balanceHistorysAsync(cons_key, start).get_result()
+    assert [bh.date for bh in rewritten] == [bh.date for bh in replayed]
+    for row, expected in zip(rewritten, replayed):
+        assert abs(row.eodBalance - expected.eodBalance) < 1e-6 * ONE_BALLOT
+        assert row.DailyNetIncomingBFlow == expected.DailyNetIncomingBFlow
+    snapshot = cons_key.get().balanceSnapshot
+    assert abs(snapshot.eodBalance - replayed[-1].eodBalance) < 1e-6 * ONE_BALLOT
+    tb.deactivate()
+
+    return (distance, '%.1f' % (request_secs * 1000), request_rpcs.total,
+            '%.1f' % (recompute_secs * 1000), chunks, recompute_rpcs.total,
+            2 * len(rewritten), '%.1f' % (replay_secs * 1000 * 2))
+
+
+def _runStale():
+    """Backdate a relation for users settlement hasn't reached, then settle them."""
+    tb = setUpTestbed()
+    tb.init_taskqueue_stub(root_path='.')
+    today = datetime.date.today()
+    start = today - datetime.timedelta(days=STALE_BACK)
+    keys = [_makeUser(u, today, STALE_DAYS) for u in ('constit@example.com', 'rep@example.com')]
+    last = [k.get().balanceSnapshot for k in keys]
+    ndb.get_context().clear_cache()
+
+    signIn('constit@example.com')
+    request = RelationForm(name='backdated', dailyRate=DAILY_RATE,
+                           repUserId='rep@example.com', startDate=start.isoformat())
+    with RpcCounter() as request_rpcs:
+        request_secs, form = timed(ElasticRepublicApi().createRelation, request)
+    # the days up to the change are written at once, none later
+    assert _recompute(keys) == 0
+    for key in keys:
+        assert key.get().balanceSnapshot.date == start
+    with RpcCounter() as settle_rpcs:
+        settle_secs, _ = timed(settleProfiles, keys, today)
+
+    # each user's days from its old balance on, replayed one by one
+    rel_key = ndb.Key(urlsafe=form.websafeKey)
+    rows = 0
+    for key, balance, flow in zip(keys, last, (-DAILY_RATE, DAILY_RATE)):
+        replayed = missedBalanceHistorys(key, balance, today, {start: (flow, [rel_key])})
+        written = balanceHistorysAsync(key, balance.date + datetime.timedelta(days=1)).get_result()
+        assert [bh.date for bh in written] == [bh.date for bh in replayed]
+        for row, expected in zip(written, replayed):
+            assert abs(row.eodBalance - expected.eodBalance) < 1e-6 * ONE_BALLOT
+            assert row.DailyNetIncomingBFlow == expected.DailyNetIncomingBFlow
+            assert row.relationsChangedKeys == expected.relationsChangedKeys
+        snapshot = key.get().balanceSnapshot
+        assert snapshot.date == today
+        assert abs(snapshot.eodBalance - replayed[-1].eodBalance) < 1e-6 * ONE_BALLOT
+        rows += len(written)
+    tb.deactivate()
+
+    return (STALE_DAYS, STALE_BACK, '%.1f' % (request_secs * 1000), request_rpcs.total,
+            '%.1f' % (settle_secs * 1000), settle_rpcs.total, rows)
+
+
+def main():
+    report('Backdated relation, 2 users with %d days of history (testbed)' % HISTORY_DAYS,
+           ('days back', 'request ms', 'request RPCs', 'recompute ms', 'chunks',
+            'recompute RPCs', 'rows', 'replay ms, no writes'),
+           [_run(d) for d in DISTANCES])
+    report('Backdated relation, 2 users settled %d days ago (testbed)' % STALE_DAYS,
+           ('days stale', 'days back', 'request ms', 'request RPCs', 'settle ms',
+            'settle RPCs', 'rows checked'),
+           [_runStale()])
+
+
+if __name__ == '__main__':
+    main()
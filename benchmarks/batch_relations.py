@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""batch_relations.py -- onboarding 1,000 relations, one call each vs batched
+
+One constituent creates a relation to each of 1,000 members, a fifth
+of whom have no profile yet, once with 1,000 createRelation calls and
+once with a single createRelations batch. Compares wall time, RPCs and
+puts, and checks both leave the same balance and incoming flows.
+
+"""
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+from protorpc import message_types
+
+from elasticrepublic import ElasticRepublicApi
+from models import IncomingFlowShard
+from models import RelationForm
+from models import RelationForms
+from stats import RpcCounter
+
+RELATIONS = 1000
+NEW_MEMBERS = RELATIONS // 5
+
+
+def _forms():
+    """A RelationForm per member."""
+    return [RelationForm(name='member %d' % i, dailyRate=1 + i % 50,
+                         repUserId='member%d@example.com' % i)
+            for i in range(RELATIONS)]
+
+
+def _run(label, create):
+    """Onboard the members with create(api); return a report row and the outcome."""
+    tb = setUpTestbed()
+    api = ElasticRepublicApi()
+    for i in range(NEW_MEMBERS, RELATIONS):
+        signIn('member%d@example.com' % i)
+        api._doProfile()
+    signIn('org@example.com')
+    api._doProfile()
+    ndb.get_context().clear_cache()
+
+    with RpcCounter() as rpcs:
+        secs, _ = timed(create, api)
+    balance = api.getBalance(message_types.VoidMessage())
+    flows = sorted((s.userId, s.DailyNetIncomingBFlow) for s in IncomingFlowShard.query())
+    tb.deactivate()
+    return ((label, '%.1f' % secs, '%.1f' % (RELATIONS / secs), rpcs.total,
+             rpcs.calls['datastore_v3.Put'], rpcs.calls['datastore_v3.Commit']),
+            (balance.eodBalance, balance.DailyNetIncomingBFlow, flows))
+
+
+def main():
+    single_row, single = _run('createRelation x %d' % RELATIONS,
+                              lambda api: [api.createRelation(f) for f in _forms()])
+    batch_row, batch = _run('createRelations',
+                            lambda api: api.createRelations(RelationForms(items=_forms())))
+
+    # the same money moved, even if not on the same shards
+    assert single[:2] == batch[:2]
+    totals = lambda flows: sorted(
+        (user, sum(f for u, f in flows if u == user)) for user in set(u for u, _ in flows))
+    assert totals(single[2]) == totals(batch[2])
+
+    report('Onboarding %d relations (testbed)' % RELATIONS,
+           ('path', 'seconds', 'relations/s', 'RPCs', 'puts', 'commits'),
+           [single_row, batch_row])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""blocks.py -- daily BalanceHistory rows vs packed monthly blocks
+
+Saves a term (1460 days) of BalanceHistory for a few users in each
+storage mode, then compares entity count, stored bytes, and the
+latency and RPCs of reading a whole term and one 100 day page.
+
+"""
+
+import datetime
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+
+import balances
+from balances import balanceHistorysAsync
+from balances import missedBalanceHistorys
+from balances import packedBalanceHistoryPageAsync
+from balances import putBalanceHistorysAsync
+from ledger import ONE_BALLOT
+from ledger import Balance
+from models import BalanceHistory
+from models import BalanceHistoryBlock
+from models import Profile
+from stats import RpcCounter
+
+USERS = 10
+DAYS = 1460
+PAGE = 100
+
+
+def _term(p_key):
+    """A term of BalanceHistorys ending yesterday, a relation change every 30 days."""
+    start = datetime.date.today() - datetime.timedelta(days=DAYS + 1)
+    changes = dict((start + datetime.timedelta(days=d), (10, [ndb.Key('Relation', d)]))
+                   for d in range(30, DAYS, 30))
+    return missedBalanceHistorys(p_key, Balance(start, ONE_BALLOT, -100),
+                                 start + datetime.timedelta(days=DAYS), changes)
+
+
+def _stored(kind):
+    """(entity count, serialized bytes) of a kind."""
+    entities = kind.query().fetch()
+    return len(entities), sum(e._to_pb().ByteSize() for e in entities)
+
+
+def main():
+    rows, results = [], {}
+    for storage in ('daily', 'monthly'):
+        tb = setUpTestbed()
+        balances.BALANCE_HISTORY_STORAGE = storage
+        p_keys = [ndb.Key(Profile, 'user%d' % i) for i in range(USERS)]
+        write_secs, _ = timed(lambda: ndb.Future.wait_all(
+            [putBalanceHistorysAsync(_term(k)) for k in p_keys]))
+        count, size = _stored(BalanceHistoryBlock if storage == 'monthly' else BalanceHistory)
+
+        ndb.get_context().clear_cache()
+        with RpcCounter() as term_rpcs:
+            term_secs, term = timed(lambda: [balanceHistorysAsync(k).get_result()
+                                             for k in p_keys])
+        ndb.get_context().clear_cache()
+        page_start = datetime.date.today() - datetime.timedelta(days=DAYS // 2)
+        if storage == 'monthly':
+            read_page = lambda k: packedBalanceHistoryPageAsync(k, PAGE, page_start).get_result()
+        else:
+            read_page = lambda k: BalanceHistory.query(ancestor=k) \
+                                                .filter(BalanceHistory.date >= page_start) \
+                                                .order(BalanceHistory.date).fetch(PAGE)
+        with RpcCounter() as page_rpcs:
+            page_secs, _ = timed(lambda: [read_page(k) for k in p_keys])
+        tb.deactivate()
+
+        results[storage] = [[(bh.date, bh.eodBalance, bh.DailyNetIncomingBFlow,
+                              bh.relationsChangedKeys) for bh in bhs] for bhs in term]
+        rows.append((storage, count // USERS, size // USERS,
+                     '%.0f' % (write_secs * 1000 / USERS),
+                     '%.1f' % (term_secs * 1000 / USERS), term_rpcs.total // USERS,
+                     '%.1f' % (page_secs * 1000 / USERS), page_rpcs.total // USERS))
+
+    balances.BALANCE_HISTORY_STORAGE = 'daily'
+    assert results['daily'] == results['monthly']
+    report('BalanceHistory storage, per user with a %d day term (testbed)' % DAYS,
+           ('storage', 'entities', 'bytes', 'write ms', 'term ms', 'term RPCs',
+            '%d day page ms' % PAGE, 'page RPCs'), rows)
+
+
+if __name__ == '__main__':
+    main()
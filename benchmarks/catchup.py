@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""catchup.py -- BalanceHistory catch-up latency against gap length
+
+Compares the old one put() per missed day loop with settlement's
+batched catch-up, settleProfiles, and checks both give the same balances.
+
+"""
+
+import datetime
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+
+from ledger import MONEY_TAX_RATE
+from ledger import BASIC_INCOME
+from ledger import ONE_BALLOT
+from ledger import balanceAfterDays
+from models import BalanceHistory
+from models import Profile
+from settlement import settleProfiles
+
+GAPS = (1, 7, 30, 365, 1000)
+FLOW = -250
+
+
+def _idleProfile(user_id, gap):
+    """Save a Profile whose BalanceHistory stopped `gap` days ago."""
+    p_key = ndb.Key(Profile, user_id)
+    start = datetime.date.today() - datetime.timedelta(days=gap)
+    bh = BalanceHistory(key=ndb.Key(BalanceHistory, start.isoformat(), parent=p_key),
+                        date=start, eodBalance=ONE_BALLOT,
+                        DailyNetIncomingBFlow=FLOW)
+    bh.put()
+    prof = Profile(key=p_key, userId=user_id, MostRecentBalanceHistoryKey=bh.key)
+    prof.put()
+    return prof
+
+
+def _oldCatchUp(profile):
+    """The original loop: one synchronous put() per missed day."""
+    bh_key = profile.MostRecentBalanceHistoryKey
+    bal_hist = bh_key.get(use_cache=False, use_memcache=False)
+    bh_date = bal_hist.date
+    bh_eodBalance = bal_hist.eodBalance
+    while bh_date < datetime.date.today():
+        date_string = bh_date.isoformat()
+        bh_date += datetime.timedelta(days=1)
+        bh_key = ndb.Key(BalanceHistory, date_string, parent=bh_key)
+        bh_eodBalance = bh_eodBalance \
+                      - (bh_eodBalance * MONEY_TAX_RATE) \
+                      + BASIC_INCOME \
+                      + bal_hist.DailyNetIncomingBFlow
+        bal_hist = BalanceHistory(key=bh_key, date=bh_date,
+                                  eodBalance=bh_eodBalance,
+                                  DailyNetIncomingBFlow=bal_hist.DailyNetIncomingBFlow)
+        bal_hist.put()
+    return bal_hist
+
+
+def main():
+    tb = setUpTestbed()
+    rows = []
+    for gap in GAPS:
+        old_secs, old_bh = timed(_oldCatchUp, _idleProfile('old-%d' % gap, gap))
+        new_secs, _ = timed(settleProfiles, [_idleProfile('new-%d' % gap, gap).key],
+                            datetime.date.today())
+        new_bh = ndb.Key(Profile, 'new-%d' % gap).get().MostRecentBalanceHistoryKey.get()
+        closed = balanceAfterDays(ONE_BALLOT, FLOW, gap)
+        assert new_bh.eodBalance == old_bh.eodBalance
+        rows.append((gap, '%.1f' % (old_secs * 1000), '%.1f' % (new_secs * 1000),
+                     '%.3g' % abs(closed - old_bh.eodBalance)))
+    tb.deactivate()
+    report('BalanceHistory catch-up (testbed)',
+           ('gap days', 'loop ms', 'batched ms', 'closed-form error'), rows)
+
+
+if __name__ == '__main__':
+    main()
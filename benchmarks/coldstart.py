@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""coldstart.py -- import time and first request latency of a new instance
+
+Each run is a fresh interpreter, as on a new instance. A cold run
+imports the API and serves getProfile straight away. A warm run calls
+the /_ah/warmup steps first and times the same request after them.
+Reports each step, and whether numpy and the oauth module were loaded
+before the first request.
+
+"""
+
+import json
+import subprocess
+import sys
+import time
+
+RUNS = 5
+
+
+def _child(warm):
+    """Time one instance start in this interpreter; print the results as JSON."""
+    start = time.time()
+    from benchmarks import setUpTestbed
+    from benchmarks import signIn
+    sdk_secs = time.time() - start
+    tb = setUpTestbed()
+    signIn('user@example.com')
+
+    result = {'sdk': sdk_secs, 'warmup': 0.0}
+    if warm:
+        from warmup import warmUp
+        result['warmup'] = sum(t for _, t in warmUp())
+
+    start = time.time()
+    from elasticrepublic import ElasticRepublicApi
+    from models import ConditionalForm
+    result['import'] = time.time() - start
+    result['numpy'] = 'numpy' in sys.modules
+    result['oauth'] = 'oauth' in sys.modules
+
+    start = time.time()
+    ElasticRepublicApi().getProfile(ConditionalForm())
+    result['first'] = time.time() - start
+    start = time.time()
+    ElasticRepublicApi().getProfile(ConditionalForm())
+    result['second'] = time.time() - start
+    tb.deactivate()
+    print(json.dumps(result))
+
+
+def _run(warm):
+    """Start a fresh interpreter for one run and return its results."""
+    args = [sys.executable, '-m', 'benchmarks.coldstart', '--child']
+    if warm:
+        args.append('--warm')
+    output = subprocess.check_output(args)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    rows = []
+    for warm in (False, True):
+        runs = [_run(warm) for _ in range(RUNS)]
+        mean = lambda name: sum(r[name] for r in runs) * 1000 / len(runs)
+        rows.append(('warm' if warm else 'cold',
+                     '%.0f' % mean('warmup'), '%.0f' % mean('import'),
+                     '%.0f' % mean('first'), '%.0f' % mean('second'),
+                     runs[0]['numpy'], runs[0]['oauth']))
+
+    from benchmarks import report
+    report('Instance start, mean of %d fresh interpreters (ms, testbed)' % RUNS,
+           ('start', 'warmup', 'import', 'first request', 'second request',
+            'numpy loaded', 'oauth loaded'),
+           rows)
+
+
+if __name__ == '__main__':
+    if '--child' in sys.argv:
+        _child('--warm' in sys.argv)
+    else:
+        main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""display_names.py -- relation list display names, per row vs one batch
+
+A representative with 5,000 constituents lists their active relations.
+Compares the client's old N+1 pattern (the list, then one Profile
+lookup per row) with getUsersActiveRelations filling the names itself
+from one batched get, with memcache cold and then hot. Checks every
+row comes back named.
+
+"""
+
+import datetime
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from elasticrepublic import ElasticRepublicApi
+from models import Profile
+from models import Relation
+from models import RelationHead
+from models import UserIDForm
+from stats import RpcCounter
+
+CONSTITUENTS = 5000
+REP = 'rep@example.com'
+PUT_BATCH = 500
+
+
+def _save():
+    """Save the representative, constituents and their relations."""
+    entities = [Profile(id=REP, userId=REP, displayName='The Rep', mainEmail=REP)]
+    first_id, _ = Relation.allocate_ids(size=CONSTITUENTS)
+    for i in range(CONSTITUENTS):
+        user_id = 'constit%d@example.com' % i
+        cons_key = ndb.Key(Profile, user_id)
+        head_key = ndb.Key(RelationHead, first_id + i, parent=cons_key)
+        rel_key = RelationHead.versionKey(head_key, 1)
+        entities.append(Profile(key=cons_key, userId=user_id, displayName='Constituent %d' % i,
+                                mainEmail=user_id))
+        entities.append(RelationHead(key=head_key, currentKey=rel_key, currentVersion=1))
+        entities.append(Relation(key=rel_key, name='r%d' % i, dailyRate=10,
+                                 constitUserId=user_id, repUserId=REP, version=1,
+                                 startDate=datetime.datetime.today()))
+    for i in range(0, len(entities), PUT_BATCH):
+        ndb.put_multi(entities[i:i + PUT_BATCH], use_memcache=False)
+
+
+def _perRow(api):
+    """The list without names, then a Profile lookup per row, as the client did."""
+    forms = api._getActiveRelationFormsAsync(REP).get_result()
+    for form in forms.items:
+        form.constitDisplayName = ndb.Key(Profile, form.constitUserId).get().displayName
+        form.repDisplayName = ndb.Key(Profile, form.repUserId).get().displayName
+    return forms
+
+
+def _measure(label, func):
+    ndb.get_context().clear_cache()
+    with RpcCounter() as rpcs:
+        secs, forms = timed(func)
+    assert len(forms.items) == CONSTITUENTS
+    assert all(f.constitDisplayName and f.repDisplayName == 'The Rep' for f in forms.items)
+    return (label, '%.0f' % (secs * 1000), rpcs.total, rpcs.byKind['get'],
+            rpcs.byKind['memcache'])
+
+
+def main():
+    tb = setUpTestbed()
+    _save()
+    signIn(REP)
+    api = ElasticRepublicApi()
+    request = UserIDForm(userId=REP)
+
+    rows = [_measure('per row lookups', lambda: _perRow(api))]
+    #a cold view cache and cold Profile memcache, then both hot
+    memcache.flush_all()
+    rows.append(_measure('batched, cold', lambda: api.getUsersActiveRelations(request)))
+    rows.append(_measure('batched, hot', lambda: api.getUsersActiveRelations(request)))
+    tb.deactivate()
+
+    report('Active relations of a representative with %d constituents (testbed)' % CONSTITUENTS,
+           ('names', 'ms', 'RPCs', 'gets', 'memcache'),
+           rows)
+
+
+if __name__ == '__main__':
+    main()
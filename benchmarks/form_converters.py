@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""form_converters.py -- entity to form conversion, reflective vs registered
+
+Converts 10k Relation entities into a RelationForms the way the old
+_copyRelationToForm did (all_fields() reflection per entity) and with
+the converter registered in converters.py, and checks the forms match.
+
+"""
+
+import datetime
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+
+from converters import toForms
+from models import Relation
+from models import RelationForm
+from models import RelationForms
+
+ENTITIES = 10000
+
+
+def _oldCopyRelationToForm(rel):
+    """The original reflective copy, verbatim."""
+    rf = RelationForm()
+    for field in rf.all_fields():
+        if hasattr(rel, field.name):
+            if field.name.endswith('Date'):
+                setattr(rf, field.name, str(getattr(rel, field.name)))
+            else:
+                setattr(rf, field.name, getattr(rel, field.name))
+        elif field.name == "websafeKey":
+            setattr(rf, field.name, rel.key.urlsafe())
+        rf.check_initialized()
+    return rf
+
+
+def main():
+    tb = setUpTestbed()
+    now = datetime.datetime.today()
+    relations = [Relation(key=ndb.Key(Relation, i + 1), name='relation %d' % i,
+                          dailyRate=i % 500, constitUserId='c%d@example.com' % i,
+                          repUserId='r%d' % (i % 50), startDate=now, version=1)
+                 for i in range(ENTITIES)]
+
+    old_secs, old = timed(lambda: RelationForms(items=[_oldCopyRelationToForm(r) for r in relations]))
+    new_secs, new = timed(toForms, relations, RelationForms)
+    assert old == new
+    tb.deactivate()
+    report('Relation -> RelationForms, %d entities' % ENTITIES,
+           ('converter', 'ms', 'us/entity'),
+           [('reflective', '%.1f' % (old_secs * 1000), '%.1f' % (old_secs * 1e6 / ENTITIES)),
+            ('registered', '%.1f' % (new_secs * 1000), '%.1f' % (new_secs * 1e6 / ENTITIES))])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""ledger_export.py -- ledger export and import throughput, JSONL vs CSV
+
+Exports a 2000 user population, one of them with a backdated flow
+change still to be recomputed, in each format, then imports it into a
+fresh Datastore putting 1 and IMPORT_PARALLEL batches at a time, and
+reports entities/s and shard bytes. Checks each import re-exports to
+the same records and queues the recompute again, that an import
+stopped after its first kinds resumes without putting their shards or
+queueing the recompute again, that the recompute then rewrites the
+restored rows as a day-by-day replay would, and that a new export into
+the same directory isn't taken for it.
+
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks.population import makePopulation
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from balances import balanceHistorysAsync
+from balances import missedBalanceHistorys
+from ledgerexport import CHECKPOINT
+from ledgerexport import FORMATS
+from ledgerexport import IMPORT_PARALLEL
+from ledgerexport import LEDGER_KINDS
+from ledgerexport import LocalShardStore
+from ledgerexport import _allocatedId
+from ledgerexport import _toRecord
+from ledgerexport import exportLedger
+from ledgerexport import importLedger
+from ledger import ONE_BALLOT
+from models import Profile
+from models import Relation
+from recompute import RECOMPUTE_QUEUE
+from recompute import backdateFlowAsync
+from recompute import recomputeChunk
+from stats import RpcCounter
+
+USERS = 2000
+SHARD_SIZE = 5000               # a few shards per kind at this size
+BACKDATE_DAYS = 20              # days before its balance the pending change starts
+BACKDATE_FLOW = 100
+
+
+def _records():
+    """Every ledger entity, as sorted records."""
+    return sorted(_toRecord(e) for model in LEDGER_KINDS.values()
+                  for e in model.query().fetch(use_cache=False, use_memcache=False))
+
+
+def _totals(results):
+    """(entities, seconds) over every kind."""
+    return (sum(r[0] for r in results.values()), sum(r[1] for r in results.values()))
+
+
+def _setUp():
+    """A testbed with the task queue recomputes are queued on."""
+    tb = setUpTestbed()
+    tb.init_taskqueue_stub(root_path='.')
+    return tb
+
+
+def _queued(tb):
+    """The recompute tasks queued."""
+    stub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    return stub.get_filtered_tasks(queue_names=[RECOMPUTE_QUEUE])
+
+
+def _drain(tb):
+    """Run the recompute queue's tasks, and the ones they add, until it's empty."""
+    stub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    while True:
+        tasks = _queued(tb)
+        if not tasks:
+            return
+        stub.FlushQueue(RECOMPUTE_QUEUE)
+        for task in tasks:
+            recomputeChunk(ndb.Key(urlsafe=task.extract_params()['job']))
+
+
+def _backdate():
+    """Backdate a flow change for the user with the latest balance, leaving
+    its recompute queued; returns (its key, its days from the change replayed)."""
+    profile = max(Profile.query(), key=lambda p: p.balanceSnapshot.date)
+    last = profile.balanceSnapshot.date
+    start = last - datetime.timedelta(days=BACKDATE_DAYS)
+    day_before = start - datetime.timedelta(days=1)
+    before, = balanceHistorysAsync(profile.key, day_before, day_before).get_result()
+
+    @ndb.transactional
+    def txn():
+        current = profile.key.get()
+        backdateFlowAsync(current, BACKDATE_FLOW, start, []).get_result()
+        current.put()
+    txn()
+    return profile.key, missedBalanceHistorys(profile.key, before.balance, last,
+                                              {start: (BACKDATE_FLOW, [])})
+
+
+def _restart(store):
+    """Forget an earlier import of store's shards."""
+    if store.exists(CHECKPOINT):
+        os.remove(os.path.join(store.directory, CHECKPOINT))
+
+
+def main():
+    tb = _setUp()
+    makePopulation(USERS)
+    backdated, replayed = _backdate()
+    expected = _records()
+    directory = tempfile.mkdtemp()
+    rows = []
+    try:
+        stores = {}
+        for fmt in FORMATS:
+            stores[fmt] = store = LocalShardStore(os.path.join(directory, fmt))
+            with RpcCounter() as rpcs:
+                entities, seconds = _totals(exportLedger(store, fmt, shard_size=SHARD_SIZE))
+            assert entities == len(expected)
+            size = sum(store.size(n) for n in os.listdir(store.directory))
+            rows.append(('export', fmt, '-', entities, '%.2f' % seconds,
+                         '%.0f' % (entities / seconds), size, rpcs.total))
+        tb.deactivate()
+
+        for fmt in FORMATS:
+            for parallel in (1, IMPORT_PARALLEL):
+                store = stores[fmt]
+                _restart(store)
+                tb = _setUp()
+                with RpcCounter() as rpcs:
+                    entities, seconds = _totals(importLedger(store, parallel=parallel))
+                assert entities == len(expected)
+                assert _records() == expected
+                assert len(_queued(tb)) == 1
+                rows.append(('import', fmt, parallel, entities, '%.2f' % seconds,
+                             '%.0f' % (entities / seconds), '-', rpcs.total))
+                tb.deactivate()
+
+        #stop after the first two kinds, then resume
+        store = stores['jsonl']
+        _restart(store)
+        tb = _setUp()
+        first = list(LEDGER_KINDS)[:2]
+        importLedger(store, kinds=first)
+        assert not _queued(tb)
+        resumed = importLedger(store)
+        for kind in first:
+            assert resumed[kind][0] == 0 and resumed[kind][2] > 0
+        assert _records() == expected
+        importLedger(store)
+        assert len(_queued(tb)) == 1
+        #and a new relation can't take an imported one's id
+        highest = max(_allocatedId(r['__key__']) for r in expected)
+        assert Relation.allocate_ids(size=1)[0] > highest
+
+        #the recompute carries on from the restored rows
+        _drain(tb)
+        rewritten = balanceHistorysAsync(backdated, replayed[0].date).get_result()
+        assert [bh.date for bh in rewritten] == [bh.date for bh in replayed]
+        for row, want in zip(rewritten, replayed):
+            assert abs(row.eodBalance - want.eodBalance) < 1e-6 * ONE_BALLOT
+            assert row.DailyNetIncomingBFlow == want.DailyNetIncomingBFlow
+
+        #a new export into the directory doesn't resume the old import
+        exportLedger(store, 'jsonl', shard_size=SHARD_SIZE)
+        try:
+            importLedger(store)
+            assert False, 'a checkpoint from another export must be rejected'
+        except ValueError:
+            pass
+        tb.deactivate()
+    finally:
+        shutil.rmtree(directory)
+
+    report('Ledger of %d users, %d entities, %d per shard (testbed)'
+           % (USERS, len(expected), SHARD_SIZE),
+           ('direction', 'format', 'parallel', 'entities', 's', 'entities/s', 'bytes', 'RPCs'),
+           rows)
+
+
+if __name__ == '__main__':
+    main()
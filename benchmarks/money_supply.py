@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""money_supply.py -- sharded money supply vs scanning every balance
+
+Signs up 300 users through the API, creates, changes and ends
+relations between them and folds the representatives' flow shards.
+Then it reads the supply three ways: getMoneySupply from its shards,
+a scan of every user's getBalance, and the reconciliation sums. It
+checks they agree and times each.
+
+"""
+
+import datetime
+import random
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+from protorpc import message_types
+
+from elasticrepublic import ElasticRepublicApi
+from models import MoneySupplyReconciliation
+from models import RelationForm
+from models import RelationKeyForm
+from settlement import settleProfiles
+from supply import KINDS
+from supply import _setPagesAsync
+from supply import finishReconciliation
+from supply import sumReconciliationPage
+
+USERS = 300
+RELATIONS = 600
+
+
+def _scan(api, user_ids):
+    """Sum every user's balance today, as the supply was computed before."""
+    total = 0.0
+    for user_id in user_ids:
+        signIn(user_id)
+        total += api._getBalanceFormAsync(user_id, datetime.date.today()) \
+                    .get_result().eodBalance
+    return total
+
+
+def _reconcile():
+    """Run a reconciliation with each kind summed as one range."""
+    run_key = MoneySupplyReconciliation().put()
+    for kind in KINDS:
+        sumReconciliationPage(run_key, kind, 0)
+        _setPagesAsync(run_key, kind, 1).get_result()
+    finishReconciliation(run_key)
+    return run_key.get()
+
+
+def main():
+    tb = setUpTestbed()
+    api = ElasticRepublicApi()
+    rand = random.Random(18)
+    user_ids = ['user%d@example.com' % i for i in range(USERS)]
+    for user_id in user_ids:
+        signIn(user_id)
+        api._doProfile()
+
+    rels = []
+    for i in range(RELATIONS):
+        constit, rep = rand.sample(user_ids, 2)
+        signIn(constit)
+        rels.append(api.createRelation(RelationForm(
+            name='relation %d' % i, dailyRate=rand.randint(1, 500), repUserId=rep)))
+    for rel in rels[::5]:
+        signIn(rel.constitUserId)
+        api.endRelation(RelationKeyForm(websafeKey=rel.websafeKey))
+    settleProfiles([ndb.Key('Profile', u) for u in user_ids], datetime.date.today())
+    ndb.get_context().clear_cache()
+
+    sharded_secs, supply = timed(api.getMoneySupply, message_types.VoidMessage())
+    scan_secs, scanned = timed(_scan, api, user_ids)
+    reconcile_secs, run = timed(_reconcile)
+    tb.deactivate()
+
+    assert supply.users == USERS and supply.DailyNetIncomingBFlow == 0
+    assert abs(supply.supply - scanned) < 1e-6 * scanned
+    assert abs(run.difference) < 1e-6 * scanned
+
+    report('Money supply of %d users, %d relations (testbed)' % (USERS, RELATIONS),
+           ('method', 'ms', 'supply'),
+           [('getMoneySupply', '%.1f' % (sharded_secs * 1000), '%.2f' % supply.supply),
+            ('getBalance scan', '%.1f' % (scan_secs * 1000), '%.2f' % scanned),
+            ('reconciliation', '%.1f' % (reconcile_secs * 1000), '%.2f' % run.reconciled)])
+
+
+if __name__ == '__main__':
+    main()
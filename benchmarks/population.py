@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""population.py -- synthetic Elastic Republic populations for benchmarks
+
+Saves N Profiles straight to the Datastore with relations whose
+representatives follow a power law (a few with most constituents),
+and users idle for 0 to 1000 days, each with a short BalanceHistory
+ending on their last active day.
+
+"""
+
+import bisect
+import datetime
+import random
+
+from google.appengine.ext import ndb
+
+from balances import missedBalanceHistorys
+from balances import putBalanceHistorysAsync
+from ledger import ONE_BALLOT
+from ledger import Balance
+from models import Profile
+from models import Relation
+from models import RelationHead
+
+PUT_BATCH = 500
+
+
+class PowerLaw(object):
+    """Pick indexes 0..n-1 with weight 1 / (rank + 1) ** alpha."""
+
+    def __init__(self, n, alpha, rand):
+        self._rand = rand
+        self._cumulative = []
+        total = 0.0
+        for rank in range(n):
+            total += 1.0 / (rank + 1) ** alpha
+            self._cumulative.append(total)
+
+    def pick(self):
+        """Return a random index."""
+        return bisect.bisect(self._cumulative, self._rand.random() * self._cumulative[-1])
+
+
+def makePopulation(users, relations_per_user=3, alpha=1.2, max_idle_days=1000,
+                   history_days=30, seed=16):
+    """Save a synthetic population, returning its user ids."""
+    rand = random.Random(seed)
+    today = datetime.date.today()
+    user_ids = ['user%d@example.com' % i for i in range(users)]
+    reps = PowerLaw(users, alpha, rand)
+
+    #relations, started when both users were last active
+    idle = [rand.randint(0, max_idle_days) for _ in user_ids]
+    flows = [0] * users
+    entities = []
+    first_id, _ = Relation.allocate_ids(size=users * relations_per_user)
+    for n in range(users * relations_per_user):
+        rep = reps.pick()
+        constit = rand.randrange(users - 1)
+        constit += constit >= rep
+        rate = rand.randint(1, 500)
+        head_key = ndb.Key(RelationHead, first_id + n,
+                           parent=ndb.Key(Profile, user_ids[constit]))
+        rel = Relation(key=RelationHead.versionKey(head_key, 1), name='relation %d' % n,
+                       dailyRate=rate, constitUserId=user_ids[constit],
+                       repUserId=user_ids[rep], version=1,
+                       startDate=datetime.datetime.combine(
+                           today - datetime.timedelta(days=max(idle[constit], idle[rep])),
+                           datetime.time()))
+        entities.extend([rel, RelationHead(key=head_key, currentKey=rel.key, currentVersion=1)])
+        flows[constit] -= rate
+        flows[rep] += rate
+
+    #profiles with a history ending on their last active day
+    bal_hists = []
+    for user_id, user_idle, flow in zip(user_ids, idle, flows):
+        p_key = ndb.Key(Profile, user_id)
+        last = today - datetime.timedelta(days=user_idle)
+        start = Balance(last - datetime.timedelta(days=max(history_days, 1)), ONE_BALLOT, flow)
+        history = missedBalanceHistorys(p_key, start, last)
+        profile = Profile(key=p_key, userId=user_id, displayName=user_id.split('@')[0],
+                          mainEmail=user_id, teeShirtSize='NOT_SPECIFIED',
+                          MostRecentBalanceHistoryKey=history[-1].key)
+        profile.setBalanceSnapshot(history[-1].balance)
+        entities.append(profile)
+        bal_hists.extend(history)
+
+    for i in range(0, len(entities), PUT_BATCH):
+        ndb.put_multi(entities[i:i + PUT_BATCH])
+    for i in range(0, len(bal_hists), PUT_BATCH):
+        putBalanceHistorysAsync(bal_hists[i:i + PUT_BATCH]).get_result()
+    return user_ids
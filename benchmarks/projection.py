@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""projection.py -- multi-user balance projection, NumPy vs scalar loop
+
+Projects 100k users four years (1460 days) ahead with a relation
+schedule, vectorized across users with projectBalances and with the
+one user, one day at a time nextBalance loop. The scalar loop is timed
+on a sample and scaled up, and checked against the vectorized result.
+
+"""
+
+import random
+
+from benchmarks import report
+from benchmarks import timed
+
+import ledger
+from ledger import ONE_BALLOT
+from ledger import projectBalances
+
+USERS = 100000
+DAYS = 1460
+RELATIONS = 200000
+SCALAR_SAMPLE = 1000
+
+
+def _population(rand):
+    """Starting balances, flows and a relation schedule for USERS users."""
+    balances = [rand.uniform(0, 2 * ONE_BALLOT) for _ in xrange(USERS)]
+    flows = [0] * USERS
+    relations = []
+    for _ in xrange(RELATIONS):
+        constit, rep = rand.sample(xrange(USERS), 2)
+        start = rand.randint(1, DAYS)
+        end = rand.choice((None, rand.randint(start, DAYS)))
+        relations.append((constit, rep, rand.randint(1, 500), start, end))
+    return balances, flows, relations
+
+
+def main():
+    balances, flows, relations = _population(random.Random(1460))
+
+    vector_secs, vector = timed(projectBalances, balances, flows, relations, DAYS)
+
+    # the scalar loop on the first SCALAR_SAMPLE users, their relations only
+    sample = [(c if c < SCALAR_SAMPLE else None, r if r < SCALAR_SAMPLE else None,
+               rate, start, end)
+              for c, r, rate, start, end in relations
+              if c < SCALAR_SAMPLE or r < SCALAR_SAMPLE]
+    numpy, ledger.numpy = ledger.loadNumpy(), None
+    try:
+        scalar_secs, scalar = timed(projectBalances, balances[:SCALAR_SAMPLE],
+                                    flows[:SCALAR_SAMPLE], sample, DAYS)
+    finally:
+        ledger.numpy = numpy
+    scalar_secs *= float(USERS) / SCALAR_SAMPLE
+
+    #the sample's users see the same flows in both runs
+    error = max(abs(s - v) / abs(s) for s, v in zip(scalar, vector[:SCALAR_SAMPLE]))
+
+    user_days = USERS * DAYS
+    report('Balance projection, %d users x %d days, %d relations' % (USERS, DAYS, RELATIONS),
+           ('engine', 'seconds', 'user-days/s'),
+           [('scalar (scaled)', '%.1f' % scalar_secs, '%.3g' % (user_days / scalar_secs)),
+            ('numpy' if numpy else 'numpy (missing)', '%.1f' % vector_secs,
+             '%.3g' % (user_days / vector_secs))])
+    print('max relative difference on sample: %.3g' % error)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""relation_expiry.py -- ending expired relations found by index vs a scan
+
+200 users hold 2000 open-ended relations, 1000 one-time transactions
+from yesterday and 40 from a month ago. Times finding the expired ones
+by the endDate index against scanning every active relation, then runs
+an expiry through its task queue and reports its throughput. Checks
+each user's flow matches the relations left active.
+
+"""
+
+import collections
+import datetime
+import random
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from protorpc import message_types
+
+from elasticrepublic import ElasticRepublicApi
+from expiry import EXPIRY_QUEUE
+from expiry import FANOUT_URL
+from expiry import _expiredQuery
+from expiry import expireBatch
+from expiry import fanOutExpiryPage
+from expiry import startExpiry
+from models import Relation
+from models import RelationExpiryRun
+from models import RelationForm
+from stats import RpcCounter
+
+USERS = 200
+ONGOING = 2000
+ONE_TIME = 1000
+BACKDATED = 40
+
+
+def _create(api, rand, user_ids, count, start=None, one_time=False):
+    """Create count relations between random users."""
+    for i in range(count):
+        constit, rep = rand.sample(user_ids, 2)
+        signIn(constit)
+        api.createRelation(RelationForm(
+            name='relation %d' % i, dailyRate=rand.randint(1, 500), repUserId=rep,
+            startDate=start.isoformat() if start else None, oneTimeTransaction=one_time))
+
+
+def _scan(day):
+    """Find the expired relations by reading every active one."""
+    start = datetime.datetime.combine(day, datetime.time())
+    return [r.key for r in Relation.query(Relation.active == True)
+            if r.endDate is not None and r.endDate < start]
+
+
+def _drain(stub):
+    """Run the expiry queue's tasks, and the ones they add, until it's empty."""
+    while True:
+        tasks = stub.get_filtered_tasks(queue_names=[EXPIRY_QUEUE])
+        if not tasks:
+            return
+        stub.FlushQueue(EXPIRY_QUEUE)
+        for task in tasks:
+            params = task.extract_params()
+            run_key = ndb.Key(RelationExpiryRun, int(params['run']))
+            day = datetime.datetime.strptime(params['day'], '%Y-%m-%d').date()
+            if task.url == FANOUT_URL:
+                cursor = Cursor(urlsafe=params['cursor']) if params.get('cursor') else None
+                fanOutExpiryPage(run_key, day, int(params['page']),
+                                 int(params['batches']), cursor)
+            else:
+                keys = params['key'] if isinstance(params['key'], list) else [params['key']]
+                expireBatch(run_key, int(params['batch']),
+                            [ndb.Key(urlsafe=k) for k in keys], day)
+
+
+def _expire(stub, day):
+    """Start an expiry run and run all its tasks; return the run."""
+    run_key = startExpiry(day)
+    _drain(stub)
+    return run_key.get()
+
+
+def _expectedFlows():
+    """Each user's net flow from the relations still active."""
+    flows = collections.Counter()
+    for rel in Relation.query(Relation.active == True):
+        flows[rel.repUserId] += rel.dailyRate
+        flows[rel.constitUserId] -= rel.dailyRate
+    return flows
+
+
+def main():
+    tb = setUpTestbed()
+    tb.init_taskqueue_stub(root_path='.')
+    stub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    api = ElasticRepublicApi()
+    rand = random.Random(24)
+    today = datetime.date.today()
+    user_ids = ['user%d@example.com' % i for i in range(USERS)]
+    for user_id in user_ids:
+        signIn(user_id)
+        api._doProfile()
+    _create(api, rand, user_ids, ONGOING)
+    _create(api, rand, user_ids, ONE_TIME, today - datetime.timedelta(days=1), one_time=True)
+    _create(api, rand, user_ids, BACKDATED, today - datetime.timedelta(days=30), one_time=True)
+    ndb.get_context().clear_cache()
+
+    with RpcCounter() as index_rpcs:
+        index_secs, indexed = timed(lambda: _expiredQuery(today).fetch(keys_only=True))
+    with RpcCounter() as scan_rpcs:
+        scan_secs, scanned = timed(_scan, today)
+    assert sorted(indexed) == sorted(scanned)
+    assert len(indexed) == ONE_TIME + BACKDATED
+
+    with RpcCounter() as expiry_rpcs:
+        expiry_secs, run = timed(_expire, stub, today)
+    assert run.finished and run.expired == ONE_TIME + BACKDATED
+    assert not _expiredQuery(today).fetch(keys_only=True)
+
+    flows = _expectedFlows()
+    for user_id in user_ids:
+        balance = api._getBalanceFormAsync(user_id, today).get_result()
+        assert balance.DailyNetIncomingBFlow == flows[user_id]
+    signIn(user_ids[0])
+    assert api.getMoneySupply(message_types.VoidMessage()).DailyNetIncomingBFlow == 0
+    tb.deactivate()
+
+    report('Finding %d expired among %d active relations (testbed)'
+           % (len(indexed), ONGOING + len(indexed)),
+           ('method', 'ms', 'RPCs', 'entities read'),
+           [('endDate index', '%.1f' % (index_secs * 1000), index_rpcs.total,
+             index_rpcs.entitiesRead),
+            ('scan', '%.1f' % (scan_secs * 1000), scan_rpcs.total, scan_rpcs.entitiesRead)])
+    report('Expiry run through the task queue, run serially (testbed)',
+           ('ended', 'batches', 'ms', 'relations/s', 'RPCs/relation'),
+           [(run.expired, run.batches, '%.0f' % (expiry_secs * 1000),
+             '%.0f' % (run.expired / expiry_secs),
+             '%.1f' % (float(expiry_rpcs.total) / run.expired))])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""relation_rpcs.py -- Datastore RPCs and latency per createRelation
+
+Runs the original serial createRelation sequence and the batched,
+transactional _doRelation against the same starting state on the testbed.
+
+"""
+
+import datetime
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+
+from balances import getBalanceAsync
+from balances import getMostRecentBalanceHistoryAsync
+from balances import missedBalanceHistorys
+from balances import putBalanceHistorysAsync
+from elasticrepublic import ElasticRepublicApi
+from ledger import ONE_BALLOT
+from models import BalanceHistory
+from models import Profile
+from models import Relation
+from models import RelationForm
+from stats import RpcCounter
+
+GAPS = (0, 1, 30)
+
+
+def _seed(user_id, gap):
+    """Save a Profile whose BalanceHistory stopped `gap` days ago."""
+    p_key = ndb.Key(Profile, user_id)
+    day = datetime.date.today() - datetime.timedelta(days=gap)
+    bh = BalanceHistory(key=BalanceHistory.keyFor(p_key, day), date=day,
+                        eodBalance=ONE_BALLOT, DailyNetIncomingBFlow=0)
+    Profile(key=p_key, userId=user_id, MostRecentBalanceHistoryKey=bh.key).put()
+    bh.put()
+
+
+def _catchUp(profile):
+    """Write a Profile's missed BalanceHistorys in a batch, returning today's."""
+    balance = getBalanceAsync(profile).get_result()
+    bal_hists = missedBalanceHistorys(profile.key, balance, datetime.date.today())
+    if not bal_hists:
+        return getMostRecentBalanceHistoryAsync(profile).get_result()
+    putBalanceHistorysAsync(bal_hists).get_result()
+    return bal_hists[-1]
+
+
+def _oldCreateRelation(api, cons_id, repr_id):
+    """The original serial createRelation sequence (catch-up already batched)."""
+    r_key = ndb.Key(Relation, Relation.allocate_ids(size=1)[0])
+    rel = Relation(key=r_key, name='old', dailyRate=100, constitUserId=cons_id,
+                   repUserId=repr_id, startDate=datetime.datetime.today(), version=1)
+    rel.put()
+    cons_prof = ndb.Key(Profile, cons_id).get()
+    cons_prof.activeRelationsKeys.append(r_key)
+    cons_prof.put()
+    repr_prof = ndb.Key(Profile, repr_id).get()
+    repr_prof.activeRelationsKeys.append(r_key)
+    repr_prof.put()
+    cons_bh = _catchUp(cons_prof)
+    repr_bh = _catchUp(repr_prof)
+    api._AddRelationToBalanceHist(rel, cons_bh, -rel.dailyRate)
+    api._AddRelationToBalanceHist(rel, repr_bh, rel.dailyRate)
+    cons_bh.put()
+    repr_bh.put()
+
+
+def main():
+    tb = setUpTestbed()
+    api = ElasticRepublicApi()
+    rows = []
+    for gap in GAPS:
+        for label in ('old', 'new'):
+            cons_id, repr_id = '%s-c-%d@example.com' % (label, gap), '%s-r-%d' % (label, gap)
+            _seed(cons_id, gap)
+            _seed(repr_id, gap)
+            ndb.get_context().clear_cache()
+            with RpcCounter() as rpcs:
+                if label == 'old':
+                    secs, _ = timed(_oldCreateRelation, api, cons_id, repr_id)
+                else:
+                    signIn(cons_id)
+                    secs, _ = timed(api._doRelation,
+                                    RelationForm(name='new', dailyRate=100, repUserId=repr_id))
+            rows.append((gap, label, rpcs.total, rpcs.calls['datastore_v3.Put'],
+                         '%.1f' % (secs * 1000)))
+    tb.deactivate()
+    report('createRelation RPCs (testbed)',
+           ('gap days', 'path', 'RPCs', 'puts', 'ms'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""relation_versions.py -- current version lookup on long-lived Relations
+
+Gives Relations hundreds of rate changes, once as the naive chain
+sketched in TODO1.py (each version a child of the one before) and once
+through updateRelation's head and flat versions. It then compares
+update latency, finding the current version, and key size.
+
+"""
+
+import datetime
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+
+from elasticrepublic import ElasticRepublicApi
+from models import Profile
+from models import Relation
+from models import RelationForm
+from stats import RpcCounter
+
+VERSIONS = (10, 90, 300, 1000)
+
+
+def _naiveChain(versions):
+    """Save a chain of versions each under the last; returns the root key."""
+    root = key = ndb.Key(Relation, 'naive-%d' % versions)
+    for version in range(1, versions + 1):
+        Relation(key=key, name='naive', dailyRate=version, repUserId='rep',
+                 startDate=datetime.datetime.today(), version=version).put()
+        key = ndb.Key(Relation, version + 1, parent=key)
+    return root
+
+
+def _naiveCurrent(root):
+    """Walk down from the root a child query per version."""
+    key = root
+    while True:
+        child = Relation.query(ancestor=key) \
+                        .filter(Relation.version == len(key.pairs()) + 1) \
+                        .get(keys_only=True)
+        if child is None:
+            return key.get()
+        key = child
+
+
+def _headCurrent(head_key):
+    """The head's pointer, then the version it points at."""
+    return head_key.get().currentKey.get()
+
+
+def _time(rows, label, versions, update_secs, lookup, key):
+    """Add a row timing one current version lookup."""
+    ndb.get_context().clear_cache()
+    with RpcCounter() as rpcs:
+        secs, current = timed(lookup, key)
+    assert current.version == versions
+    rows.append((versions, label, '%.1f' % (update_secs * 1000),
+                 '%.1f' % (secs * 1000), rpcs.total, len(current.key.serialized())))
+
+
+def main():
+    tb = setUpTestbed()
+    api = ElasticRepublicApi()
+    Profile(key=ndb.Key(Profile, 'rep'), userId='rep').put()
+    rows = []
+    for versions in VERSIONS:
+        try:
+            secs, root = timed(_naiveChain, versions)
+        except Exception as e:
+            rows.append((versions, 'chain', 'fails: %s' % type(e).__name__, '-', '-', '-'))
+        else:
+            _time(rows, 'chain', versions, secs / versions, _naiveCurrent, root)
+
+        cons_id = 'c%d@example.com' % versions
+        signIn(cons_id)
+        api._doProfile()
+        rel = api._doRelationAsync(RelationForm(name='head', dailyRate=1,
+                                                repUserId='rep')).get_result()
+        start = datetime.datetime.now()
+        for rate in range(2, versions + 1):
+            rel = api._changeRelationAsync(rel.key.urlsafe(), rate).get_result()
+        secs = (datetime.datetime.now() - start).total_seconds()
+        _time(rows, 'head', versions, secs / max(versions - 1, 1), _headCurrent,
+              rel.key.parent())
+    tb.deactivate()
+    report('Relation versions: current version lookup (testbed)',
+           ('versions', 'layout', 'update ms', 'lookup ms', 'lookup RPCs', 'key bytes'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""rep_contention.py -- concurrent createRelation against one representative
+
+Runs many createRelation transactions concurrently on the ndb event loop,
+all naming the same representative, with one incoming flow shard (a single
+hot entity, as before sharding) and with the default number of shards.
+Transaction retries are counted as BeginTransaction calls beyond one per
+relation.
+
+"""
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from google.appengine.ext import ndb
+
+import counters
+from elasticrepublic import ElasticRepublicApi
+from models import RelationForm
+from stats import RpcCounter
+
+CONSTITUENTS = 200
+REPRESENTATIVE = 'popular-rep'
+
+
+def _createConcurrently(api, label):
+    """Start every constituent's createRelation before waiting on any."""
+    futures = []
+    for i in range(CONSTITUENTS):
+        cons_id = '%s-%d@example.com' % (label, i)
+        signIn(cons_id)
+        ndb.put_multi(api._newProfile(ndb.Key('Profile', cons_id), cons_id, cons_id, cons_id))
+        # the request's user is read before the tasklet's first yield
+        futures.append(api._doRelationAsync(
+            RelationForm(name='dues', dailyRate=10, repUserId=REPRESENTATIVE)))
+    ndb.Future.wait_all(futures)
+    return [f.get_exception() for f in futures]
+
+
+def main():
+    rows = []
+    api = ElasticRepublicApi()
+    for shards in (1, counters.INCOMING_FLOW_SHARDS):
+        tb = setUpTestbed()
+        counters.INCOMING_FLOW_SHARDS = shards
+        with RpcCounter() as rpcs:
+            secs, errors = timed(_createConcurrently, api, 'shards%d' % shards)
+        failed = len([e for e in errors if e])
+        retries = rpcs.calls['datastore_v3.BeginTransaction'] - CONSTITUENTS
+        rows.append((shards, CONSTITUENTS, retries, failed, '%.1f' % (secs * 1000)))
+        tb.deactivate()
+    report('Concurrent relations to one representative (testbed)',
+           ('shards', 'relations', 'txn retries', 'failed', 'ms'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""server_stats.py -- per-method instrumentation on the testbed stubs
+
+Signs a few users in, makes profiles and relations through the API and
+reads them back, then prints getServerStats' percentiles and writes
+the raw JSON dump for offline analysis.
+
+"""
+
+import json
+import sys
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+
+from protorpc import message_types
+
+import elasticrepublic
+from elasticrepublic import ElasticRepublicApi
+from models import ConditionalForm
+from models import RelationForm
+from models import ServerStatsRequestForm
+from models import UserIDForm
+
+USERS = 20
+ADMIN = 'admin@example.com'
+
+
+def main():
+    tb = setUpTestbed()
+    api = ElasticRepublicApi()
+    emails = ['user%d@example.com' % i for i in range(USERS)]
+    for i, email in enumerate(emails):
+        signIn(email)
+        api.getProfile(ConditionalForm())
+        api.createRelation(RelationForm(name='r%d' % i, dailyRate=10,
+                                        repUserId=emails[(i + 1) % USERS]))
+        api.getBalance(message_types.VoidMessage())
+        api.getUsersActiveRelations(UserIDForm(userId=email))
+
+    elasticrepublic.ADMIN_EMAILS = (ADMIN,)
+    signIn(ADMIN)
+    stats = api.getServerStats(ServerStatsRequestForm(raw=True))
+    tb.deactivate()
+
+    for item in stats.items:
+        report('%s: %d calls, %d errors' % (item.endpoint, item.calls, item.errors),
+               ('metric', 'p50', 'p90', 'p99', 'max', 'mean'),
+               [(m.name, '%.1f' % m.p50, '%.1f' % m.p90, '%.1f' % m.p99,
+                 '%.1f' % m.max, '%.2f' % m.mean)
+                for m in item.metrics if m.max])
+
+    path = sys.argv[1] if len(sys.argv) > 1 else 'server_stats.json'
+    with open(path, 'w') as f:
+        json.dump(json.loads(stats.json), f, indent=2, sort_keys=True)
+    print('JSON dump written to %s' % path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""settlement_queue.py -- nightly settlement through its task queue, run twice
+
+Settles a population idle up to MAX_IDLE_DAYS by running the settlement
+queue on the taskqueue stub, every fan-out and batch task twice as a
+retry after success would. Then starts the same day's settlement again.
+Checks every BalanceHistory row is written exactly once and every
+profile is settled to the day, and reports the run's throughput.
+
+"""
+
+import collections
+import datetime
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import timed
+from benchmarks.population import makePopulation
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from models import BalanceHistory
+from models import Profile
+from settlement import FANOUT_URL
+from settlement import SETTLEMENT_QUEUE
+from settlement import fanOutSettlementPage
+from settlement import settleBatch
+from settlement import startSettlement
+from stats import RpcCounter
+
+USERS = 500
+MAX_IDLE_DAYS = 30
+RUNS_PER_TASK = 2               # a retry of every task after it succeeded
+
+# BalanceHistory key path -> times it was put
+ROW_WRITES = collections.Counter()
+
+
+def _countRowWrites(service, call, request, response):
+    """apiproxy pre-call hook: count each BalanceHistory put by key."""
+    if service != 'datastore_v3' or call != 'Put':
+        return
+    for entity in request.entity_list():
+        path = entity.key().path().element_list()
+        if path[-1].type() == BalanceHistory._get_kind():
+            ROW_WRITES[tuple((e.type(), e.name() or e.id()) for e in path)] += 1
+
+
+def _drain(stub):
+    """Run the settlement queue's tasks, and the ones they add, until it's empty.
+
+    Returns the names of the tasks run.
+    """
+    names = []
+    while True:
+        tasks = stub.get_filtered_tasks(queue_names=[SETTLEMENT_QUEUE])
+        if not tasks:
+            return names
+        stub.FlushQueue(SETTLEMENT_QUEUE)
+        for task in tasks:
+            names.append(task.name)
+            params = task.extract_params()
+            day = datetime.datetime.strptime(params['day'], '%Y-%m-%d').date()
+            for _ in range(RUNS_PER_TASK):
+                if task.url == FANOUT_URL:
+                    cursor = Cursor(urlsafe=params['cursor']) if params.get('cursor') else None
+                    fanOutSettlementPage(day, int(params['page']), cursor)
+                else:
+                    keys = params['key'] if isinstance(params['key'], list) else [params['key']]
+                    settleBatch([ndb.Key(urlsafe=k) for k in keys], day)
+
+
+def _settle(stub, day):
+    """Start a settlement run for day and run all its tasks; returns the task names."""
+    startSettlement(day)
+    return _drain(stub)
+
+
+def main():
+    tb = setUpTestbed()
+    tb.init_taskqueue_stub(root_path='.')
+    stub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    today = datetime.date.today()
+    makePopulation(USERS, max_idle_days=MAX_IDLE_DAYS)
+    ndb.get_context().clear_cache()
+    missed = sum((today - p.balanceSnapshot.date).days for p in Profile.query())
+
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'settlement-rows', _countRowWrites, 'datastore_v3')
+    with RpcCounter() as rpcs:
+        seconds, first = timed(_settle, stub, today)
+    assert len(set(first)) == len(first)
+    assert len(ROW_WRITES) == missed
+    assert set(ROW_WRITES.values()) == set([1]), 'a row was written more than once'
+    for profile in Profile.query():
+        assert profile.balanceSnapshot.date == today
+        assert profile.MostRecentBalanceHistoryKey.get().date == today
+
+    #the same day's settlement again: named tasks or the balance markers
+    #keep it from writing anything
+    written = ROW_WRITES.copy()
+    second = _settle(stub, today)
+    assert ROW_WRITES == written
+    tb.deactivate()
+
+    report('Settlement of %d profiles idle up to %d days, each task run %d times (testbed)'
+           % (USERS, MAX_IDLE_DAYS, RUNS_PER_TASK),
+           ('run', 'tasks', 'rows written', 's', 'users/s', 'RPCs/user'),
+           [('first', len(first), len(ROW_WRITES), '%.2f' % seconds,
+             '%.0f' % (USERS / seconds), '%.1f' % (float(rpcs.total) / USERS)),
+            ('again', len(second), 0, '-', '-', '-')])
+
+
+if __name__ == '__main__':
+    main()
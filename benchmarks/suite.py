@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""suite.py -- ledger API load benchmark on a synthetic population
+
+Generates a population (see population.py) on the testbed, drives
+createRelation, getProfile, getUsersActiveRelations and
+getBalanceHistorysCreated through the ProtoRPC service methods, and
+writes throughput, p50/p99 latency and RPCs per call to a JSON results
+file. With --compare it also prints the change from an earlier results
+file, e.g.
+
+    $ GAE_SDK=~/google_appengine python -m benchmarks.suite --out new.json --compare old.json
+
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import random
+
+from benchmarks import percentile
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+from benchmarks.population import PowerLaw
+from benchmarks.population import makePopulation
+
+from google.appengine.ext import ndb
+from elasticrepublic import ElasticRepublicApi
+from models import ConditionalForm
+from models import RelationForm
+from models import UserIDForm
+from stats import RpcCounter
+
+# results compared with --compare; lower is better for all but throughput
+COMPARED = ('throughput', 'p50_ms', 'p99_ms', 'rpcs_per_call')
+
+
+def _operations(api, user_ids, rand, alpha):
+    """name -> function making one call as a random user."""
+    reps = PowerLaw(len(user_ids), alpha, rand)
+
+    def createRelation():
+        rep = user_ids[reps.pick()]
+        constit = rand.choice(user_ids)
+        while constit == rep:
+            constit = rand.choice(user_ids)
+        signIn(constit)
+        api.createRelation(RelationForm(name='bench', dailyRate=rand.randint(1, 500),
+                                        repUserId=rep))
+
+    def getProfile():
+        signIn(rand.choice(user_ids))
+        api.getProfile(ConditionalForm())
+
+    def getUsersActiveRelations():
+        signIn(rand.choice(user_ids))
+        api.getUsersActiveRelations(UserIDForm(userId=user_ids[reps.pick()]))
+
+    def getBalanceHistorysCreated():
+        signIn(rand.choice(user_ids))
+        api.getBalanceHistorysCreated(ConditionalForm())
+
+    return collections.OrderedDict([
+        ('createRelation', createRelation),
+        ('getProfile', getProfile),
+        ('getUsersActiveRelations', getUsersActiveRelations),
+        ('getBalanceHistorysCreated', getBalanceHistorysCreated),
+    ])
+
+
+def _measure(call, calls):
+    """Make calls, each as a fresh request; return its results entry."""
+    latencies, rpcs, kinds = [], 0, collections.Counter()
+    for _ in range(calls):
+        ndb.get_context().clear_cache()
+        with RpcCounter() as counter:
+            secs, _ = timed(call)
+        latencies.append(secs * 1000)
+        rpcs += counter.total
+        kinds.update(counter.byKind)
+    latencies.sort()
+    return {
+        'calls': calls,
+        'throughput': calls / (sum(latencies) / 1000),
+        'p50_ms': percentile(latencies, 0.50),
+        'p99_ms': percentile(latencies, 0.99),
+        'rpcs_per_call': float(rpcs) / calls,
+        'rpcs_per_call_by_kind': dict((k, float(n) / calls) for k, n in kinds.items()),
+    }
+
+
+def _compare(results, baseline):
+    """Print each compared result beside the baseline's."""
+    rows = []
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if not before:
+            continue
+        for metric in COMPARED:
+            change = (result[metric] - before[metric]) / before[metric] * 100 \
+                     if before[metric] else 0.0
+            rows.append((name, metric, '%.2f' % before[metric], '%.2f' % result[metric],
+                         '%+.1f%%' % change))
+    report('Compared with %s' % baseline['date'],
+           ('operation', 'metric', 'baseline', 'now', 'change'), rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--relations-per-user', type=int, default=3)
+    parser.add_argument('--alpha', type=float, default=1.2, help='power law exponent')
+    parser.add_argument('--max-idle-days', type=int, default=1000)
+    parser.add_argument('--calls', type=int, default=200, help='calls per operation')
+    parser.add_argument('--seed', type=int, default=16)
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--compare', help='earlier results file')
+    args = parser.parse_args()
+
+    tb = setUpTestbed()
+    populate_secs, user_ids = timed(makePopulation, args.users, args.relations_per_user,
+                                    args.alpha, args.max_idle_days, seed=args.seed)
+    rand = random.Random(args.seed)
+    results = collections.OrderedDict()
+    for name, call in _operations(ElasticRepublicApi(), user_ids, rand, args.alpha).items():
+        results[name] = _measure(call, args.calls)
+    tb.deactivate()
+
+    output = {'date': datetime.datetime.now().isoformat(),
+              'config': vars(args),
+              'populate_seconds': populate_secs,
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+
+    report('Ledger API, %d users (testbed)' % args.users,
+           ('operation', 'calls/s', 'p50 ms', 'p99 ms', 'RPCs/call'),
+           [(name, '%.1f' % r['throughput'], '%.1f' % r['p50_ms'], '%.1f' % r['p99_ms'],
+             '%.1f' % r['rpcs_per_call']) for name, r in results.items()])
+    print('Results written to %s' % args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            _compare(output, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
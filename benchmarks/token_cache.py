@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""token_cache.py -- bearer token lookups through the tokeninfo cache
+
+Serves tokeninfo from a fake urlfetch stub and a settable clock, and
+checks each tier of oauth.getOAuthUserIdAsync: a miss fetches once, then
+the instance cache and memcache answer until the token's expires_in
+passes; a rejected token is remembered for TOKEN_NEGATIVE_TTL; an
+outage or 5xx answer raises and is never cached. Reports the latency
+of a lookup from each tier.
+
+"""
+
+import json
+import os
+import time
+import urlparse
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+
+import endpoints
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import urlfetch_service_pb
+from google.appengine.runtime import apiproxy_errors
+
+import oauth
+from oauth import TOKEN_CACHE_STATS
+from oauth import TOKEN_NEGATIVE_TTL
+from oauth import TtlLruCache
+from oauth import getOAuthUserIdAsync
+
+TOKENS = 200
+EXPIRES_IN = 3600               # seconds tokeninfo gives each token
+
+
+class FakeTokenInfo(apiproxy_stub.APIProxyStub):
+    """The tokeninfo endpoint: known access tokens, rejections and outages."""
+
+    def __init__(self, users):
+        super(FakeTokenInfo, self).__init__('urlfetch')
+        self.users = users
+        self.status = 200           # a 5xx to answer every call with
+        self.unreachable = False
+        self.calls = 0
+
+    def _Dynamic_Fetch(self, request, response):
+        self.calls += 1
+        if self.unreachable:
+            raise apiproxy_errors.ApplicationError(
+                urlfetch_service_pb.URLFetchServiceError.FETCH_ERROR)
+        query = urlparse.parse_qs(urlparse.urlparse(request.url()).query)
+        token = query.get('access_token', [None])[0]
+        if self.status != 200:
+            response.set_statuscode(self.status)
+            response.set_content('backend error')
+        elif token in self.users:
+            response.set_statuscode(200)
+            response.set_content(json.dumps(
+                {'user_id': self.users[token], 'expires_in': EXPIRES_IN}))
+        else:
+            # id tokens, and access tokens it doesn't know
+            response.set_statuscode(400)
+            response.set_content(json.dumps({'error': 'invalid_token'}))
+
+
+class Clock(object):
+    """A time module stand-in for oauth, moved on by hand."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+def _lookup(token):
+    """Look a token up as a request bearing it would; returns (ms, user id)."""
+    os.environ['HTTP_AUTHORIZATION'] = 'Bearer %s' % token
+    start = time.time()
+    user_id = getOAuthUserIdAsync().get_result()
+    return (time.time() - start) * 1000, user_id
+
+
+def _tier(stub, token):
+    """Look a token up; returns (ms, user id, tier, tokeninfo calls)."""
+    before, calls = TOKEN_CACHE_STATS.copy(), stub.calls
+    ms, user_id = _lookup(token)
+    tier, = [k for k in TOKEN_CACHE_STATS if TOKEN_CACHE_STATS[k] != before[k]
+             and k != 'failures']
+    return ms, user_id, tier, stub.calls - calls
+
+
+def main():
+    tb = setUpTestbed()
+    os.environ.pop('OAUTH_USER_ID', None)
+    users = dict(('token-%d' % i, 'user%d' % i) for i in range(TOKENS))
+    stub = FakeTokenInfo(users)
+    apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', stub)
+    clock = oauth.time = Clock()
+    timings = dict((tier, []) for tier in ('misses', 'localHits', 'memcacheHits'))
+
+    def check(token, user_id, tier, calls):
+        ms, got_id, got_tier, got_calls = _tier(stub, token)
+        assert (got_id, got_tier, got_calls) == (user_id, tier, calls), \
+            (token, got_id, got_tier, got_calls)
+        if tier in timings:
+            timings[tier].append(ms)
+
+    try:
+        #a miss asks for an id token, then an access token; then it's cached
+        for token, user_id in sorted(users.items()):
+            check(token, user_id, 'misses', 2)
+            check(token, user_id, 'localHits', 0)
+
+        #a new instance finds them in memcache
+        oauth._token_cache = TtlLruCache(oauth.TOKEN_CACHE_SIZE)
+        for token, user_id in sorted(users.items()):
+            check(token, user_id, 'memcacheHits', 0)
+            check(token, user_id, 'localHits', 0)
+
+        #until expires_in passes
+        clock.now += EXPIRES_IN + 1
+        check('token-0', 'user0', 'misses', 2)
+
+        #a rejected token is remembered, for TOKEN_NEGATIVE_TTL only
+        check('forged', '', 'misses', 2)
+        check('forged', '', 'localHits', 0)
+        clock.now += TOKEN_NEGATIVE_TTL + 1
+        check('forged', '', 'misses', 2)
+
+        #an outage or a 5xx raises, and leaves nothing cached
+        clock.now += EXPIRES_IN + 1
+        for down in ('unreachable', 'status'):
+            if down == 'unreachable':
+                stub.unreachable = True
+            else:
+                stub.status = 503
+            calls = stub.calls
+            try:
+                _lookup('token-1')
+                assert False, 'a lookup during an outage must raise'
+            except endpoints.InternalServerErrorException:
+                pass
+            assert stub.calls - calls > 1      # retried within the deadline
+            stub.unreachable, stub.status = False, 200
+            check('token-1', 'user1', 'misses', 2)
+            clock.now += EXPIRES_IN + 1
+    finally:
+        oauth.time = time
+        tb.deactivate()
+
+    rows = []
+    for tier in ('misses', 'localHits', 'memcacheHits'):
+        ms = sorted(timings[tier])
+        rows.append((tier, len(ms), '%.3f' % (sum(ms) / len(ms)), '%.3f' % ms[len(ms) // 2]))
+    report('Bearer token lookups, %d tokens, fake tokeninfo (testbed)' % TOKENS,
+           ('tier', 'lookups', 'mean ms', 'median ms'),
+           rows)
+    print('tokeninfo calls: %d; counters: %s' % (stub.calls, dict(TOKEN_CACHE_STATS)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""view_cache.py -- page loads with and without the per-user view cache
+
+Each page load reads getProfile, getBalance and getUsersActiveRelations
+for one user; every WRITE_EVERY loads a user creates a relation. Runs
+the same script against the uncached builders and the cached endpoints
+on the memcache testbed stub, and checks every cached read matches a
+fresh build.
+
+"""
+
+import datetime
+import random
+
+from benchmarks import report
+from benchmarks import setUpTestbed
+from benchmarks import signIn
+from benchmarks import timed
+
+from protorpc import message_types
+
+import cache
+from cache import VIEW_CACHE_STATS
+from elasticrepublic import ElasticRepublicApi
+from models import ConditionalForm
+from models import RelationForm
+from models import UserIDForm
+from stats import RpcCounter
+
+USERS = 50
+LOADS = 2000
+WRITE_EVERY = 20
+
+
+def _cachedLoad(api, email):
+    """One page load through the cached endpoints."""
+    signIn(email)
+    return (api.getProfile(ConditionalForm()),
+            api.getBalance(message_types.VoidMessage()),
+            api.getUsersActiveRelations(UserIDForm(userId=email)))
+
+
+def _uncachedLoad(api, email):
+    """One page load straight from the Datastore."""
+    signIn(email)
+    relations = api._getActiveRelationFormsAsync(email).get_result()
+    api._fillDisplayNamesAsync(relations.items).get_result()
+    return (api._doProfile(),
+            api._getBalanceFormAsync(email, datetime.date.today()).get_result(),
+            relations)
+
+
+def _untagged(page):
+    """A page load's views without the etags the endpoints add."""
+    for form in page:
+        if hasattr(form, 'etag'):
+            form.reset('etag')
+    return page
+
+
+def _run(load, check):
+    """Replay the page load script, returning (seconds, datastore RPCs)."""
+    tb = setUpTestbed()
+    api = ElasticRepublicApi()
+    emails = ['user%d@example.com' % i for i in range(USERS)]
+    for email in emails:
+        signIn(email)
+        api._doProfile()
+    rand = random.Random(14)
+    seconds = 0.0
+    with RpcCounter() as rpcs:
+        for i in range(LOADS):
+            email = rand.choice(emails)
+            if i % WRITE_EVERY == 0:
+                signIn(email)
+                api._doRelation(RelationForm(name='r%d' % i, dailyRate=10,
+                                             repUserId=rand.choice(emails)))
+            secs, page = timed(load, api, email)
+            seconds += secs
+            if check:
+                assert _untagged(page) == _uncachedLoad(api, email)
+    tb.deactivate()
+    datastore = sum(n for call, n in rpcs.calls.items() if call.startswith('datastore_v3.'))
+    return seconds, datastore
+
+
+def main():
+    #the testbed's Datastore is strongly consistent, and the whole run
+    #takes less than the production window
+    cache.CONSISTENCY_WINDOW = 1
+    rows = []
+    for label, load in (('uncached', _uncachedLoad), ('cached', _cachedLoad)):
+        VIEW_CACHE_STATS.clear()
+        secs, datastore = _run(load, check=False)
+        rows.append((label, '%.2f' % (secs * 1000 / LOADS), '%.2f' % (float(datastore) / LOADS)))
+    report('Page loads, %d users, a write every %d loads (testbed)' % (USERS, WRITE_EVERY),
+           ('views', 'ms/load', 'datastore RPCs/load'), rows)
+    report('View cache hit rates', ('view', 'hits', 'misses'),
+           [(view, VIEW_CACHE_STATS[view + 'Hits'], VIEW_CACHE_STATS[view + 'Misses'])
+            for view in ('profile', 'balance', 'relations')])
+
+    #and no read after a write is stale
+    _run(_cachedLoad, check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Elastic Republic read-through memcache of per-user API views. Each user
+has a generation number in every view's cache key; writes bump it, so a
+view cached before a write is never read again.
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import collections
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protobuf
+
+VIEW_CACHE_TTL = 3600           # seconds a cached view is kept
+CONSISTENCY_WINDOW = 10         # seconds after a write query-built views aren't cached
+
+# view cache hit/miss counters for this instance, by view
+VIEW_CACHE_STATS = collections.Counter()
+
+
+def _generationKey(user_id):
+    return 'gen:' + user_id
+
+
+def _writtenKey(user_id):
+    return 'written:' + user_id
+
+
+def _initialGeneration():
+    """A generation above any handed out before memcache forgot a user's."""
+    # milliseconds since the epoch outgrow one increment per write
+    return int(time.time() * 1000)
+
+
+@ndb.tasklet
+def getGenerationAsync(user_id):
+    """Get a user's generation number, None while memcache is unavailable."""
+    ctx = ndb.get_context()
+    generation = yield ctx.memcache_get(_generationKey(user_id))
+    if generation is None:
+        yield ctx.memcache_add(_generationKey(user_id), _initialGeneration())
+        #another request may have added its own first
+        generation = yield ctx.memcache_get(_generationKey(user_id))
+    raise ndb.Return(generation)
+
+
+@ndb.tasklet
+def bumpGenerationsAsync(user_ids):
+    """Invalidate every cached view of these users; call once the write commits."""
+    ctx = ndb.get_context()
+    user_ids = set(user_ids)
+    yield [ctx.memcache_incr(_generationKey(u), initial_value=_initialGeneration())
+           for u in user_ids] + \
+          [ctx.memcache_set(_writtenKey(u), True, time=CONSISTENCY_WINDOW)
+           for u in user_ids]
+
+
+def _etag(key):
+    """The ETag of the view cached under key."""
+    # the generation is in the key, so a write changes every view's tag
+    return '"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+
+
+def _isConditional(form_class):
+    """Whether form_class carries an etag and notModified."""
+    return hasattr(form_class, 'etag') and hasattr(form_class, 'notModified')
+
+
+@ndb.tasklet
+def cachedFormAsync(view, user_id, form_class, build, suffix='', consistent=True,
+                    etag=None, cache=True):
+    """Get a user's view as a form_class message, building and caching it on a miss.
+
+    build() returns the message or a Future of it. Views built from
+    eventually consistent queries (consistent=False) aren't cached
+    just after a write, while the query may still miss it.
+
+    A form_class with etag and notModified fields gets the view's ETag.
+    When etag, the one the client holds, is still current an empty
+    form_class with notModified set is returned without building or
+    reading the view. cache=False tags a view without caching it.
+    """
+    ctx = ndb.get_context()
+    generation, written = yield (getGenerationAsync(user_id),
+                                 ctx.memcache_get(_writtenKey(user_id)))
+    key = '%s:%s:%s%s' % (view, user_id, generation, suffix)
+    #a view built just after a write might be stale, so it isn't
+    #tagged either, or the client would keep it until the next write
+    current = generation is not None and (consistent or not written)
+    tag = _etag(key) if current and _isConditional(form_class) else None
+    if tag and etag == tag:
+        VIEW_CACHE_STATS[view + 'NotModified'] += 1
+        raise ndb.Return(form_class(etag=tag, notModified=True))
+
+    if cache and generation is not None:
+        value = yield ctx.memcache_get(key)
+        if value is not None:
+            VIEW_CACHE_STATS[view + 'Hits'] += 1
+            form = protobuf.decode_message(form_class, value)
+            if tag:
+                form.etag = tag
+            raise ndb.Return(form)
+
+    VIEW_CACHE_STATS[view + 'Misses'] += 1
+    form = build()
+    if isinstance(form, ndb.Future):
+        form = yield form
+
+    if cache:
+        value = protobuf.encode_message(form)
+        if current and len(value) < memcache.MAX_VALUE_SIZE:
+            yield ctx.memcache_set(key, value, time=VIEW_CACHE_TTL)
+    if tag:
+        form.etag = tag
+    raise ndb.Return(form)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Elastic Republic ndb entity to ProtoRPC form message converters, each
+built once per (model, form) pair at import instead of reflecting over
+the form's fields for every entity
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import operator
+
+from models import BalanceHistory
+from models import BalanceHistoryForm
+from models import Profile
+from models import ProfileForm
+from models import Relation
+from models import RelationForm
+from models import TeeShirtSize
+
+_converters = {}
+
+
+def _converting(getter, convert):
+    """Compose an entity attribute getter with a value conversion."""
+    return lambda entity: convert(getter(entity))
+
+
+def registerConverter(model_class, form_class, conversions=None, extras=None):
+    """Build and register the converter from model_class entities to form_class.
+
+    Form fields named like a model property are copied, through
+    conversions[name] if given; extras[name](entity) fills form fields
+    the model doesn't have. Other form fields are left unset.
+    """
+    conversions = conversions or {}
+    extras = extras or {}
+
+    #work out once which form fields get filled and how
+    plan = []
+    for field in form_class.all_fields():
+        if field.name in extras:
+            plan.append((field.name, extras[field.name]))
+        elif field.name in model_class._properties:
+            getter = operator.attrgetter(field.name)
+            if field.name in conversions:
+                getter = _converting(getter, conversions[field.name])
+            plan.append((field.name, getter))
+    plan = tuple(plan)
+    check = any(field.required for field in form_class.all_fields())
+
+    def convert(entity):
+        form = form_class()
+        for name, getter in plan:
+            setattr(form, name, getter(entity))
+        if check:
+            form.check_initialized()
+        return form
+
+    _converters[model_class, form_class] = convert
+    return convert
+
+
+def converterFor(model_class, form_class):
+    """Return the registered converter for a (model, form) pair."""
+    return _converters[model_class, form_class]
+
+
+def toForm(entity, form_class):
+    """Convert an entity to a form message."""
+    return _converters[type(entity), form_class](entity)
+
+
+def toForms(entities, forms_class):
+    """Convert a list of entities into a multiple form message's items."""
+    item_class = forms_class.field_by_name('items').message_type
+    convert = None
+    items = []
+    for entity in entities:
+        if convert is None:
+            convert = _converters[type(entity), item_class]
+        items.append(convert(entity))
+    return forms_class(items=items)
+
+
+# dates are sent as strings (unset ones as 'None', as they always have been)
+registerConverter(Relation, RelationForm,
+                  conversions={'startDate': str, 'endDate': str},
+                  extras={'websafeKey': lambda rel: rel.key.urlsafe()})
+
+registerConverter(BalanceHistory, BalanceHistoryForm,
+                  conversions={'date': str,
+                               'relationsChangedKeys': lambda keys: [k.urlsafe() for k in keys]})
+
+# t-shirt string to Enum
+registerConverter(Profile, ProfileForm,
+                  conversions={'teeShirtSize': lambda size: getattr(TeeShirtSize, size)})
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""counters.py
+
+Elastic Republic sharded accumulators for values written by many
+requests at once, so no single entity group takes every write
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import datetime
+import random
+
+from google.appengine.ext import ndb
+
+from ledger import NO_SUPPLY
+from models import IncomingFlowShard
+from models import MoneySupplyShard
+
+# shards per representative per day; a folding transaction takes the
+# Profile plus up to 23 shards and a money supply shard, inside the 25
+# entity group limit, as does a batch of relations from one constituent
+# to up to 23 reps
+INCOMING_FLOW_SHARDS = 10
+FOLD_SHARDS_PER_TXN = 23
+REPS_PER_TXN = 23
+
+# the money supply changes with every balance, so it's spread wide
+MONEY_SUPPLY_SHARDS = 20
+
+
+@ndb.tasklet
+def addIncomingFlowAsync(user_id, dailyNetIncomingBFlow, relation_keys):
+    """Add to today's incoming flow for a user on a random shard.
+
+    Call inside the transaction that saves the Relations.
+    """
+    today = datetime.date.today()
+    key = IncomingFlowShard.keyFor(user_id, today,
+                                   random.randint(0, INCOMING_FLOW_SHARDS - 1))
+    shard = yield key.get_async()
+    if shard is None:
+        shard = IncomingFlowShard(key=key, userId=user_id, date=today)
+    shard.DailyNetIncomingBFlow += dailyNetIncomingBFlow
+    shard.relationsChangedKeys.extend(relation_keys)
+    shard.pending = True
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def getPendingFlowShardsAsync(user_id, before=None):
+    """Get a user's shards not yet folded into BalanceHistory.
+
+    Today's shards are read by key so they're strongly consistent;
+    older ones are found by query. With `before`, only shards dated
+    before that day (which no longer change) are returned.
+    """
+    query = IncomingFlowShard.query(IncomingFlowShard.userId == user_id,
+                                    IncomingFlowShard.pending == True)
+    if before is not None:
+        shards = yield query.filter(IncomingFlowShard.date < before).fetch_async()
+        raise ndb.Return(shards)
+
+    today = datetime.date.today()
+    queried, todays = yield (
+        query.fetch_async(),
+        ndb.get_multi_async([IncomingFlowShard.keyFor(user_id, today, i)
+                             for i in range(INCOMING_FLOW_SHARDS)]))
+    shards = dict((s.key, s) for s in queried)
+    shards.update((s.key, s) for s in todays if s and s.pending)
+    raise ndb.Return(shards.values())
+
+
+def withPendingFlows(balance, shards):
+    """Return a Balance with pending shard flows added in memory.
+
+    The Balance must be dated on or after every shard.
+    """
+    for shard in shards:
+        balance = balance.withFlowFrom(shard.date, shard.DailyNetIncomingBFlow)
+    return balance
+
+
+def _moneySupplyKeys():
+    return [ndb.Key(MoneySupplyShard, 'supply|%d' % i) for i in range(MONEY_SUPPLY_SHARDS)]
+
+
+@ndb.tasklet
+def addMoneySupplyAsync(supply):
+    """Add a change in the money supply to a random shard.
+
+    Call inside the transaction that saves the balances it comes from.
+    """
+    if supply == NO_SUPPLY:
+        return
+    key = random.choice(_moneySupplyKeys())
+    shard = yield key.get_async()
+    if shard is None:
+        shard = MoneySupplyShard(key=key)
+    shard.add(supply)
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def getMoneySupplyAsync():
+    """Get the money supply summed over its shards, as a Supply."""
+    shards = yield ndb.get_multi_async(_moneySupplyKeys())
+    supply = NO_SUPPLY
+    for shard in shards:
+        if shard:
+            supply += shard.supply
+    raise ndb.Return(supply)
@@ -12,17 +12,18 @@ __author__ = 'mike.parziale@gmail.com (Michael Parziale)'
 
 
 #from datetime import datetime, date, timedelta
+import collections
 import datetime
-import json
-import os
-import time
+import logging
+import operator
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
-from google.appengine.api import urlfetch
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import Profile
@@ -32,24 +33,121 @@ from models import TeeShirtSize
 from models import Relation
 from models import RelationForm
 from models import RelationForms
+from models import RelationHead
+from models import RelationKeyForm
+from models import RelationPageForms
+from models import RelationQueryForms
+from models import RelationResultForm
+from models import RelationResultForms
 from models import BalanceHistory
 from models import BalanceHistoryForm
 from models import BalanceHistoryForms
+from models import BalanceHistoryPageForm
+from models import BalanceHistoryPageForms
 from models import UserIDForm
+from models import BalanceForm
+from models import MoneySupplyForm
+from models import ProjectionForm
+from models import CacheStatForm
+from models import CacheStatsForm
+from models import ConditionalForm
+from models import MetricStatForm
+from models import EndpointStatForm
+from models import ServerStatsForm
+from models import ServerStatsRequestForm
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import ADMIN_EMAILS
 
 from utils import getUserId
 
+from balances import addTodaysFlowAsync
+from balances import balanceHistorysAsync
+from balances import getBalanceAsync
+from balances import getBalanceHistoryAsync
+from balances import initialBalanceHistory
+from balances import latestBalanceHistorys
+from balances import packedBalanceHistoryPageAsync
+from balances import packedStorage
+from balances import putBalanceHistorysAsync
+from balances import todaysBalanceHistoryAsync
+
+from cache import VIEW_CACHE_STATS
+from cache import bumpGenerationsAsync
+from cache import cachedFormAsync
+
+from converters import converterFor
+from converters import toForm
+from converters import toForms
+
+from counters import REPS_PER_TXN
+from counters import addIncomingFlowAsync
+from counters import addMoneySupplyAsync
+from counters import getMoneySupplyAsync
+from counters import getPendingFlowShardsAsync
+from counters import withPendingFlows
+
+from stats import instrumented
+from stats import serverStats
+from stats import statsJson
+
+from ledger import BASIC_INCOME
+from ledger import MONEY_TAX_RATE
+from ledger import NO_SUPPLY
+from ledger import Supply
+from ledger import projectBalances
+
+from recompute import backdateFlowAsync
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 
-ONE_BALLOT = float(1000000) #one millioon milionths of a Ballot
-MONEY_TAX_RATE = 0.0006849315068493151  #float(1 / 1460) #Daily money tax rate: 1 divided by 1460 days in a term
-BASIC_INCOME = 684.9315068493151  #float(ONE_BALLOT * TAX_RATE) #Daily Universal Basic Income 
+MAX_PAGE_SIZE = 500
+RELATIONS_PAGE_SIZE = 500
+MAX_PROJECTION_DAYS = 4 * 1460
+MAX_RELATIONS_BATCH = 1000
+MAX_BACKDATE_DAYS = 1460
+
+# queryRelations filter fields and operators
+QUERY_FIELDS = {
+    'REP_USER_ID':      'repUserId',
+    'CONSTIT_USER_ID':  'constitUserId',
+    'NAME':             'name',
+    'DAILY_RATE':       'dailyRate',
+    'ACTIVE':           'active',
+}
+QUERY_OPERATORS = {
+    'EQ':   operator.eq,
+    'GT':   operator.gt,
+    'GTEQ': operator.ge,
+    'LT':   operator.lt,
+    'LTEQ': operator.le,
+}
+
+# queryRelations filter combinations, as (properties filtered by
+# equality, whether dailyRate is filtered); each is served by a built-in
+# or index.yaml index, anything else is rejected rather than scanned
+QUERY_INDEXES = frozenset([
+    (frozenset(), False),
+    (frozenset(), True),
+    (frozenset(['active']), False),
+    (frozenset(['active']), True),
+    (frozenset(['constitUserId']), False),
+    (frozenset(['constitUserId']), True),
+    (frozenset(['constitUserId', 'active']), False),
+    (frozenset(['constitUserId', 'active']), True),
+    (frozenset(['repUserId']), False),
+    (frozenset(['repUserId']), True),
+    (frozenset(['repUserId', 'active']), False),
+    (frozenset(['repUserId', 'active']), True),
+    (frozenset(['constitUserId', 'repUserId']), False),
+    (frozenset(['constitUserId', 'repUserId', 'active']), False),
+    (frozenset(['name']), False),
+    (frozenset(['name', 'active']), False),
+])
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -65,30 +163,14 @@ class ElasticRepublicApi(remote.Service):
 # - - - Relation objects - - - - - - - - - - - - - - - - -
 
 
-    def _copyRelationToForm(self, rel):
-        """Copy relevant fields from Conference to ConferenceForm."""
-        rf = RelationForm()
-        for field in rf.all_fields():
-            if hasattr(rel, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(rf, field.name, str(getattr(rel, field.name)))
-                else:
-                    setattr(rf, field.name, getattr(rel, field.name))
-            elif field.name == "websafeKey":
-                setattr(rf, field.name, rel.key.urlsafe())
-            rf.check_initialized()
-        return rf
-
-    def _createRelationObject(self, request):
-        """Create or update Relation object, returning RelationForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        
+    def _relationFromForm(self, request, constit_user_id):
+        """Build a new Relation from a RelationForm, unsaved and without a key."""
         if not request.name:
             raise endpoints.BadRequestException("Relation 'name' field required")
+        if not request.repUserId:
+            raise endpoints.BadRequestException("Relation 'repUserId' field required")
+        if request.dailyRate is None:
+            raise endpoints.BadRequestException("Relation 'dailyRate' field required")
 
         # copy RelationForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -96,99 +178,158 @@ class ElasticRepublicApi(remote.Service):
         del data['constitDisplayName']
         del data['repDisplayName']
 
-        data ['constitUserId'] = cons_user_id = getUserId(user)
+        data ['constitUserId'] = constit_user_id
+
+        if data['constitUserId'] == data['repUserId']:
+            raise endpoints.BadRequestException("Can't create a Relation with yourself")
         
-        # Set startDate to tadoy
-        data['startDate'] = datetime.datetime.today()
+        # Set startDate to tadoy, or the past day it was backdated to
+        start = self._effectiveDate(request.startDate, 'startDate')
+        data['startDate'] = self._effectiveDateTime(start)
             
+        # a one-time transaction is paid on its start day only; otherwise
+        # an endDate schedules the last day paid, ended by relation expiry
         if data['oneTimeTransaction']:
-            data['endDate'] = datetime.datetime.today()
+            data['endDate'] = data['startDate']
+        elif request.endDate:
+            end = self._parseDate(request.endDate, 'endDate')
+            if end < start:
+                raise endpoints.BadRequestException("'endDate' can't be before 'startDate'")
+            data['endDate'] = datetime.datetime.combine(end, datetime.time())
         del data['oneTimeTransaction']
 
-        
-        # allocate new Relation ID 
-        r_id = Relation.allocate_ids(size=1)[0]
-        # make Relation key from ID
-        r_key = ndb.Key(Relation, r_id)
-        data['key'] = r_key
-
         data['version'] = 1
 
-        # create Relation & return (modified) RelationForm
-        rel = Relation(**data)
-        rel.put() #save in Datastore
-          
-        return rel
-
-    def _doRelation(self, request, change_request=None):
-        """Get user Profile and return to user, possibly updating it first."""
-        # get user Profile
-        rel = self._createRelationObject(request)
- 
-        csid = rel.constitUserId
-
-        # get Profile entity from user ID
-        cons_prof = ndb.Key(Profile, csid).get()
-              
-        r_key = rel.key
-        #add this relation entity's key to the profile's active relations keys list
-        cons_prof.activeRelationsKeys.append(r_key)
-
-        cons_prof.put() #save in Datastore
-        
-
-        #add this relation entity's key to the repersentitves's profile's active relations keys list
-        ruid = rel.repUserId
-        
-        repr_key = ndb.Key(Profile, ruid)
-        repr_prof = repr_key.get()
-
-        #If the representitve user is not already a reqistered ERBM user
-        # create new Profile if not there
-        if not repr_prof:
-            
-            bh_key = self._generateInitialBalanceHistory(repr_key)
-
-            repr_prof = Profile(
-                key = repr_key,
-                userId = request.repUserId,
-                displayName = request.repUserId,
-                mainEmail= request.repUserId,
-                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
-                MostRecentBalanceHistoryKey = bh_key,
-            )
-        
-        #add this relation entity's key to the rep profile's active relations keys list
-        repr_prof.activeRelationsKeys.append(r_key)
-        
-        #save rep profile to Datastore
-        repr_prof.put()
+        return Relation(**data)
+
+    def _effectiveDate(self, date_string, field_name):
+        """Parse the day a change takes effect: today, or a recent past day."""
+        today = datetime.date.today()
+        if not date_string:
+            return today
+        date = self._parseDate(date_string, field_name)
+        if date > today:
+            raise endpoints.BadRequestException("'%s' can't be in the future" % field_name)
+        if (today - date).days > MAX_BACKDATE_DAYS:
+            raise endpoints.BadRequestException(
+                "'%s' can be at most %d days ago" % (field_name, MAX_BACKDATE_DAYS))
+        return date
+
+    def _effectiveDateTime(self, date):
+        """The Relation datetime of a change effective on date."""
+        if date == datetime.date.today():
+            return datetime.datetime.today()
+        return datetime.datetime.combine(date, datetime.time())
+
+    def _setRelationId(self, rel, r_id):
+        """Key a new Relation as the first version under its head."""
+        # the head is in the constituent's entity group, which every
+        # change to the Relation writes anyway; ids come from Relation's
+        # so it can't clash with a Relation saved before heads existed
+        head_key = ndb.Key(RelationHead, r_id, parent=ndb.Key(Profile, rel.constitUserId))
+        rel.key = RelationHead.versionKey(head_key, 1)
+
+    @ndb.tasklet
+    def _createRelationObjectAsync(self, request):
+        """Create new Relation object from RelationForm/request, unsaved."""
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
 
-        #Make the constituents BalanceHistory Current
-        cons_today_bh = self._MakeBalanceHistCurrent(cons_prof)
+        rel = self._relationFromForm(request, getUserId(user))
 
-        #Make the representives BalanceHistory Current
-        repr_today_bh = self._MakeBalanceHistCurrent(repr_prof)
-        
-        #adds r_key to today's BalanceHistory relationsChangedKeys
-        #updates today's balance and rate for const and rep
-        self._AddRelationToBalanceHists(rel, cons_today_bh, repr_today_bh)
-
-        # # if saveProfile(), process user-modifyable fields
-        # if change_request:
-        #     for field in ('displayName', 'teeShirtSize'):
-        #         if hasattr(change_request, field):
-        #             val = getattr(change_request, field)
-        #             if val:
-        #                 setattr(rel, field, str(val))
-        #                 #if field == 'teeShirtSize':
-        #                 #    setattr(prof, field, str(val).upper())
-        #                 #else:
-        #                 #    setattr(prof, field, val)
-        #                 rel.put()
+        # allocate new Relation ID 
+        r_id, _ = yield Relation.allocate_ids_async(size=1)
+        self._setRelationId(rel, r_id)
+
+        # create Relation, saved by the caller with the profiles it changes
+        raise ndb.Return(rel)
+
+    @ndb.tasklet
+    def _doRelationAsync(self, request):
+        """Create a Relation and apply it to both profiles and BalanceHistorys."""
+        rel = yield self._createRelationObjectAsync(request)
+
+        cons_key = ndb.Key(Profile, rel.constitUserId)
+        repr_key = ndb.Key(Profile, rel.repUserId)
+
+        @ndb.tasklet
+        def txn():
+            # get both Profile entities and today's BalanceHistory, if
+            # relations already changed today, at the same time
+            (cons_prof, repr_prof), cons_bh = yield (
+                ndb.get_multi_async([cons_key, repr_key]),
+                getBalanceHistoryAsync(cons_key, datetime.date.today()))
+            if not cons_prof:
+                raise endpoints.NotFoundException(
+                    'No profile found for user: %s' % rel.constitUserId)
+
+            head = RelationHead(key=rel.key.parent(), currentKey=rel.key,
+                                currentVersion=rel.version)
+            to_put = [rel, head, cons_prof]
+            bal_hists = []
+            supply = NO_SUPPLY
+            start = rel.startDate.date()
+
+            #If the representitve user is not already a reqistered ERBM user
+            # create new Profile if not there
+            if not repr_prof:
+                repr_prof, repr_bh = self._newProfile(repr_key, rel.repUserId,
+                                                      rel.repUserId, rel.repUserId)
+                to_put.append(repr_prof)
+                bal_hists.append(repr_bh)
+                supply += Supply.ofBalance(repr_bh.balance)
+
+            if start < datetime.date.today():
+                #a backdated Relation changes both balances from its start;
+                #their BalanceHistorys catch up from the task queue
+                changes = yield (
+                    backdateFlowAsync(cons_prof, -rel.dailyRate, start, [rel.key]),
+                    backdateFlowAsync(repr_prof, rel.dailyRate, start, [rel.key]))
+                supply += changes[0] + changes[1]
+                if repr_prof not in to_put:
+                    to_put.append(repr_prof)
+            else:
+                #start today's BalanceHistory from the profile's balance if
+                #this is its first relation change today
+                if not cons_bh:
+                    cons_bh = yield todaysBalanceHistoryAsync(cons_prof)
+
+                #adds r_key to today's BalanceHistory relationsChangedKeys
+                #Subtract for constituent
+                self._AddRelationToBalanceHist(rel, cons_bh, -rel.dailyRate)
+
+                #and from the profile's materialized balance by as much
+                supply += yield addTodaysFlowAsync(cons_prof, -rel.dailyRate)
+                cons_prof.MostRecentBalanceHistoryKey = cons_bh.key
+                bal_hists.append(cons_bh)
+
+                #Add for Representive, on a shard so many constituents can pick
+                #the same representative at once; folded in at settlement
+                yield addIncomingFlowAsync(rel.repUserId, rel.dailyRate, [rel.key])
+                supply += Supply.ofFlow(start, rel.dailyRate)
+
+            #the money supply only changes by a new profile's ballot
+            yield addMoneySupplyAsync(supply)
+
+            #save everything at once
+            yield ndb.put_multi_async(to_put), putBalanceHistorysAsync(bal_hists)
+
+        # Relation, Profiles, BalanceHistorys and the shards commit together
+        yield ndb.transaction_async(txn, xg=True)
+
+        # then both users' cached views are dropped
+        yield bumpGenerationsAsync([rel.constitUserId, rel.repUserId])
+
+        raise ndb.Return(rel)
+
+    def _doRelation(self, request):
+        """Create a Relation and return RelationForm."""
+        rel = self._doRelationAsync(request).get_result()
 
         # return RelationForm
-        return self._copyRelationToForm(rel)
+        return toForm(rel, RelationForm)
 
 
     @endpoints.method(RelationForm, RelationForm, 
@@ -200,15 +341,160 @@ class ElasticRepublicApi(remote.Service):
 
     #The second argument is request, which is an argument of the wrapping endpoints methhod, 
     #the first endpoints method argumrnt which in this case is of RelationForm Class model
+    @instrumented
     def createRelation(self, request): #self is each instance of the ElasticRepublic API on the server
         """Create new relation."""
         return self._doRelation(request)#Return the _doRelation method running on this instance of ER API
 
 
+    @ndb.tasklet
+    def _insertProfileAsync(self, p_key, user_id, display_name=None, email=None):
+        """Get a Profile, creating it if there isn't one; names default to user_id."""
+        @ndb.tasklet
+        def txn():
+            profile = yield p_key.get_async()
+            if not profile:
+                profile, bal_hist = self._newProfile(p_key, user_id,
+                                                     display_name or user_id,
+                                                     email or user_id)
+                yield (profile.put_async(), putBalanceHistorysAsync([bal_hist]),
+                       addMoneySupplyAsync(Supply.ofBalance(bal_hist.balance)))
+            raise ndb.Return(profile)
+        # the Profile and its share of the money supply commit together
+        profile = yield ndb.transaction_async(txn, xg=True)
+        raise ndb.Return(profile)
+
+    @ndb.tasklet
+    def _commitRelationsAsync(self, cons_key, rels):
+        """Apply a chunk of one constituent's new Relations in one transaction."""
+        #one shard write per representative, for all of their relations
+        rep_flows = collections.OrderedDict()
+        for rel in rels:
+            flow, keys = rep_flows.get(rel.repUserId, (0, []))
+            rep_flows[rel.repUserId] = (flow + rel.dailyRate, keys + [rel.key])
+
+        @ndb.tasklet
+        def txn():
+            cons_prof, cons_bh = yield (cons_key.get_async(),
+                                        getBalanceHistoryAsync(cons_key, datetime.date.today()))
+            if not cons_bh:
+                cons_bh = yield todaysBalanceHistoryAsync(cons_prof)
+
+            #Relations, heads and the constituent share an entity group
+            to_put = [cons_prof]
+            for rel in rels:
+                to_put.append(rel)
+                to_put.append(RelationHead(key=rel.key.parent(), currentKey=rel.key,
+                                           currentVersion=rel.version))
+                self._AddRelationToBalanceHist(rel, cons_bh, -rel.dailyRate)
+            supply = yield addTodaysFlowAsync(cons_prof, -sum(r.dailyRate for r in rels))
+            cons_prof.MostRecentBalanceHistoryKey = cons_bh.key
+            for flow, _ in rep_flows.values():
+                supply += Supply.ofFlow(cons_bh.date, flow)
+
+            yield [addIncomingFlowAsync(rep, flow, keys)
+                   for rep, (flow, keys) in rep_flows.items()] + \
+                  [addMoneySupplyAsync(supply)]
+            yield ndb.put_multi_async(to_put), putBalanceHistorysAsync([cons_bh])
+
+        yield ndb.transaction_async(txn, xg=True)
+
+    def _relationChunks(self, rels):
+        """Split Relations into chunks with at most REPS_PER_TXN representatives each."""
+        chunk, reps = [], set()
+        for rel in rels:
+            if rel.repUserId not in reps and len(reps) == REPS_PER_TXN:
+                yield chunk
+                chunk, reps = [], set()
+            chunk.append(rel)
+            reps.add(rel.repUserId)
+        if chunk:
+            yield chunk
+
+    def _doRelations(self, request):
+        """Create a batch of the user's Relations and return a result per item."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if len(request.items) > MAX_RELATIONS_BATCH:
+            raise endpoints.BadRequestException(
+                'At most %d relations per batch' % MAX_RELATIONS_BATCH)
+        cons_id = getUserId(user)
+        cons_key = ndb.Key(Profile, cons_id)
+        results = [RelationResultForm() for _ in request.items]
+
+        # bad items are reported, the rest go ahead
+        rels = collections.OrderedDict()
+        for i, item in enumerate(request.items):
+            try:
+                rels[i] = self._relationFromForm(item, cons_id)
+                if rels[i].startDate.date() < datetime.date.today():
+                    del rels[i]
+                    raise endpoints.BadRequestException(
+                        'Backdated relations are created one at a time')
+            except endpoints.BadRequestException as e:
+                results[i].error = str(e)
+        if not rels:
+            return RelationResultForms(items=results)
+
+        # one id allocation and one load of every profile in the batch
+        first_id, _ = Relation.allocate_ids(size=len(rels))
+        for r_id, rel in enumerate(rels.values(), first_id):
+            self._setRelationId(rel, r_id)
+        rep_ids = list(collections.OrderedDict.fromkeys(r.repUserId for r in rels.values()))
+        profiles = ndb.get_multi([cons_key] + [ndb.Key(Profile, r) for r in rep_ids])
+        if not profiles[0]:
+            raise endpoints.NotFoundException('No profile found for user: %s' % cons_id)
+
+        #representatives who aren't users yet get a Profile first
+        inserts = dict((rep_id, self._insertProfileAsync(ndb.Key(Profile, rep_id), rep_id))
+                       for rep_id, profile in zip(rep_ids, profiles[1:]) if not profile)
+        failed_reps = set()
+        for rep_id, insert in inserts.items():
+            try:
+                insert.get_result()
+            except datastore_errors.Error as e:
+                failed_reps.add(rep_id)
+                logging.warning('Could not create profile for %s: %s', rep_id, e)
+
+        index = dict((rel.key, i) for i, rel in rels.items())
+        committed, reps = [], set()
+        for chunk in self._relationChunks([r for r in rels.values()
+                                           if r.repUserId not in failed_reps]):
+            try:
+                self._commitRelationsAsync(cons_key, chunk).get_result()
+            except datastore_errors.Error as e:
+                for rel in chunk:
+                    results[index[rel.key]].error = 'Not saved: %s' % e
+                continue
+            committed.extend(chunk)
+            reps.update(rel.repUserId for rel in chunk)
+        for rel in rels.values():
+            if rel.repUserId in failed_reps:
+                results[index[rel.key]].error = "Could not create representative's profile"
+
+        bumpGenerationsAsync([cons_id] + list(reps)).get_result()
+        for rel in committed:
+            results[index[rel.key]].relation = toForm(rel, RelationForm)
+        self._fillDisplayNamesAsync([r.relation for r in results if r.relation]).get_result()
+        return RelationResultForms(items=results)
+
+
+    @endpoints.method(RelationForms, RelationResultForms,
+                path='relations',
+                http_method='POST',
+                name='createRelations')
+    @instrumented
+    def createRelations(self, request):
+        """Create a batch of new relations, reporting errors per item."""
+        return self._doRelations(request)
+
+
     @endpoints.method(UserIDForm, RelationForms,
                 path='getUsersActiveRelations',
                 http_method='POST',
                 name='getUsersActiveRelations')
+    @instrumented
     def getUsersActiveRelations(self, request):
         """Query for a given users active relations."""
 
@@ -220,159 +506,347 @@ class ElasticRepublicApi(remote.Service):
         #get passed in user id
         user_id = request.userId 
 
-        #get profile entity of user from Datastore
-        prof = ndb.Key(Profile, user_id).get() 
-
-        #if the userId is not in the system
-        if not prof: 
-
-            #return blank
-            return RelationForms()
-
-        #if the the userId is in the system
-        else: 
+        # the RelationForms are cached until the user's relations change,
+        # and not sent again while the client's etag is current
+        forms = cachedFormAsync('relations', user_id, RelationForms,
+                                lambda: self._getActiveRelationFormsAsync(user_id),
+                                consistent=False, etag=request.etag).get_result()
+        if forms.notModified:
+            return forms
+
+        # names are joined after the cache read, so a renamed user shows
+        # up in everyone's lists at once; a rename also changes their etags
+        self._fillDisplayNamesAsync(forms.items).get_result()
+        return forms
+
+    @ndb.tasklet
+    def _fillDisplayNamesAsync(self, rel_forms):
+        """Fill RelationForms' display names from their users' Profiles, in one batch."""
+        user_ids = set()
+        for form in rel_forms:
+            user_ids.update((form.constitUserId, form.repUserId))
+        user_ids.discard(None)
+        user_ids = list(user_ids)
+
+        # ndb serves hot Profiles from memcache and gets the rest together
+        profiles = yield ndb.get_multi_async([ndb.Key(Profile, u) for u in user_ids])
+        names = dict((u, p.displayName) for u, p in zip(user_ids, profiles) if p)
+        for form in rel_forms:
+            form.constitDisplayName = names.get(form.constitUserId)
+            form.repDisplayName = names.get(form.repUserId)
+
+    @ndb.tasklet
+    def _getActiveRelationFormsAsync(self, user_id):
+        """Get a user's active Relations as RelationForms."""
+        #get user's active relations entities from Datastore,
+        #as constituent and as representative at the same time
+        as_constit, as_rep = yield (
+            self._getActiveRelationsAsync(Relation.constitUserId, user_id),
+            self._getActiveRelationsAsync(Relation.repUserId, user_id))
+
+        # return individual RelationForm object per Relation
+        raise ndb.Return(toForms(as_constit + as_rep, RelationForms))
+
+    @ndb.tasklet
+    def _getActiveRelationsAsync(self, user_prop, user_id):
+        """Get the active Relations with user_id in user_prop."""
+        query = Relation.query(user_prop == user_id, Relation.active == True)
+
+        #page through the keys, getting each page's entities in a batch
+        #while the next page of keys is fetched
+        gets = []
+        cursor, more = None, True
+        while more:
+            keys, cursor, more = yield query.fetch_page_async(
+                RELATIONS_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+            gets.append(ndb.get_multi_async(keys))
+            more = more and cursor is not None
+
+        relations = []
+        for page in gets:
+            page_relations = yield page
+            relations.extend(r for r in page_relations if r)
+        raise ndb.Return(relations)
+
+
+    @endpoints.method(RelationQueryForms, RelationPageForms,
+                path='queryRelations',
+                http_method='POST',
+                name='queryRelations')
+    @instrumented
+    def queryRelations(self, request):
+        """Query relations by field filters, a page at a time."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if not 0 < request.pageSize <= MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be between 1 and %d" % MAX_PAGE_SIZE)
+
+        query, checks = self._relationQuery(request.filters)
+        return self._relationPageAsync(query, checks, request.pageSize,
+                                       self._parseCursor(request.websafeCursor)).get_result()
+
+    def _relationQuery(self, filters):
+        """Build a Relation query from RelationQueryForm filters.
+
+        Returns the query and its filters as (property name, operator,
+        value) checks. Combinations not in QUERY_INDEXES are rejected.
+        """
+        query = Relation.query()
+        equalities, by_rate, checks = set(), False, []
+        for f in filters:
+            name = QUERY_FIELDS.get(f.field)
+            op = QUERY_OPERATORS.get(f.operator)
+            if not name:
+                raise endpoints.BadRequestException("Unknown filter field '%s'" % f.field)
+            if not op:
+                raise endpoints.BadRequestException("Unknown filter operator '%s'" % f.operator)
+            value = self._filterValue(f.field, name, f.value)
+
+            if name == 'dailyRate':
+                by_rate = True
+            elif op is not operator.eq:
+                raise endpoints.BadRequestException('Only DAILY_RATE can be filtered by range')
+            elif name in equalities:
+                raise endpoints.BadRequestException("'%s' can only be filtered once" % f.field)
+            else:
+                equalities.add(name)
+            query = query.filter(op(getattr(Relation, name), value))
+            checks.append((name, op, value))
+
+        if (frozenset(equalities), by_rate) not in QUERY_INDEXES:
+            raise endpoints.BadRequestException('Relations can\'t be filtered by %s together'
+                % ', '.join(f.field for f in filters))
+
+        # a cursor needs a stable order; a dailyRate range sorts by it first
+        if by_rate:
+            return query.order(Relation.dailyRate, Relation.key), checks
+        return query.order(Relation.key), checks
+
+    def _filterValue(self, field, name, value):
+        """Convert a filter's string value to its property's type."""
+        if name == 'dailyRate':
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                raise endpoints.BadRequestException("'%s' filter value must be a whole number" % field)
+        if name == 'active':
+            if value in ('true', 'True', '1'):
+                return True
+            if value in ('false', 'False', '0'):
+                return False
+            raise endpoints.BadRequestException("'%s' filter value must be true or false" % field)
+        if not value:
+            raise endpoints.BadRequestException("'%s' filter value required" % field)
+        return value
+
+    @ndb.tasklet
+    def _relationPageAsync(self, query, checks, page_size, cursor):
+        """Get a page of a Relation query as RelationForms: keys, then entities in a batch."""
+        keys, next_cursor, more = yield query.fetch_page_async(
+            page_size, start_cursor=cursor, keys_only=True)
+        relations = yield ndb.get_multi_async(keys)
+
+        # indexes lag their entities, so rows that stopped matching are dropped
+        relations = [r for r in relations
+                     if r and all(op(getattr(r, name), value) for name, op, value in checks)]
+        forms = toForms(relations, RelationPageForms)
+        yield self._fillDisplayNamesAsync(forms.items)
+        forms.more = bool(more and next_cursor)
+        forms.nextCursor = next_cursor.urlsafe() if forms.more else None
+        raise ndb.Return(forms)
+
+
+    def _parseRelationKey(self, websafe_key):
+        """Parse a Relation or RelationHead websafeKey."""
+        try:
+            key = ndb.Key(urlsafe=websafe_key)
+        except Exception:
+            raise endpoints.BadRequestException("Invalid 'websafeKey'")
+        if key.kind() not in (Relation._get_kind(), RelationHead._get_kind()):
+            raise endpoints.BadRequestException("'websafeKey' is not a Relation")
+        return key
+
+    @ndb.tasklet
+    def _changeRelationAsync(self, websafe_key, dailyRate=0, contract=None, effective=None):
+        """Replace a Relation's current version with a new one, or end it when dailyRate is 0.
+
+        The change takes effect today, or on a past effective date.
+        """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
 
-            #get user's active relations keys
-            rel_keys = prof.activeRelationsKeys 
+        key = self._parseRelationKey(websafe_key)
+        head_key = key if key.kind() == RelationHead._get_kind() else RelationHead.keyOf(key)
+        today = datetime.date.today()
+        effective = effective or today
+
+        @ndb.tasklet
+        def txn():
+            # the head names the current version in one get; Relations
+            # saved before heads existed are their own current version
+            head = yield head_key.get_async()
+            current_key = head.currentKey if head else ndb.Key(Relation, head_key.id())
+            current = yield current_key.get_async()
+            if not current:
+                raise endpoints.NotFoundException('No relation found with key: %s' % websafe_key)
+            if not current.active:
+                raise endpoints.BadRequestException('Relation has already ended')
+            if user_id not in (current.constitUserId, current.repUserId):
+                raise endpoints.ForbiddenException('Only the Relation\'s users can change it')
+            if dailyRate and user_id != current.constitUserId:
+                raise endpoints.ForbiddenException('Only the constituent can change the daily rate')
+            if current.startDate and effective < current.startDate.date():
+                raise endpoints.BadRequestException(
+                    'The change must take effect on or after %s' % current.startDate.date())
+
+            cons_key = ndb.Key(Profile, current.constitUserId)
+            repr_key = ndb.Key(Profile, current.repUserId)
+            cons_bh = None
+            if effective < today:
+                cons_prof, repr_prof = yield ndb.get_multi_async([cons_key, repr_key])
+            else:
+                cons_prof, cons_bh = yield (cons_key.get_async(),
+                                            getBalanceHistoryAsync(cons_key, today))
+                if not cons_bh:
+                    cons_bh = yield todaysBalanceHistoryAsync(cons_prof)
+
+            # the current version's last day paid is the one before the
+            # effective day, when a new one starts; a scheduled end still
+            # applies to the new one
+            scheduled_end = current.endDate
+            current.endDate = datetime.datetime.combine(
+                effective - datetime.timedelta(days=1), datetime.time())
+            current.active = False
+            changed, to_put = current, [current]
+            if dailyRate:
+                version = (current.version or 1) + 1
+                changed = Relation(
+                    key           = RelationHead.versionKey(head_key, version),
+                    name          = current.name,
+                    dailyRate     = dailyRate,
+                    contract      = current.contract if contract is None else contract,
+                    constitUserId = current.constitUserId,
+                    repUserId     = current.repUserId,
+                    startDate     = self._effectiveDateTime(effective),
+                    endDate       = scheduled_end,
+                    version       = version)
+                to_put.append(changed)
+            head = head or RelationHead(key=head_key)
+            head.currentKey, head.currentVersion = changed.key, changed.version
+            to_put.append(head)
+            flow = dailyRate - current.dailyRate
+
+            if cons_bh is None:
+                #backdated: both balances change from the effective day, and
+                #their BalanceHistorys catch up from the task queue
+                if flow:
+                    changes = yield (
+                        backdateFlowAsync(cons_prof, -flow, effective, [changed.key]),
+                        backdateFlowAsync(repr_prof, flow, effective, [changed.key]))
+                    to_put.append(repr_prof)
+                    yield addMoneySupplyAsync(changes[0] + changes[1])
+            else:
+                #the constituent pays the new rate from today
+                self._ChangeRelationInBalanceHist(current.key, changed, cons_bh, -flow)
+                supply = Supply.ofFlow(today, flow)
+                supply += yield addTodaysFlowAsync(cons_prof, -flow)
+                cons_prof.MostRecentBalanceHistoryKey = cons_bh.key
+
+                #and the representative's incoming flow changes by as much
+                if flow:
+                    yield (addIncomingFlowAsync(current.repUserId, flow, [changed.key]),
+                           addMoneySupplyAsync(supply))
+
+            #profiles saved before Relation.active still list their relations
+            if current.key in cons_prof.activeRelationsKeys:
+                cons_prof.activeRelationsKeys.remove(current.key)
+                if changed.active:
+                    cons_prof.activeRelationsKeys.append(changed.key)
+            to_put.append(cons_prof)
+
+            #save every version, head, profile and BalanceHistory at once
+            yield ndb.put_multi_async(to_put), putBalanceHistorysAsync([cons_bh] if cons_bh else [])
+            raise ndb.Return(changed)
+
+        rel = yield ndb.transaction_async(txn, xg=True)
+        yield bumpGenerationsAsync([rel.constitUserId, rel.repUserId])
+        raise ndb.Return(rel)
+
+
+    @endpoints.method(RelationForm, RelationForm,
+                path='relation/update',
+                http_method='POST',
+                name='updateRelation')
+    @instrumented
+    def updateRelation(self, request):
+        """Change a relation's daily rate or contract as a new version, from today or startDate."""
+        if not request.websafeKey:
+            raise endpoints.BadRequestException("Relation 'websafeKey' field required")
+        if request.dailyRate is None or request.dailyRate < 0:
+            raise endpoints.BadRequestException("Relation 'dailyRate' field required")
+        effective = self._effectiveDate(request.startDate, 'startDate')
+        rel = self._changeRelationAsync(request.websafeKey, request.dailyRate,
+                                        request.contract, effective).get_result()
+        return toForm(rel, RelationForm)
+
+
+    @endpoints.method(RelationKeyForm, RelationForm,
+                path='relation/end',
+                http_method='POST',
+                name='endRelation')
+    @instrumented
+    def endRelation(self, request):
+        """End a relation today, or after endDate, its last day paid."""
+        effective = datetime.date.today()
+        if request.endDate:
+            # the day after the last one paid is the day it ends
+            last_day = self._parseDate(request.endDate, 'endDate')
+            if last_day >= effective:
+                raise endpoints.BadRequestException("'endDate' must be before today")
+            effective = self._effectiveDate(
+                str(last_day + datetime.timedelta(days=1)), 'endDate')
+        rel = self._changeRelationAsync(request.websafeKey, effective=effective).get_result()
+        return toForm(rel, RelationForm)
+
+
+    @endpoints.method(RelationKeyForm, RelationForms,
+                path='relation/versions',
+                http_method='POST',
+                name='getRelationVersions')
+    @instrumented
+    def getRelationVersions(self, request):
+        """Return every version of a relation, oldest first."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
 
-            #get user's active relations entities from Datastore
-            relations = ndb.get_multi(rel_keys) 
+        key = self._parseRelationKey(request.websafeKey)
+        head_key = key if key.kind() == RelationHead._get_kind() else RelationHead.keyOf(key)
 
-            # return individual RelationForm object per Relation
-            return RelationForms(
-                items=[self._copyRelationToForm(rela) \
-                for rela in relations]
-            )
+        # versions are one level under the head, plus a first version
+        # saved before heads existed
+        versions = Relation.query(ancestor=head_key).order(Relation.version).fetch_async()
+        legacy = ndb.Key(Relation, head_key.id()).get_async()
+        versions = versions.get_result()
+        if legacy.get_result():
+            versions.insert(0, legacy.get_result())
+        forms = toForms(versions, RelationForms)
+        self._fillDisplayNamesAsync(forms.items).get_result()
+        return forms
 
 
 # - - - Balance History objects - - - - - - - - - - - - - - - - - - -
 
 
-    def _generateInitialBalanceHistory(self, profile_key):
-        """Generate an Initial BalanceHistory."""
-        
-        #get today's date into memory
-        todays_date = datetime.date.today()
-        #create date in string format for key id 
-        date_string = todays_date.isoformat()
-
-        # #Generate BalanceHistory ID based on Profile key as ansestor
-        # bh_id = BalanceHistory.allocate_ids(size=1, parent=profile_key)[0]
-        
-        #get BalanceHistory key from ID
-        bh_key = ndb.Key(BalanceHistory, date_string, parent=profile_key)
-             
-        #add initial BalanceHistory entity
-        bal_hist = BalanceHistory(
-                key                  = bh_key,
-                date                 = todays_date,
-                eodBalance           = ONE_BALLOT, 
-                DailyNetIncomingBFlow= 0,
-        )
-
-        #save users BalanceHistory entity to Datastore
-        bal_hist.put() 
-
-        return bh_key
-
-
-    def _MakeBalanceHistCurrent(self, profile):
-        """Make a profiles BalanceHistory current."""
-        # Makes BalanceHistory current up to today
-        # Prosesses UBI and money tax for each day
-        # Assumes no Relation changes since last run
-
-        # #query BalanceHistory ordered by datetime
-        # q = BalanceHistory.all()
-        # q.filter('__key__ >', last_seen_key)
-        
-        #read profile's last most recent Balance History key
-        bh_key = profile.MostRecentBalanceHistoryKey
-        #get mrbh object
-        bal_hist = bh_key.get(use_cache=False, use_memcache=False)
-        #get most recent BalanceHistory Date for User (mrbh_date)
-        bh_date = bal_hist.date
-        #put today's date into memory
-        todays_date = datetime.date.today()  
-        #put one day into memory
-        one_day = datetime.timedelta(days=1)
-        #read profile's mrbh end of day balance into memory
-        bh_eodBalance = bal_hist.eodBalance
-        #read profile's mrbh Daily Net Incoming Balllot Flow to memory
-        bh_DailyNetIncomingBFlow = bal_hist.DailyNetIncomingBFlow
-
-        #while date is less than and not equal to today
-        while bh_date < todays_date:
-            #Since this is programatically run prior to changing relations 
-            #BalHist is always current up until previous day.
-            #Today is not finalized until tomorrow.
-
-            # relations_changed_this_day = mrbh.relationsChangedKeys != []
-
-            # if relations_changed_this_day:
-            #     raise endpoints.ForbiddenException(
-            #         'Error: Make Current Failed. Todays Relation Changes wernt saves to Balance History')
-            
-            #create date in string format for key id 
-            date_string = bh_date.isoformat() #This is weird, shoudn't it be after the increment below???
-
-            #Increment date to next day so we can add a Balance History for that day
-            bh_date += one_day
-            
-            # #Generate BalanceHistory ID based on most recent BH key as ansestor
-            # bh_id = BalanceHistory.allocate_ids(size=1, parent=mrbh_key)[0]
-            
-            #Generate new BalanceHistory key from date string ID
-            #use this key for next iteration
-            bh_key = ndb.Key(BalanceHistory, date_string, parent=bh_key)
-            
-            #calculate the end of day balance
-                            #yesterday's end of day balance
-                            #\minus yesterday's tax
-                            #\plus today's basic income
-                            #\plus today's net incomeing ballotflow 
-                            #(that's the same as yesterday's since no relations changed)
-            bh_eodBalance = bh_eodBalance \
-                          - (bh_eodBalance * MONEY_TAX_RATE) \
-                          + BASIC_INCOME \
-                          + bh_DailyNetIncomingBFlow 
-                                   
-            #Add BalanceHistory Entity
-            bal_hist = BalanceHistory(
-                key                   = bh_key,
-                date                  = bh_date,
-                eodBalance            = bh_eodBalance,
-                DailyNetIncomingBFlow = bh_DailyNetIncomingBFlow,
-                #relationsChangedKeys  = mrbh.relationsChangedKeys,
-            )
-            #save BalanceHistory entity to Datastore
-            bal_hist.put() 
-
-        return bal_hist
-
-    def _copyBalanceHistoryToForm(self, bal_hist):
-        """Copy all fields from BalanceHistory to BalanceHistoryForm."""
-        bhf = BalanceHistoryForm()
-        for field in bhf.all_fields():
-            if hasattr(bal_hist, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('date'):
-                    setattr(bhf, field.name, str(getattr(bal_hist, field.name)))
-                elif field.name == "relationsChangedKeys":            
-                    web_safe_keys = []
-                    for key in getattr(bal_hist, 'relationsChangedKeys'):
-                        web_safe_keys.append(key.urlsafe())
-                    setattr(bhf, field.name, web_safe_keys)
-                else:
-                    setattr(bhf, field.name, getattr(bal_hist, field.name))
-        bhf.check_initialized()
-        return bhf
-
-
-    @endpoints.method(message_types.VoidMessage, BalanceHistoryForms,
+    @endpoints.method(ConditionalForm, BalanceHistoryForms,
                 path='getBalanceHistorysCreated',
                 http_method='POST', 
                 name='getBalanceHistorysCreated')
+    @instrumented
     def getBalanceHistorysCreated(self, request):
         """Return BalanceHistorys created by user."""
         # make sure user is authed
@@ -383,76 +857,163 @@ class ElasticRepublicApi(remote.Service):
         
         user_id = getUserId(user)
 
-        # create ancestor query for all key matches for this user
-        balhists = BalanceHistory.query(ancestor=ndb.Key(Profile, user_id))
-        
-        #prof = ndb.Key(Profile, user_id).get()
-        
+        # all of this user's BalanceHistorys, however they're stored;
+        # too big to cache, but not read again while the client's etag
+        # is current
+        return cachedFormAsync('history', user_id, BalanceHistoryForms,
+                               lambda: self._getBalanceHistoryFormsAsync(user_id),
+                               etag=request.etag, cache=False).get_result()
+
+    @ndb.tasklet
+    def _getBalanceHistoryFormsAsync(self, user_id):
+        """Get all of a user's BalanceHistorys as BalanceHistoryForms."""
+        balhists = yield balanceHistorysAsync(ndb.Key(Profile, user_id))
+
         # return set of BalanceHistoryForm objects per BalanceHistory
-        return BalanceHistoryForms(
-            items=[self._copyBalanceHistoryToForm(balhist) for balhist in balhists]
+        raise ndb.Return(toForms(balhists, BalanceHistoryForms))
+
+
+    def _parseDate(self, date_string, field_name):
+        """Parse an ISO date string from a request field."""
+        try:
+            return datetime.datetime.strptime(date_string, '%Y-%m-%d').date()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "'%s' must be an ISO date (YYYY-MM-DD)" % field_name)
+
+    def _parseCursor(self, websafe_cursor):
+        """Parse a web-safe query cursor, None when not given."""
+        if not websafe_cursor:
+            return None
+        try:
+            return Cursor(urlsafe=websafe_cursor)
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid 'websafeCursor'")
+
+    def _copyBalanceHistorySummaryToForm(self, bal_hist):
+        """Copy projected date and eodBalance to BalanceHistoryForm."""
+        return BalanceHistoryForm(
+            date       = str(bal_hist.date),
+            eodBalance = bal_hist.eodBalance,
         )
 
-                
-    def _AddRelationToBalanceHists(self, relation, const_bh, rep_bh):
-        """Add a Relation to a profiles BalanceHistory."""
-        #adds the new or changed Relation key to today's BalanceHistory for the profile as passed
-        #Updates the DailyNetIncomingBFlow and eodBalance
-        #Makecurrent was run first to return today's bh key
-        #today's BH
-
-        relation_key = relation.key
 
-        relation_dailyRate = relation.dailyRate
+    @endpoints.method(BalanceHistoryPageForm, BalanceHistoryPageForms,
+                path='getBalanceHistoryPage',
+                http_method='POST',
+                name='getBalanceHistoryPage')
+    @instrumented
+    def getBalanceHistoryPage(self, request):
+        """Return one page of the user's BalanceHistorys, oldest first."""
+        # make sure user is authed
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
 
-        relation_dailyRate = relation.dailyRate
+        if not 0 < request.pageSize <= MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be between 1 and %d" % MAX_PAGE_SIZE)
 
-        #Append the relation key to todays balance history
-        const_bh.relationsChangedKeys.append(relation_key)
+        user_id = getUserId(user)
+        p_key = ndb.Key(Profile, user_id)
 
-        #Adjust the day's daily rate to include the new relation
-        #Subtract for constituent
-        const_bh.DailyNetIncomingBFlow -= relation_dailyRate
+        start_date = end_date = None
+        if request.startDate:
+            start_date = self._parseDate(request.startDate, 'startDate')
+        if request.endDate:
+            end_date = self._parseDate(request.endDate, 'endDate')
 
-        #Begin Relation today by counting the daily rate towards today's balance
-        #Subtract for constituent
-        const_bh.eodBalance -= relation_dailyRate
+        if request.summary:
+            copy_to_form = self._copyBalanceHistorySummaryToForm
+        else:
+            copy_to_form = converterFor(BalanceHistory, BalanceHistoryForm)
+
+        # monthly blocks are paged by date, the cursor is the next page's
+        if packedStorage():
+            if request.websafeCursor:
+                start_date = self._parseDate(request.websafeCursor, 'websafeCursor')
+            page, next_date = packedBalanceHistoryPageAsync(
+                p_key, request.pageSize, start_date, end_date).get_result()
+            return BalanceHistoryPageForms(
+                items=[copy_to_form(balhist) for balhist in page],
+                nextCursor=str(next_date) if next_date else None,
+                more=next_date is not None,
+            )
 
-        #save const profile to Datastore
-        const_bh.put()
+        # ancestor query over this user's BalanceHistorys in date order
+        balhists = BalanceHistory.query(ancestor=p_key)
+        if start_date:
+            balhists = balhists.filter(BalanceHistory.date >= start_date)
+        if end_date:
+            balhists = balhists.filter(BalanceHistory.date <= end_date)
+        balhists = balhists.order(BalanceHistory.date)
+
+        # summary mode only reads date and eodBalance from the index
+        if request.summary:
+            projection = [BalanceHistory.date, BalanceHistory.eodBalance]
+        else:
+            projection = None
+
+        page, next_cursor, more = balhists.fetch_page_async(
+            request.pageSize,
+            start_cursor=self._parseCursor(request.websafeCursor),
+            projection=projection).get_result()
+
+        # return page of BalanceHistoryForm objects and where to continue
+        return BalanceHistoryPageForms(
+            items=[copy_to_form(balhist) \
+            for balhist in latestBalanceHistorys(page)],
+            nextCursor=next_cursor.urlsafe() if more and next_cursor else None,
+            more=more,
+        )
 
+                
+    def _AddRelationToBalanceHist(self, relation, bal_hist, dailyRate):
+        """Add a Relation to a profiles BalanceHistory."""
+        #adds the new or changed Relation key to today's BalanceHistory for the profile as passed
+        #Updates the DailyNetIncomingBFlow and eodBalance
+        #today's BH, saved by the caller
 
         #Append the relation key to todays balance history
-        rep_bh.relationsChangedKeys.append(relation.key)
+        bal_hist.relationsChangedKeys.append(relation.key)
 
         #Adjust the day's daily rate to include the new relation
-        #Add for Representive
-        rep_bh.DailyNetIncomingBFlow += relation.dailyRate
+        bal_hist.DailyNetIncomingBFlow += dailyRate
 
         #Begin Relation today by counting the daily rate towards today's balance
-        #Add for Representive
-        rep_bh.eodBalance += relation.dailyRate
+        bal_hist.eodBalance += dailyRate
 
-        #save const profile to Datastore
-        rep_bh.put()
+    def _ChangeRelationInBalanceHist(self, old_key, relation, bal_hist, dailyRate):
+        """Swap a Relation's new version into a profiles BalanceHistory."""
+        #a version already changed today is replaced by the new one
+        keys = bal_hist.relationsChangedKeys
+        if old_key in keys:
+            keys[keys.index(old_key)] = relation.key
+        elif relation.key not in keys:
+            keys.append(relation.key)
 
-        return 
+        #Adjust the day's daily rate and balance by the change
+        bal_hist.DailyNetIncomingBFlow += dailyRate
+        bal_hist.eodBalance += dailyRate
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyProfileToForm(self, prof):
-        """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from ndb Profile to endpoints ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+    def _newProfile(self, p_key, user_id, display_name, email):
+        """Build a new Profile with its initial balance, unsaved."""
+        #generate initial BalanceHistory 
+        bal_hist = initialBalanceHistory(p_key)
+
+        #pupulate new ndb Profile entity
+        profile = Profile(
+            key = p_key,
+            userId = user_id,
+            displayName = display_name,
+            mainEmail= email,
+            teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
+            MostRecentBalanceHistoryKey = bal_hist.key,
+        )
+        profile.setBalanceSnapshot(bal_hist.balance)
+        return profile, bal_hist
 
 
     def _getProfileFromUser(self):
@@ -467,32 +1028,14 @@ class ElasticRepublicApi(remote.Service):
         p_key = ndb.Key(Profile, user_id)
         profile = p_key.get(use_cache=False, use_memcache=False)
         
-        # create new Profile if not there
+        # create new Profile if not there, saving it with its
+        # initial BalanceHistory and share of the money supply
         if not profile:
+            profile = self._insertProfileAsync(p_key, user_id, user.nickname(),
+                                               user.email()).get_result()
 
-            #generate initial BalanceHistory 
-            mrbhk = self._generateInitialBalanceHistory(p_key)
-            
-            #pupulate new ndb Profile entity
-            profile = Profile(
-                key = p_key,
-                userId = user_id,
-                displayName = user.nickname(),
-                mainEmail= user.email(),
-                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
-                MostRecentBalanceHistoryKey = mrbhk,
-            )
-        
-        #if profile exists make it's balance history current 
-        #and update it's mosrt recent balance history key
-        else:
-
-            mrbh = self._MakeBalanceHistCurrent(profile)
-
-            profile.MostRecentBalanceHistoryKey = mrbh.key
-
-        #save Profile entity to Datastore 
-        profile.put()    
+        #existing profiles are read only; their balance is
+        #computed from the materialized snapshot when asked for
 
         # return ndb Profile entity object
         return profile    
@@ -505,38 +1048,260 @@ class ElasticRepublicApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
-            for field in ('displayName', 'teeShirtSize'):
-                if hasattr(save_request, field):
-                    val = getattr(save_request, field)
-                    if val:
-                        setattr(prof, field, str(val))
-                        #if field == 'teeShirtSize':
-                        #    setattr(prof, field, str(val).upper())
-                        #else:
-                        #    setattr(prof, field, val)
-                        prof.put()
+            def txn():
+                # read again in the transaction, so a balance change
+                # committed since isn't overwritten
+                profile = prof.key.get()
+                renamed = bool(save_request.displayName) and \
+                    str(save_request.displayName) != profile.displayName
+                for field in ('displayName', 'teeShirtSize'):
+                    if hasattr(save_request, field):
+                        val = getattr(save_request, field)
+                        if val:
+                            setattr(profile, field, str(val))
+                            #if field == 'teeShirtSize':
+                            #    setattr(profile, field, str(val).upper())
+                            #else:
+                            #    setattr(profile, field, val)
+                profile.put()
+                return profile, renamed
+            prof, renamed = ndb.transaction(txn)
+
+            # relation lists join display names after their cache read,
+            # so a rename changes the views of everyone related, too
+            user_ids = [prof.userId]
+            if renamed:
+                user_ids.extend(self._relatedUserIdsAsync(prof.userId).get_result())
+            bumpGenerationsAsync(user_ids).get_result()
 
         # return ProfileForm
-        return self._copyProfileToForm(prof)
+        return toForm(prof, ProfileForm)
 
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @endpoints.method(ConditionalForm, ProfileForm,
                 path='profile', 
                 http_method='GET', 
                 name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
-        return self._doProfile()
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+
+        # the ProfileForm is cached until the profile is saved, and not
+        # sent again while the client's etag is current
+        return cachedFormAsync('profile', getUserId(user), ProfileForm,
+                               self._doProfile, etag=request.etag).get_result()
 
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
                 path='profile', 
                 http_method='POST', 
                 name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
 
+    @ndb.tasklet
+    def _relatedUserIdsAsync(self, user_id):
+        """Get the ids of the users in a user's active Relations."""
+        as_constit, as_rep = yield (
+            self._getActiveRelationsAsync(Relation.constitUserId, user_id),
+            self._getActiveRelationsAsync(Relation.repUserId, user_id))
+        raise ndb.Return(set([r.repUserId for r in as_constit] +
+                             [r.constitUserId for r in as_rep]))
+
+
+    @endpoints.method(message_types.VoidMessage, BalanceForm,
+                path='balance',
+                http_method='GET',
+                name='getBalance')
+    @instrumented
+    def getBalance(self, request):
+        """Return user's balance as of today."""
+        # make sure user is authed
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+
+        user_id = getUserId(user)
+        today = datetime.date.today()
+
+        # the BalanceForm is cached for the day, until the balance changes
+        return cachedFormAsync('balance', user_id, BalanceForm,
+                               lambda: self._getBalanceFormAsync(user_id, today),
+                               suffix=':' + today.isoformat(),
+                               consistent=False).get_result()
+
+    @ndb.tasklet
+    def _getBalanceFormAsync(self, user_id, date):
+        """Get a user's balance on a date as a BalanceForm."""
+        profile = yield ndb.Key(Profile, user_id).get_async()
+        if not profile:
+            raise endpoints.NotFoundException(
+                'No profile found for user: %s' % user_id)
+
+        # carry the materialized balance forward to the date in memory
+        # and add incoming flows not yet folded in by settlement
+        balance, shards = yield (getBalanceAsync(profile),
+                                 getPendingFlowShardsAsync(user_id))
+        balance = withPendingFlows(balance.on(date), shards)
+
+        raise ndb.Return(BalanceForm(
+            userId                = user_id,
+            date                  = str(balance.date),
+            eodBalance            = balance.eodBalance,
+            DailyNetIncomingBFlow = balance.DailyNetIncomingBFlow,
+        ))
+
+
+    @endpoints.method(message_types.VoidMessage, MoneySupplyForm,
+                path='moneySupply',
+                http_method='GET',
+                name='getMoneySupply')
+    @instrumented
+    def getMoneySupply(self, request):
+        """Return the money supply as of today."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+
+        # every balance and pending flow, summed as they're written
+        supply = getMoneySupplyAsync().get_result()
+        today = datetime.date.today()
+        return MoneySupplyForm(
+            date                  = str(today),
+            supply                = supply.on(today),
+            users                 = supply.users,
+            basicIncome           = supply.users * BASIC_INCOME,
+            moneyTax              = supply.on(today - datetime.timedelta(days=1)) * MONEY_TAX_RATE,
+            DailyNetIncomingBFlow = supply.DailyNetIncomingBFlow,
+        )
+
+
+    def _checkAdmin(self):
+        """Raise unless the signed in user is an app admin."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if user.email() not in ADMIN_EMAILS:
+            raise endpoints.ForbiddenException('Admins only')
+
+
+    @endpoints.method(message_types.VoidMessage, CacheStatsForm,
+                path='cacheStats',
+                http_method='GET',
+                name='getCacheStats')
+    @instrumented
+    def getCacheStats(self, request):
+        """Return this instance's view cache hit rates (admins only)."""
+        self._checkAdmin()
+        items = []
+        for view in ('profile', 'balance', 'relations', 'history'):
+            hits = VIEW_CACHE_STATS[view + 'Hits']
+            misses = VIEW_CACHE_STATS[view + 'Misses']
+            items.append(CacheStatForm(
+                view        = view,
+                hits        = hits,
+                misses      = misses,
+                hitRate     = float(hits) / (hits + misses) if hits + misses else 0.0,
+                notModified = VIEW_CACHE_STATS[view + 'NotModified'],
+            ))
+        return CacheStatsForm(items=items)
+
+
+    @endpoints.method(ServerStatsRequestForm, ServerStatsForm,
+                path='serverStats',
+                http_method='POST',
+                name='getServerStats')
+    def getServerStats(self, request):
+        """Return this instance's per-method call stats (admins only)."""
+        self._checkAdmin()
+        items = []
+        for endpoint, stats in sorted(serverStats().items()):
+            items.append(EndpointStatForm(
+                endpoint = endpoint,
+                calls    = stats['calls'],
+                errors   = stats['errors'],
+                metrics  = [MetricStatForm(name=name, **percentiles)
+                            for name, percentiles in sorted(stats['metrics'].items())],
+            ))
+        # the JSON dump is for offline analysis
+        return ServerStatsForm(items=items, json=statsJson(raw=request.raw))
+
+
+    @endpoints.method(ProjectionForm, BalanceHistoryForms,
+                path='projectBalance',
+                http_method='POST',
+                name='projectBalance')
+    @instrumented
+    def projectBalance(self, request):
+        """Return user's projected end of day balances for the coming days."""
+        # make sure user is authed
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+
+        if not 0 < request.days <= MAX_PROJECTION_DAYS:
+            raise endpoints.BadRequestException(
+                "'days' must be between 1 and %d" % MAX_PROJECTION_DAYS)
+
+        user_id = getUserId(user)
+        profile = ndb.Key(Profile, user_id).get()
+        if not profile:
+            raise endpoints.NotFoundException(
+                'No profile found for user: %s' % user_id)
+
+        # today's balance, as getBalance, and the active relations
+        # whose scheduled end changes the flow later on
+        today = datetime.date.today()
+        balance = getBalanceAsync(profile)
+        shards = getPendingFlowShardsAsync(user_id)
+        as_constit = self._getActiveRelationsAsync(Relation.constitUserId, user_id)
+        as_rep = self._getActiveRelationsAsync(Relation.repUserId, user_id)
+        balance = withPendingFlows(balance.get_result().on(today),
+                                   shards.get_result())
+
+        # this user is index 0, the other party is outside the projection
+        relations = []
+        for rel in as_constit.get_result() + as_rep.get_result():
+            if rel.endDate is None:
+                continue
+            if rel.endDate.date() < today:
+                # past its last day but not expired yet: its flow is still
+                # in the balance, so it stops from today
+                flow = -rel.dailyRate if rel.constitUserId == user_id else rel.dailyRate
+                balance = balance.withFlowFrom(today, -flow)
+                continue
+            end = (rel.endDate.date() - today).days
+            if rel.constitUserId == user_id:
+                relations.append((0, None, rel.dailyRate, 0, end))
+            else:
+                relations.append((None, 0, rel.dailyRate, 0, end))
+
+        history = projectBalances([balance.eodBalance],
+                                  [balance.DailyNetIncomingBFlow],
+                                  relations, request.days, record=True)
+
+        # one BalanceHistoryForm per projected day, flow changes included
+        flow = balance.DailyNetIncomingBFlow
+        flow_changes = {}
+        for constit, _, dailyRate, _, end in relations:
+            day = end + 1
+            flow_changes[day] = flow_changes.get(day, 0) \
+                              + (dailyRate if constit is not None else -dailyRate)
+        items = []
+        for day in xrange(1, request.days + 1):
+            flow += flow_changes.get(day, 0)
+            items.append(BalanceHistoryForm(
+                date                  = str(today + datetime.timedelta(days=day)),
+                eodBalance            = float(history[day - 1][0]),
+                DailyNetIncomingBFlow = flow,
+            ))
+        return BalanceHistoryForms(items=items)
+
 
 # registers API
 api = endpoints.api_server([ElasticRepublicApi]) 
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+"""expiry.py
+
+Elastic Republic relation expiry: ends the active Relations whose endDate
+has passed, one-time transactions and scheduled endings, found by their
+endDate index and reversed in batches on the task queue
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import collections
+import datetime
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from balances import getBalanceAsync
+from balances import getBalanceHistoryAsync
+from balances import putBalanceHistorysAsync
+from cache import bumpGenerationsAsync
+from counters import addIncomingFlowAsync
+from counters import addMoneySupplyAsync
+from ledger import NO_SUPPLY
+from ledger import Supply
+from models import BalanceHistory
+from models import Profile
+from models import Relation
+from models import RelationExpiryPartial
+from models import RelationExpiryRun
+from recompute import backdateFlowAsync
+from stats import RpcCounter
+
+EXPIRY_QUEUE = 'expiry'
+FANOUT_URL = '/tasks/expiry/fanout'
+EXPIRE_URL = '/tasks/expiry/batch'
+
+EXPIRY_PAGE_SIZE = 500          # Relation keys read per fan-out task
+EXPIRY_BATCH_SIZE = 100         # Relations ended per expiry task
+EXPIRY_GROUPS_PER_TXN = 24      # entity groups per transaction, besides a supply shard (25 max)
+BACKDATED_PER_TXN = 2           # each queues two recomputes (5 transactional tasks max)
+
+
+def _dayStart(day):
+    return datetime.datetime.combine(day, datetime.time())
+
+
+def _expiredQuery(day):
+    """Query for the active Relations whose last day was before day."""
+    return Relation.query(Relation.active == True, Relation.endDate < _dayStart(day))
+
+
+def _isExpired(rel, day):
+    """Whether a Relation is still active past its last day."""
+    return rel is not None and rel.active and rel.endDate is not None \
+        and rel.endDate < _dayStart(day)
+
+
+def _flowEndsOn(rel):
+    """The first day a Relation's daily rate isn't paid."""
+    return rel.endDate.date() + datetime.timedelta(days=1)
+
+
+def _isLegacy(rel):
+    """Whether a Relation was saved before heads, and may be in Profile lists."""
+    return rel.key.parent() is None
+
+
+def _addTasks(tasks):
+    """Add named tasks, skipping ones a retried task already added."""
+    queue = taskqueue.Queue(EXPIRY_QUEUE)
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+def startExpiry(day):
+    """Start an expiry run for day, returning its key."""
+    run_key = RelationExpiryRun(day=day).put()
+    _addTasks([taskqueue.Task(url=FANOUT_URL,
+                              name='expire-%d-page-0' % run_key.id(),
+                              params={'run': run_key.id(), 'day': day.isoformat(),
+                                      'page': 0, 'batches': 0})])
+    return run_key
+
+
+def _batches(keys):
+    """Split Relation keys into batches, keeping each constituent's together."""
+    # a Relation is in its constituent's entity group, so batches
+    # that don't share constituents don't contend
+    keys = sorted(keys, key=lambda k: k.pairs()[0])
+    batch = []
+    for key in keys:
+        if len(batch) >= EXPIRY_BATCH_SIZE and key.pairs()[0] != batch[-1].pairs()[0]:
+            yield batch
+            batch = []
+        batch.append(key)
+    if batch:
+        yield batch
+
+
+def fanOutExpiryPage(run_key, day, page, batches, cursor=None):
+    """Queue expiry batches for one page of expired Relation keys, then the next page.
+
+    batches counts the batches queued by earlier pages.
+    """
+    keys, next_cursor, more = _expiredQuery(day).fetch_page(
+        EXPIRY_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+    more = more and next_cursor is not None
+
+    #task names make a retried fan-out page queue nothing twice
+    tasks = []
+    for batch in _batches(keys):
+        tasks.append(taskqueue.Task(
+            url=EXPIRE_URL,
+            name='expire-%d-batch-%d' % (run_key.id(), batches),
+            params={'run': run_key.id(), 'day': day.isoformat(), 'batch': batches,
+                    'key': [k.urlsafe() for k in batch]}))
+        batches += 1
+
+    #the query skips Relations ended by earlier batches, but the
+    #cursor is already past them
+    if more:
+        tasks.append(taskqueue.Task(
+            url=FANOUT_URL,
+            name='expire-%d-page-%d' % (run_key.id(), page + 1),
+            params={'run': run_key.id(), 'day': day.isoformat(), 'page': page + 1,
+                    'batches': batches, 'cursor': next_cursor.urlsafe()}))
+    _addTasks(tasks)
+
+    if not more:
+        _setBatchesAsync(run_key, batches).get_result()
+        finishExpiry(run_key)
+    return len(keys)
+
+
+@ndb.transactional_tasklet
+def _setBatchesAsync(run_key, batches):
+    """Record how many batches a run has."""
+    run = yield run_key.get_async()
+    run.batches = batches
+    yield run.put_async()
+
+
+def _groups(rel, today):
+    """The entity groups ending a Relation writes, besides a supply shard."""
+    #its own, the constituent's unless it's a legacy root Relation
+    groups = set([rel.key.root().pairs()[0], ('Profile', rel.constitUserId)])
+    if _flowEndsOn(rel) < today or _isLegacy(rel):
+        groups.add(('Profile', rel.repUserId))
+    if _flowEndsOn(rel) >= today:
+        groups.add(('IncomingFlowShard', rel.repUserId))
+    return groups
+
+
+def _expiryChunks(rels, today):
+    """Split Relations into chunks each one cross-group transaction can end."""
+    chunk, groups, backdated = [], set(), 0
+    for rel in rels:
+        rel_groups = _groups(rel, today)
+        rel_backdated = int(_flowEndsOn(rel) < today)
+        if chunk and (len(groups | rel_groups) > EXPIRY_GROUPS_PER_TXN or
+                      backdated + rel_backdated > BACKDATED_PER_TXN):
+            yield chunk
+            chunk, groups, backdated = [], set(), 0
+        chunk.append(rel)
+        groups |= rel_groups
+        backdated += rel_backdated
+    if chunk:
+        yield chunk
+
+
+@ndb.transactional_tasklet(xg=True)
+def _expireChunkAsync(rel_keys, day):
+    """End a chunk of expired Relations, reversing their flows; returns how many ended.
+
+    Each Relation's rate stops the day after its endDate: from today
+    through today's BalanceHistory and the representative's flow shards
+    like a relation change, or from a past day through backdated flows.
+    """
+    today = datetime.date.today()
+    rels = yield ndb.get_multi_async(rel_keys)
+    #ended by an earlier run of this task, or by its users meanwhile
+    rels = [r for r in rels if _isExpired(r, day)]
+    if not rels:
+        raise ndb.Return(0)
+
+    user_ids = set()
+    for rel in rels:
+        user_ids.update(user_id for kind, user_id in _groups(rel, today) if kind == 'Profile')
+    user_ids = list(user_ids)
+    profiles = yield ndb.get_multi_async([ndb.Key(Profile, u) for u in user_ids])
+    profiles = dict(zip(user_ids, profiles))
+    supply = NO_SUPPLY
+
+    #a day ended in the past changes both balances from then on, and
+    #their BalanceHistorys catch up from the recompute queue
+    for rel in rels:
+        if _flowEndsOn(rel) < today:
+            changes = yield (
+                backdateFlowAsync(profiles[rel.constitUserId], rel.dailyRate,
+                                  _flowEndsOn(rel), [rel.key]),
+                backdateFlowAsync(profiles[rel.repUserId], -rel.dailyRate,
+                                  _flowEndsOn(rel), [rel.key]))
+            supply += changes[0] + changes[1]
+
+    #ending today: each constituent's rates come back in today's
+    #BalanceHistory, and each representative's go on one flow shard
+    ending_today = [r for r in rels if _flowEndsOn(r) >= today]
+    constit_ids = sorted(set(r.constitUserId for r in ending_today))
+    bal_hists = yield [getBalanceHistoryAsync(ndb.Key(Profile, u), today) for u in constit_ids]
+    bal_hists = dict(zip(constit_ids, bal_hists))
+    rep_flows = collections.defaultdict(lambda: [0, []])
+    for user_id in constit_ids:
+        profile = profiles[user_id]
+        balance = yield getBalanceAsync(profile)
+        balance = balance.on(today)
+        if not bal_hists[user_id]:
+            bal_hists[user_id] = BalanceHistory.fromBalance(profile.key, balance)
+        bal_hist = bal_hists[user_id]
+        flow = 0
+        for rel in ending_today:
+            if rel.constitUserId == user_id:
+                bal_hist.relationsChangedKeys.append(rel.key)
+                flow += rel.dailyRate
+                rep_flows[rel.repUserId][0] -= rel.dailyRate
+                rep_flows[rel.repUserId][1].append(rel.key)
+        bal_hist.DailyNetIncomingBFlow += flow
+        bal_hist.eodBalance += flow
+
+        #the change is added to the balance rather than copied from the
+        #row, which may still be waiting for a backdated recompute
+        changed = balance.withFlowFrom(today, flow)
+        supply += Supply.ofBalance(changed) - Supply.ofBalance(balance)
+        profile.setBalanceSnapshot(changed)
+        profile.MostRecentBalanceHistoryKey = bal_hist.key
+    for flow, _ in rep_flows.values():
+        supply += Supply.ofFlow(today, flow)
+    yield [addIncomingFlowAsync(rep_id, flow, rep_keys)
+           for rep_id, (flow, rep_keys) in rep_flows.items()]
+
+    #profiles saved before Relation.active still list their relations
+    for rel in rels:
+        rel.active = False
+        for user_id in (rel.constitUserId, rel.repUserId):
+            profile = profiles.get(user_id)
+            if profile and rel.key in profile.activeRelationsKeys:
+                profile.activeRelationsKeys.remove(rel.key)
+
+    #relation flows leave one user for another, so this is no more
+    #than rounding
+    yield addMoneySupplyAsync(supply)
+    yield (ndb.put_multi_async(rels + [p for p in profiles.values() if p]),
+           putBalanceHistorysAsync(bal_hists.values()))
+    raise ndb.Return(len(rels))
+
+
+def expireRelations(rel_keys, day):
+    """End the Relations among rel_keys still active past their last day.
+
+    Returns how many were ended.
+    """
+    today = datetime.date.today()
+    rels = [r for r in ndb.get_multi(rel_keys) if _isExpired(r, day)]
+
+    #a constituent's backdated endings change its balance before its
+    #rates ending today are added, in separate transactions
+    expired = 0
+    for rels_ending in ([r for r in rels if _flowEndsOn(r) < today],
+                        [r for r in rels if _flowEndsOn(r) >= today]):
+        for chunk in _expiryChunks(rels_ending, today):
+            expired += _expireChunkAsync([r.key for r in chunk], day).get_result()
+
+    #then both users' cached views are dropped
+    user_ids = set()
+    for rel in rels:
+        user_ids.update((rel.constitUserId, rel.repUserId))
+    bumpGenerationsAsync(user_ids).get_result()
+    return expired
+
+
+def expireBatch(run_key, batch, rel_keys, day):
+    """End one task's batch of Relations, log its throughput and record it in the run."""
+    partial_key = ndb.Key(RelationExpiryPartial, 'batch-%d' % batch, parent=run_key)
+    if partial_key.get():
+        #recorded by an earlier run of this task
+        finishExpiry(run_key)
+        return 0
+
+    start = time.time()
+    with RpcCounter() as rpcs:
+        expired = expireRelations(rel_keys, day)
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info('Ended %d of %d relations past %s in %.2fs: %.1f relations/s, '
+                 '%.1f RPCs/relation', expired, len(rel_keys), day, elapsed,
+                 len(rel_keys) / elapsed, float(rpcs.total) / max(len(rel_keys), 1))
+
+    RelationExpiryPartial(key=partial_key, expired=expired,
+                          skipped=len(rel_keys) - expired,
+                          seconds=elapsed, rpcs=rpcs.total).put()
+    finishExpiry(run_key)
+    return expired
+
+
+def finishExpiry(run_key):
+    """Total a run's batches and log its throughput once every batch is in."""
+    run = run_key.get()
+    if run.finished or run.batches is None:
+        return
+    partials = RelationExpiryPartial.query(ancestor=run_key).fetch()
+    if len(partials) < run.batches:
+        return
+
+    @ndb.tasklet
+    def txn():
+        run = yield run_key.get_async()
+        if run.finished:
+            #another batch finished the run first
+            raise ndb.Return(None)
+        run.finished = datetime.datetime.now()
+        run.expired = sum(p.expired for p in partials)
+        run.skipped = sum(p.skipped for p in partials)
+        run.seconds = (run.finished - run.started).total_seconds()
+        run.taskSeconds = sum(p.seconds for p in partials)
+        yield run.put_async()
+        raise ndb.Return(run)
+
+    run = ndb.transaction_async(txn).get_result()
+    if run:
+        logging.info('Relation expiry for %s: %d ended, %d skipped, in %d batches over '
+                     '%.1fs: %.1f relations/s, %.1f per task second', run.day,
+                     run.expired, run.skipped, run.batches, run.seconds,
+                     run.expired / max(run.seconds, 1e-6),
+                     run.expired / max(run.taskSeconds, 1e-6))
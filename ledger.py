@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""ledger.py
+
+Elastic Republic ledger arithmetic: daily money tax, basic income and
+Relation ballot flows applied to end of day balances
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import collections
+import datetime
+
+# NumPy takes a while to import, so it's loaded by the first projection
+# (or at warmup) rather than by every request that touches the ledger
+numpy = None
+_numpy_loaded = False
+
+
+ONE_BALLOT = float(1000000) #one millioon milionths of a Ballot
+MONEY_TAX_RATE = 0.0006849315068493151  #float(1 / 1460) #Daily money tax rate: 1 divided by 1460 days in a term
+BASIC_INCOME = 684.9315068493151  #float(ONE_BALLOT * TAX_RATE) #Daily Universal Basic Income
+
+#share of yesterday's balance left after today's money tax
+DAILY_RETENTION = 1 - MONEY_TAX_RATE
+
+#money supply shares are carried back to this day so they add up
+SUPPLY_EPOCH = datetime.date(2015, 1, 1)
+
+
+def nextBalance(eodBalance, dailyNetIncomingBFlow):
+    """Return the next day's end of day balance."""
+    #yesterday's end of day balance
+    #\minus yesterday's tax
+    #\plus today's basic income
+    #\plus today's net incomeing ballotflow
+    return eodBalance \
+         - (eodBalance * MONEY_TAX_RATE) \
+         + BASIC_INCOME \
+         + dailyNetIncomingBFlow
+
+
+def balanceAfterDays(eodBalance, dailyNetIncomingBFlow, days):
+    """Return the end of day balance `days` days later, in O(1)."""
+    # nextBalance is the linear recurrence b(n+1) = a * b(n) + c with
+    # a = DAILY_RETENTION and c = BASIC_INCOME + flow, so
+    # b(n) = a^n * b(0) + c * (1 - a^n) / (1 - a)
+    if days <= 0:
+        return eodBalance
+    retained = DAILY_RETENTION ** days
+    return retained * eodBalance \
+         + (BASIC_INCOME + dailyNetIncomingBFlow) * (1 - retained) / MONEY_TAX_RATE
+
+
+def flowBalance(dailyNetIncomingBFlow, days):
+    """Return what a daily flow adds to the balance after `days` days of it."""
+    # the flow counts in full on its first day and is taxed every day after:
+    # flow * (1 + a + ... + a^(days - 1))
+    if days <= 0:
+        return 0.0
+    return dailyNetIncomingBFlow * (1 - DAILY_RETENTION ** days) / MONEY_TAX_RATE
+
+
+class Balance(collections.namedtuple(
+        'Balance', 'date eodBalance DailyNetIncomingBFlow')):
+    """Balance -- end of day balance and net incoming ballot flow on a date"""
+    __slots__ = ()
+
+    def on(self, date):
+        """Return this Balance carried forward to a later date."""
+        return self._replace(
+            date=date,
+            eodBalance=balanceAfterDays(self.eodBalance,
+                                        self.DailyNetIncomingBFlow,
+                                        (date - self.date).days))
+
+    def withFlowFrom(self, date, dailyNetIncomingBFlow):
+        """Return this Balance with a flow that started on an earlier date."""
+        return self._replace(
+            eodBalance=self.eodBalance + flowBalance(dailyNetIncomingBFlow,
+                                                     (self.date - date).days + 1),
+            DailyNetIncomingBFlow=self.DailyNetIncomingBFlow + dailyNetIncomingBFlow)
+
+
+class Supply(collections.namedtuple(
+        'Supply', 'epochBalance DailyNetIncomingBFlow users')):
+    """Supply -- a share of the money supply, carried back to SUPPLY_EPOCH"""
+    __slots__ = ()
+    # Balance.on is linear in (eodBalance, flow, basic incomes), so
+    # shares carried to one day add up to the total on any later day;
+    # relation flows leave one user for another and sum to nothing
+
+    @classmethod
+    def ofBalance(cls, balance, users=1):
+        """Return the share of a Balance, earning basic income for `users` users."""
+        #Balance.on run backwards, from the balance's date to the epoch
+        retained = DAILY_RETENTION ** (balance.date - SUPPLY_EPOCH).days
+        income = users * BASIC_INCOME + balance.DailyNetIncomingBFlow
+        return cls((balance.eodBalance - income * (1 - retained) / MONEY_TAX_RATE) / retained,
+                   balance.DailyNetIncomingBFlow, users)
+
+    @classmethod
+    def ofFlow(cls, date, dailyNetIncomingBFlow):
+        """Return the share of a flow starting on date, as Balance.withFlowFrom counts it."""
+        return cls.ofBalance(Balance(date - datetime.timedelta(days=1), 0.0,
+                                     dailyNetIncomingBFlow), users=0)
+
+    def __add__(self, other):
+        return Supply(*[a + b for a, b in zip(self, other)])
+
+    def __sub__(self, other):
+        return Supply(*[a - b for a, b in zip(self, other)])
+
+    def __neg__(self):
+        return Supply(*[-a for a in self])
+
+    def on(self, date):
+        """Return the total money supply at the end of date."""
+        retained = DAILY_RETENTION ** (date - SUPPLY_EPOCH).days
+        return retained * self.epochBalance \
+             + (self.users * BASIC_INCOME + self.DailyNetIncomingBFlow) \
+             * (1 - retained) / MONEY_TAX_RATE
+
+
+NO_SUPPLY = Supply(0.0, 0, 0)
+
+
+def loadNumpy():
+    """Import NumPy once, returning it or None when it isn't available."""
+    global numpy, _numpy_loaded
+    if not _numpy_loaded:
+        _numpy_loaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def _flowEvents(relations, days):
+    """List (day, user index, flow change) for relations starting and ending."""
+    # relations are (constituent index, representative index, dailyRate,
+    # start day, end day or None) with days counted from day 0; either
+    # index may be None for a user outside the projection
+    events = []
+    for constit, rep, dailyRate, start, end in relations:
+        for user, flow in ((constit, -dailyRate), (rep, dailyRate)):
+            if user is None:
+                continue
+            #flows from its start day through its end day
+            if 0 < start <= days:
+                events.append((start, user, flow))
+            if end is not None and 0 < end + 1 <= days:
+                events.append((end + 1, user, -flow))
+    return events
+
+
+def _projectBalancesScalar(eodBalances, flows, events, days, record):
+    """Pure Python projectBalances, one user and one day at a time."""
+    changes = collections.defaultdict(lambda: collections.defaultdict(float))
+    for day, user, flow in events:
+        changes[user][day] += flow
+
+    finals, history = [], []
+    for user, (eodBalance, flow) in enumerate(zip(eodBalances, flows)):
+        user_changes = changes.get(user, {})
+        user_history = []
+        for day in xrange(1, days + 1):
+            flow += user_changes.get(day, 0)
+            eodBalance = nextBalance(eodBalance, flow)
+            if record:
+                user_history.append(eodBalance)
+        finals.append(eodBalance)
+        history.append(user_history)
+
+    if record:
+        #one row per day, one column per user
+        return [list(day) for day in zip(*history)]
+    return finals
+
+
+def projectBalances(eodBalances, flows, relations=(), days=1460, record=False):
+    """Project many users' end of day balances `days` days ahead.
+
+    eodBalances and flows hold each user's day 0 balance and net daily
+    flow; relations schedule flow changes (see _flowEvents). Returns the
+    balances on the last day, or with record=True every day's balances,
+    one row per day. Uses NumPy across users when it's available.
+    """
+    events = _flowEvents(relations, days)
+    if loadNumpy() is None:
+        return _projectBalancesScalar(eodBalances, flows, events, days, record)
+
+    balances = numpy.array(eodBalances, dtype=float)
+    flows = numpy.array(flows, dtype=float)
+    users = len(balances)
+
+    #flow changes sorted by day, with each day's slice bounds
+    events.sort(key=lambda e: e[0])
+    event_days = numpy.array([e[0] for e in events], dtype=int)
+    event_users = numpy.array([e[1] for e in events], dtype=int)
+    event_flows = numpy.array([e[2] for e in events], dtype=float)
+    bounds = numpy.searchsorted(event_days, numpy.arange(1, days + 2))
+
+    history = numpy.empty((days, users)) if record else None
+    for day in xrange(1, days + 1):
+        lo, hi = bounds[day - 1], bounds[day]
+        if hi > lo:
+            flows += numpy.bincount(event_users[lo:hi], weights=event_flows[lo:hi],
+                                    minlength=users)
+        #same steps as nextBalance, for every user at once
+        balances -= balances * MONEY_TAX_RATE
+        balances += BASIC_INCOME
+        balances += flows
+        if record:
+            history[day - 1] = balances
+
+    return history if record else balances
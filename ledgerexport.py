@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+"""ledgerexport.py
+
+Elastic Republic bulk ledger export and import: streams every Profile,
+Relation and BalanceHistory, and the backdated recomputes still being
+written to them, out of the Datastore a cursor page at a time into
+gzipped JSONL or CSV shards, and puts them back a shard at a time,
+resuming after the last shard committed; imported recomputes are
+queued again. Run it from the app directory in remote_api_shell.py
+against the app, or the dev server:
+
+    >>> import ledgerexport
+    >>> store = ledgerexport.LocalShardStore('ledger')
+    >>> ledgerexport.exportLedger(store, 'csv')
+    >>> ledgerexport.importLedger(store, parallel=8)
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import base64
+import collections
+import contextlib
+import csv
+import datetime
+import gzip
+import itertools
+import json
+import logging
+import os
+import time
+
+from google.appengine.ext import ndb
+
+from models import BalanceHistory
+from models import BalanceHistoryBlock
+from models import BalanceRecompute
+from models import IncomingFlowShard
+from models import MoneySupplyShard
+from models import Profile
+from models import Relation
+from models import RelationHead
+from recompute import RECOMPUTE_QUEUE
+from recompute import _queueChunk
+
+# stored kinds of a ledger, in the order they're imported
+LEDGER_KINDS = collections.OrderedDict((model._get_kind(), model) for model in (
+    Profile, RelationHead, Relation, BalanceHistory, BalanceHistoryBlock,
+    IncomingFlowShard, MoneySupplyShard, BalanceRecompute))
+FORMATS = ('jsonl', 'csv')
+
+EXPORT_PAGE_SIZE = 500          # entities per cursor query page
+SHARD_SIZE = 20000              # entities per shard file
+IMPORT_BATCH_SIZE = 500         # entities per put_multi
+IMPORT_PARALLEL = 4             # put_multi batches in flight
+
+MANIFEST = 'manifest.json'
+CHECKPOINT = 'import.checkpoint'
+REQUEUED = 'recomputes queued'  # checkpoint line once imported recomputes are queued
+KEY_COLUMN = '__key__'
+
+# every read and write skips the caches, so memory stays bounded by a page
+NO_CACHE = dict(use_cache=False, use_memcache=False)
+
+
+class LocalShardStore(object):
+    """Shard files in a local directory, standing in for Cloud Storage."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextlib.contextmanager
+    def writer(self, name):
+        """Open a file to write; it appears under name only once closed."""
+        path = self._path(name)
+        with open(path + '.tmp', 'wb') as f:
+            yield f
+        os.rename(path + '.tmp', path)
+
+    def reader(self, name):
+        return open(self._path(name), 'rb')
+
+    def size(self, name):
+        return os.path.getsize(self._path(name))
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def append(self, name, line):
+        """Append a line to a file, on disk before returning."""
+        with open(self._path(name), 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def lines(self, name):
+        if not self.exists(name):
+            return []
+        with open(self._path(name)) as f:
+            return [line.strip() for line in f if line.strip()]
+
+
+# - - - entity records - - - - - - - - - - - - - - - - - - - - - -
+
+
+def _columns(model):
+    """A kind's record fields: its key, then its properties by name."""
+    return [KEY_COLUMN] + sorted(model._properties)
+
+
+def _toJson(prop, value):
+    """One property value as JSON: keys as flat paths, dates ISO, blobs base64."""
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return list(value.flat())
+    if isinstance(prop, ndb.DateTimeProperty):
+        #DateProperty is a DateTimeProperty too
+        return value.isoformat()
+    if isinstance(prop, ndb.BlobProperty) and not isinstance(prop, ndb.TextProperty):
+        return base64.b64encode(value)
+    return value
+
+
+def _fromJson(prop, value):
+    """The inverse of _toJson."""
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value)
+    if isinstance(prop, ndb.DateProperty):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if isinstance(prop, ndb.DateTimeProperty):
+        return datetime.datetime.strptime(
+            value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    if isinstance(prop, ndb.BlobProperty) and not isinstance(prop, ndb.TextProperty):
+        return base64.b64decode(value)
+    if isinstance(prop, ndb.FloatProperty):
+        return float(value)
+    return value
+
+
+def _toRecord(entity):
+    """An entity as a dict of JSON values; properties no longer modelled are left out."""
+    record = {KEY_COLUMN: list(entity.key.flat())}
+    for name, prop in type(entity)._properties.items():
+        value = prop._get_value(entity)
+        if prop._repeated:
+            record[name] = [_toJson(prop, v) for v in value]
+        else:
+            record[name] = _toJson(prop, value)
+    return record
+
+
+def _fromRecord(model, record):
+    """Build the entity a record was made from."""
+    entity = model(key=ndb.Key(flat=record[KEY_COLUMN]))
+    for name, prop in model._properties.items():
+        if name not in record:
+            continue
+        value = record[name]
+        if prop._repeated:
+            value = [_fromJson(prop, v) for v in value or []]
+        else:
+            value = _fromJson(prop, value)
+        prop._set_value(entity, value)
+    return entity
+
+
+def _csvCell(value):
+    """A CSV cell: the value as JSON, or empty for None."""
+    return '' if value is None else json.dumps(value)
+
+
+def _fromCsvCell(cell):
+    return json.loads(cell) if cell else None
+
+
+# - - - shard files - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def _shardName(kind, index, fmt):
+    return '%s-%05d.%s.gz' % (kind, index, fmt)
+
+
+def _writeShard(f, model, fmt, records):
+    """Write records to a gzipped shard file; returns how many."""
+    count = 0
+    with gzip.GzipFile(fileobj=f, mode='wb') as out:
+        if fmt == 'jsonl':
+            for record in records:
+                out.write(json.dumps(record, sort_keys=True) + '\n')
+                count += 1
+        else:
+            columns = _columns(model)
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for record in records:
+                writer.writerow([_csvCell(record[c]) for c in columns])
+                count += 1
+    return count
+
+
+def _readShard(f, model, fmt):
+    """Yield the records of a gzipped shard file."""
+    with gzip.GzipFile(fileobj=f, mode='rb') as lines:
+        if fmt == 'jsonl':
+            for line in lines:
+                yield json.loads(line)
+        else:
+            rows = csv.reader(lines)
+            columns = next(rows)
+            for row in rows:
+                yield dict((c, _fromCsvCell(cell)) for c, cell in zip(columns, row)
+                           if c == KEY_COLUMN or c in model._properties)
+
+
+# - - - export - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def _pages(query, page_size):
+    """Yield a query's entities a cursor page at a time.
+
+    The next page is fetched while the caller writes the last one.
+    """
+    future = query.fetch_page_async(page_size, **NO_CACHE)
+    while True:
+        entities, cursor, more = future.get_result()
+        more = more and cursor is not None
+        if more:
+            future = query.fetch_page_async(page_size, start_cursor=cursor, **NO_CACHE)
+        yield entities
+        if not more:
+            return
+
+
+def exportKind(store, kind, fmt='jsonl', page_size=EXPORT_PAGE_SIZE, shard_size=SHARD_SIZE):
+    """Stream every entity of a kind into shard files; returns (shard names, count)."""
+    model = LEDGER_KINDS[kind]
+    records = (_toRecord(e) for page in _pages(model.query(), page_size) for e in page)
+    names, count = [], 0
+    for first in records:
+        #each shard takes the next shard_size records off the stream
+        name = _shardName(kind, len(names), fmt)
+        with store.writer(name) as f:
+            count += _writeShard(f, model, fmt, itertools.chain(
+                [first], itertools.islice(records, shard_size - 1)))
+        names.append(name)
+    return names, count
+
+
+def _recomputeProgress():
+    """Each BalanceRecompute's key and first day not rewritten yet."""
+    return dict((job.key, job.nextDate) for job in BalanceRecompute.query().iter(**NO_CACHE))
+
+
+def exportLedger(store, fmt='jsonl', kinds=None, page_size=EXPORT_PAGE_SIZE,
+                 shard_size=SHARD_SIZE):
+    """Export the ledger's kinds to store, then write its manifest.
+
+    Returns {kind: (entities, seconds)}, and logs entities/s. Raises
+    ValueError, writing no manifest, if a recompute chunk committed or a
+    new recompute began while it ran: the rows exported and the
+    recompute's marker could then disagree about which days it rewrote.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format: %s' % fmt)
+    progress = _recomputeProgress()
+    manifest = {'format': fmt, 'started': datetime.datetime.now().isoformat(), 'kinds': {}}
+    results = collections.OrderedDict()
+    for kind in kinds or LEDGER_KINDS:
+        start = time.time()
+        names, count = exportKind(store, kind, fmt, page_size, shard_size)
+        elapsed = max(time.time() - start, 1e-6)
+        manifest['kinds'][kind] = {'shards': names, 'entities': count}
+        results[kind] = (count, elapsed)
+        logging.info('Exported %d %ss to %d shards in %.1fs: %.0f entities/s, %d bytes',
+                     count, kind, len(names), elapsed, count / elapsed,
+                     sum(store.size(n) for n in names))
+
+    if _recomputeProgress() != progress:
+        raise ValueError('A balance recompute ran during the export; export again '
+                         'once the %s queue is paused or empty' % RECOMPUTE_QUEUE)
+
+    #the manifest is written last, so only a finished export has one
+    with store.writer(MANIFEST) as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return results
+
+
+# - - - import - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def _putBatches(entities, batch_size, parallel):
+    """put_multi entities in batches, with up to parallel batches in flight.
+
+    Raises the first failed put, so its shard isn't checkpointed.
+    """
+    in_flight = collections.deque()
+    batch = list(itertools.islice(entities, batch_size))
+    while batch:
+        if len(in_flight) >= parallel:
+            [f.get_result() for f in in_flight.popleft()]
+        in_flight.append(ndb.put_multi_async(batch, **NO_CACHE))
+        batch = list(itertools.islice(entities, batch_size))
+    for futures in in_flight:
+        [f.get_result() for f in futures]
+
+
+def importShard(store, name, kind, fmt, batch_size=IMPORT_BATCH_SIZE, parallel=IMPORT_PARALLEL):
+    """Put every entity of one shard file; returns how many."""
+    model = LEDGER_KINDS[kind]
+    count = [0]
+
+    def entities():
+        with store.reader(name) as f:
+            for record in _readShard(f, model, fmt):
+                count[0] += 1
+                yield _fromRecord(model, record)
+
+    _putBatches(entities(), batch_size, parallel)
+    return count[0]
+
+
+def _allocatedId(flat):
+    """The id a key's path took from Relation's sequence, if any."""
+    pairs = zip(flat[::2], flat[1::2])
+    for kind, id in pairs:
+        if kind == RelationHead._get_kind() and isinstance(id, (int, long)):
+            return id
+    kind, id = pairs[0]
+    if kind == Relation._get_kind() and isinstance(id, (int, long)):
+        #a legacy, unversioned relation
+        return id
+    return 0
+
+
+def _highestRelationId(store, manifest):
+    """The highest id an exported Relation or RelationHead took."""
+    highest = 0
+    for kind in (Relation._get_kind(), RelationHead._get_kind()):
+        if kind not in manifest['kinds']:
+            continue
+        for name in manifest['kinds'][kind]['shards']:
+            with store.reader(name) as f:
+                for record in _readShard(f, LEDGER_KINDS[kind], manifest['format']):
+                    highest = max(highest, _allocatedId(record[KEY_COLUMN]))
+    return highest
+
+
+def _queueRecomputes(store, manifest):
+    """Queue the next chunk of every exported BalanceRecompute; returns how many."""
+    kind = BalanceRecompute._get_kind()
+    count = 0
+    for name in manifest['kinds'].get(kind, {}).get('shards', []):
+        with store.reader(name) as f:
+            for record in _readShard(f, BalanceRecompute, manifest['format']):
+                job_key = _fromRecord(BalanceRecompute, record).key
+                ndb.transaction(lambda: _queueChunk(job_key))
+                count += 1
+    return count
+
+
+def importLedger(store, kinds=None, batch_size=IMPORT_BATCH_SIZE, parallel=IMPORT_PARALLEL):
+    """Import an export from store, skipping shards an earlier import of it committed.
+
+    Returns {kind: (entities, seconds, shards skipped)}, and logs
+    entities/s. Entities are put by key, so a shard interrupted part
+    way is simply put again. Once its BalanceRecomputes are in, each
+    one's next chunk is queued, once per export. Imported users' cached
+    views aren't dropped: import into a Datastore nothing else is using.
+    """
+    if not store.exists(MANIFEST):
+        raise ValueError('No finished export in %s' % store.directory)
+    with store.reader(MANIFEST) as f:
+        manifest = json.load(f)
+    #the checkpoint's first line names the export its shards came from
+    checkpoint = store.lines(CHECKPOINT)
+    if not checkpoint:
+        store.append(CHECKPOINT, manifest['started'])
+    elif checkpoint[0] != manifest['started']:
+        raise ValueError('%s in %s is from importing the export of %s, not of %s; '
+                         'remove it to import this export' % (
+                             CHECKPOINT, store.directory, checkpoint[0], manifest['started']))
+    committed = set(checkpoint[1:])
+    results = collections.OrderedDict()
+    for kind in kinds or LEDGER_KINDS:
+        if kind not in manifest['kinds']:
+            continue
+        start, count, skipped = time.time(), 0, 0
+        for name in manifest['kinds'][kind]['shards']:
+            if name in committed:
+                skipped += 1
+                continue
+            count += importShard(store, name, kind, manifest['format'], batch_size, parallel)
+            store.append(CHECKPOINT, name)
+        elapsed = max(time.time() - start, 1e-6)
+        results[kind] = (count, elapsed, skipped)
+        logging.info('Imported %d %ss in %.1fs: %.0f entities/s, %d shards already in',
+                     count, kind, elapsed, count / elapsed, skipped)
+
+    #new Relations take ids from Relation's sequence; keep it past the imported ones
+    highest = _highestRelationId(store, manifest)
+    if highest:
+        Relation.allocate_ids(max=highest)
+
+    #recomputes pending at the export carry on from their markers, after
+    #the rows they rewrite are in
+    if BalanceRecompute._get_kind() in (kinds or LEDGER_KINDS) and REQUEUED not in committed:
+        queued = _queueRecomputes(store, manifest)
+        store.append(CHECKPOINT, REQUEUED)
+        logging.info('Queued %d %ss', queued, BalanceRecompute._get_kind())
+    return results
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Elastic Republic resumable Datastore migrations, run a page at a time
+from the task queue by tasks.py
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+from google.appengine.ext import ndb
+
+from balances import latestBalanceHistorys
+from balances import packBalanceHistorysAsync
+from balances import packedStorage
+from models import BalanceHistory
+from models import Profile
+from models import Relation
+
+MIGRATION_PAGE_SIZE = 200
+PACK_PAGE_SIZE = 20     # Profiles packed per task, up to a term of rows each
+
+
+@ndb.transactional_tasklet
+def _repointProfileAsync(profile_key, moved):
+    """Point a Profile's MostRecentBalanceHistoryKey at its flat key."""
+    profile = yield profile_key.get_async()
+    if profile and profile.MostRecentBalanceHistoryKey in moved:
+        profile.MostRecentBalanceHistoryKey = moved[profile.MostRecentBalanceHistoryKey]
+        yield profile.put_async()
+
+
+def flattenBalanceHistoryPage(cursor=None, page_size=MIGRATION_PAGE_SIZE):
+    """Re-key one page of chained BalanceHistorys directly under their Profile.
+
+    Returns (next_cursor, more, moved_count). Safe to re-run on the same
+    cursor: flat rows are written before chained ones are deleted, and
+    days that already have a flat row keep it.
+    """
+    keys, next_cursor, more = BalanceHistory.query().fetch_page(
+        page_size, start_cursor=cursor, keys_only=True)
+
+    #old keys are nested one level deeper for every day
+    chained_keys = [k for k in keys if len(k.pairs()) > 2]
+    if not chained_keys:
+        return next_cursor, more, 0
+
+    chained = [bh for bh in ndb.get_multi(chained_keys) if bh]
+
+    #chained key -> flat key under the root Profile key
+    moved = {}
+    for bh in chained:
+        profile_key = ndb.Key(pairs=bh.key.pairs()[:1])
+        moved[bh.key] = BalanceHistory.keyFor(profile_key, bh.date)
+
+    #don't overwrite days written flat since the new key scheme shipped
+    flat_keys = list(set(moved.values()))
+    existing = set(k for k, bh in zip(flat_keys, ndb.get_multi(flat_keys)) if bh)
+    ndb.put_multi([BalanceHistory(key=moved[bh.key], **bh.to_dict())
+                   for bh in chained if moved[bh.key] not in existing])
+
+    profile_keys = set(k.root() for k in moved.values())
+    ndb.Future.wait_all([_repointProfileAsync(k, moved) for k in profile_keys])
+
+    ndb.delete_multi(moved.keys())
+
+    return next_cursor, more, len(moved)
+
+
+def backfillRelationActivePage(cursor=None, page_size=MIGRATION_PAGE_SIZE):
+    """Re-save one page of Relations so their 'active' flag is indexed.
+
+    Returns (next_cursor, more, saved_count). Relations saved before the
+    flag existed load with its default (True), matching the old
+    Profile.activeRelationsKeys lists; already set flags are kept.
+    """
+    relations, next_cursor, more = Relation.query().fetch_page(
+        page_size, start_cursor=cursor)
+    ndb.put_multi(relations)
+    return next_cursor, more, len(relations)
+
+
+@ndb.transactional_tasklet
+def _packProfileAsync(profile_key):
+    """Pack a Profile's daily BalanceHistorys into blocks, returning the row keys."""
+    rows = yield BalanceHistory.query(ancestor=profile_key).fetch_async()
+    if not rows:
+        raise ndb.Return([])
+
+    #days already in a block were written since monthly storage was on
+    yield packBalanceHistorysAsync(profile_key, latestBalanceHistorys(rows),
+                                   keep_existing=True)
+
+    #flat keys name the day wherever it's stored, chained ones don't
+    profile = yield profile_key.get_async()
+    dates = dict((bh.key, bh.date) for bh in rows)
+    if profile and profile.MostRecentBalanceHistoryKey in dates \
+            and len(profile.MostRecentBalanceHistoryKey.pairs()) > 2:
+        profile.MostRecentBalanceHistoryKey = BalanceHistory.keyFor(
+            profile_key, dates[profile.MostRecentBalanceHistoryKey])
+        yield profile.put_async()
+    raise ndb.Return([bh.key for bh in rows])
+
+
+def packBalanceHistoryPage(cursor=None, page_size=PACK_PAGE_SIZE):
+    """Pack one page of Profiles' daily BalanceHistorys into monthly blocks.
+
+    Returns (next_cursor, more, packed_count). Safe to re-run on the same
+    cursor: blocks are written before the rows are deleted. Only run with
+    monthly storage on, or the packed days can't be read.
+    """
+    if not packedStorage():
+        raise ValueError("Set BALANCE_HISTORY_STORAGE to 'monthly' before packing")
+
+    keys, next_cursor, more = Profile.query().fetch_page(
+        page_size, start_cursor=cursor, keys_only=True)
+
+    #each Profile is its own entity group, so pack them side by side;
+    #a term of deletes is too many for one transaction
+    packed = [f.get_result() for f in [_packProfileAsync(k) for k in keys]]
+    row_keys = [k for rows in packed for k in rows]
+    ndb.delete_multi(row_keys)
+
+    return next_cursor, more, len(row_keys)
@@ -9,10 +9,15 @@ Elastic Republic server-side Python App Engine data & ProtoRPC models
 __author__ = 'mike.parziale@gmail.com (Michael Parziale)'
 
 import httplib
+import struct
+
 import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from ledger import Balance
+from ledger import Supply
+
 
 class Profile(ndb.Model):
     """Profile -- User profile object"""
@@ -21,7 +26,25 @@ class Profile(ndb.Model):
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     MostRecentBalanceHistoryKey = ndb.KeyProperty(kind='BalanceHistory')
+    # no longer written: active relations are queried by Relation.active
     activeRelationsKeys = ndb.KeyProperty(kind='Relation', repeated=True)
+    # materialized end of day balance as of balanceAsOfDate
+    balanceAsOfDate = ndb.DateProperty(indexed=False)
+    eodBalance = ndb.FloatProperty(indexed=False)
+    DailyNetIncomingBFlow = ndb.IntegerProperty(indexed=False)
+
+    @property
+    def balanceSnapshot(self):
+        """Materialized Balance, None for profiles saved before it existed."""
+        if self.balanceAsOfDate is None:
+            return None
+        return Balance(self.balanceAsOfDate, self.eodBalance, self.DailyNetIncomingBFlow)
+
+    def setBalanceSnapshot(self, balance):
+        """Materialize a Balance on the Profile."""
+        self.balanceAsOfDate = balance.date
+        self.eodBalance = balance.eodBalance
+        self.DailyNetIncomingBFlow = balance.DailyNetIncomingBFlow
 
 
 class ProfileMiniForm(messages.Message):
@@ -36,6 +59,8 @@ class ProfileForm(messages.Message):
     displayName = messages.StringField(2)
     mainEmail = messages.StringField(3)
     teeShirtSize = messages.EnumField('TeeShirtSize', 4)
+    etag = messages.StringField(5)
+    notModified = messages.BooleanField(6)#the client's etag is current; nothing else set
 
 
 class TeeShirtSize(messages.Enum):
@@ -63,9 +88,31 @@ class Relation(ndb.Model):
     contract        = ndb.StringProperty()
     constitUserId   = ndb.StringProperty()
     repUserId       = ndb.StringProperty(required=True)
-    startDate       = ndb.DateTimeProperty()
-    endDate         = ndb.DateTimeProperty()
+    startDate       = ndb.DateTimeProperty()#first day paid
+    endDate         = ndb.DateTimeProperty()#last day paid, None while open-ended
     version         = ndb.IntegerProperty()
+    active          = ndb.BooleanProperty(default=True)
+
+
+class RelationHead(ndb.Model):
+    """RelationHead -- stable reference to a Relation's current version"""
+    currentKey      = ndb.KeyProperty(kind='Relation', indexed=False)
+    currentVersion  = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def keyOf(cls, relation_key):
+        """Return the head key for any version's key."""
+        # versions are children of their head; a Relation saved before
+        # heads existed is version 1 of the head with its id
+        parent = relation_key.parent()
+        if parent and parent.kind() == cls._get_kind():
+            return parent
+        return ndb.Key(cls, relation_key.id())
+
+    @classmethod
+    def versionKey(cls, head_key, version):
+        """Return the key of one version of a Relation."""
+        return ndb.Key(Relation, version, parent=head_key)
 
 
 class RelationForm(messages.Message):
@@ -85,6 +132,40 @@ class RelationForm(messages.Message):
 class RelationForms(messages.Message):
     """RelationForms -- multiple Relation outbound form message"""
     items = messages.MessageField(RelationForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+
+class RelationResultForm(messages.Message):
+    """RelationResultForm -- one batch item's Relation or error outbound form message"""
+    relation        = messages.MessageField(RelationForm, 1)
+    error           = messages.StringField(2)
+
+class RelationResultForms(messages.Message):
+    """RelationResultForms -- batch Relation results, in request order, outbound form message"""
+    items = messages.MessageField(RelationResultForm, 1, repeated=True)
+
+class RelationQueryForm(messages.Message):
+    """RelationQueryForm -- one inbound Relation query filter message"""
+    field           = messages.StringField(1)#REP_USER_ID, CONSTIT_USER_ID, NAME, DAILY_RATE, ACTIVE
+    operator        = messages.StringField(2)#EQ, GT, GTEQ, LT, LTEQ
+    value           = messages.StringField(3)
+
+class RelationQueryForms(messages.Message):
+    """RelationQueryForms -- inbound Relation query, filters ANDed, message"""
+    filters         = messages.MessageField(RelationQueryForm, 1, repeated=True)
+    pageSize        = messages.IntegerField(2, variant=messages.Variant.INT32, default=100)
+    websafeCursor   = messages.StringField(3)
+
+class RelationPageForms(messages.Message):
+    """RelationPageForms -- one page of Relation outbound form message"""
+    items           = messages.MessageField(RelationForm, 1, repeated=True)
+    nextCursor      = messages.StringField(2)
+    more            = messages.BooleanField(3)
+
+class RelationKeyForm(messages.Message):
+    """RelationKeyForm -- inbound (single) Relation websafeKey message"""
+    websafeKey = messages.StringField(1, required=True)
+    endDate    = messages.StringField(2)#ISO date, last day paid, before today; default yesterday
 
 
 class BalanceHistory(ndb.Model):
@@ -93,7 +174,176 @@ class BalanceHistory(ndb.Model):
     eodBalance            = ndb.FloatProperty(required=True)
     DailyNetIncomingBFlow = ndb.IntegerProperty(required=True)
     relationsChangedKeys  = ndb.KeyProperty(kind='Relation', repeated=True)
-    
+
+    @classmethod
+    def keyFor(cls, profile_key, date):
+        """Return the key of a Profile's BalanceHistory for a date."""
+        # one level under the Profile, id = ISO date
+        return ndb.Key(cls, date.isoformat(), parent=profile_key)
+
+    @property
+    def balance(self):
+        """This day's Balance."""
+        return Balance(self.date, self.eodBalance, self.DailyNetIncomingBFlow)
+
+    @classmethod
+    def fromBalance(cls, profile_key, balance):
+        """New BalanceHistory for a Profile's Balance."""
+        return cls(key                   = cls.keyFor(profile_key, balance.date),
+                   date                  = balance.date,
+                   eodBalance            = balance.eodBalance,
+                   DailyNetIncomingBFlow = balance.DailyNetIncomingBFlow)
+
+    @property
+    def isChained(self):
+        """True for old keys nested under the previous day's BalanceHistory."""
+        return len(self.key.pairs()) > 2
+
+class BalanceHistoryBlock(ndb.Model):
+    """BalanceHistoryBlock -- a month of a Profile's BalanceHistorys packed in one entity"""
+    month                 = ndb.DateProperty(required=True)#first day of the month
+    present               = ndb.IntegerProperty(default=0, indexed=False)#bit n-1 set when day n is stored
+    days                  = ndb.BlobProperty(default='')#DAY_FORMAT per day of the month
+    relationsChangedDays  = ndb.IntegerProperty(repeated=True, indexed=False)#day of each key below
+    relationsChangedKeys  = ndb.KeyProperty(kind='Relation', repeated=True, indexed=False)
+
+    # eodBalance, DailyNetIncomingBFlow
+    DAY_FORMAT = struct.Struct('<dq')
+
+    @classmethod
+    def keyFor(cls, profile_key, date):
+        """Return the key of a Profile's block for a date's month."""
+        return ndb.Key(cls, date.strftime('%Y-%m'), parent=profile_key)
+
+    @classmethod
+    def forDate(cls, profile_key, date):
+        """New empty block for a Profile's month."""
+        return cls(key=cls.keyFor(profile_key, date), month=date.replace(day=1))
+
+    def hasDay(self, date):
+        """True if the block stores a BalanceHistory for date."""
+        return bool(self.present >> (date.day - 1) & 1)
+
+    def getDay(self, date):
+        """Unpack a day's BalanceHistory, None if the block doesn't store it."""
+        if not self.hasDay(date):
+            return None
+        eodBalance, flow = self.DAY_FORMAT.unpack_from(
+            self.days, (date.day - 1) * self.DAY_FORMAT.size)
+        return BalanceHistory(
+            key                   = BalanceHistory.keyFor(self.key.parent(), date),
+            date                  = date,
+            eodBalance            = eodBalance,
+            DailyNetIncomingBFlow = flow,
+            relationsChangedKeys  = [k for d, k in zip(self.relationsChangedDays,
+                                                       self.relationsChangedKeys)
+                                     if d == date.day])
+
+    def balanceHistorys(self, start=None, end=None):
+        """Yield the stored BalanceHistorys between start and end, unpacking each as it's reached."""
+        for day in xrange(1, 32):
+            if not self.present >> (day - 1) & 1:
+                continue
+            date = self.month.replace(day=day)
+            if (start and date < start) or (end and date > end):
+                continue
+            yield self.getDay(date)
+
+    def setDay(self, bal_hist):
+        """Pack a BalanceHistory into its day of the block."""
+        day, size = bal_hist.date.day, self.DAY_FORMAT.size
+        offset = (day - 1) * size
+        days = self.days.ljust(offset + size, '\0')
+        self.days = days[:offset] \
+                  + self.DAY_FORMAT.pack(bal_hist.eodBalance,
+                                         int(bal_hist.DailyNetIncomingBFlow)) \
+                  + days[offset + size:]
+        self.present |= 1 << (day - 1)
+
+        #relation keys are kept sparsely, replacing the day's old ones
+        changed = [(d, k) for d, k in zip(self.relationsChangedDays,
+                                          self.relationsChangedKeys) if d != day]
+        changed.extend((day, k) for k in bal_hist.relationsChangedKeys)
+        self.relationsChangedDays = [d for d, _ in changed]
+        self.relationsChangedKeys = [k for _, k in changed]
+
+class IncomingFlowShard(ndb.Model):
+    """IncomingFlowShard -- one shard of a user's new incoming ballot flow for a day"""
+    userId                = ndb.StringProperty(required=True)
+    date                  = ndb.DateProperty(required=True)
+    DailyNetIncomingBFlow = ndb.IntegerProperty(default=0, indexed=False)
+    relationsChangedKeys  = ndb.KeyProperty(kind='Relation', repeated=True, indexed=False)
+    pending               = ndb.BooleanProperty(default=True)#not yet folded into BalanceHistory
+
+    @classmethod
+    def keyFor(cls, user_id, date, index):
+        """Return the key of one of a user's shards for a date."""
+        return ndb.Key(cls, '%s|%s|%d' % (user_id, date.isoformat(), index))
+
+class BalanceRecompute(ndb.Model):
+    """BalanceRecompute -- a backdated flow change still being written to a Profile's BalanceHistorys, a child of the Profile"""
+    fromDate              = ndb.DateProperty(required=True, indexed=False)
+    throughDate           = ndb.DateProperty(required=True, indexed=False)
+    nextDate              = ndb.DateProperty(required=True, indexed=False)#first day not rewritten yet
+    DailyNetIncomingBFlow = ndb.IntegerProperty(required=True, indexed=False)
+    relationsChangedKeys  = ndb.KeyProperty(kind='Relation', repeated=True, indexed=False)
+
+class MoneySupplyShard(ndb.Model):
+    """MoneySupplyShard -- one shard of the global money supply"""
+    epochBalance          = ndb.FloatProperty(default=0.0, indexed=False)
+    DailyNetIncomingBFlow = ndb.IntegerProperty(default=0, indexed=False)
+    users                 = ndb.IntegerProperty(default=0, indexed=False)
+
+    @property
+    def supply(self):
+        return Supply(self.epochBalance, self.DailyNetIncomingBFlow, self.users)
+
+    def add(self, supply):
+        """Add a Supply to the shard."""
+        self.epochBalance, self.DailyNetIncomingBFlow, self.users = self.supply + supply
+
+class MoneySupplyReconciliation(ndb.Model):
+    """MoneySupplyReconciliation -- one run recomputing the money supply from every Profile"""
+    started          = ndb.DateTimeProperty(auto_now_add=True)
+    repair           = ndb.BooleanProperty(default=False, indexed=False)
+    # partial sums expected, known once each kind's fan-out is done
+    profilePages     = ndb.IntegerProperty(indexed=False)
+    shardPages       = ndb.IntegerProperty(indexed=False)
+    finished         = ndb.DateTimeProperty()
+    date             = ndb.DateProperty(indexed=False)
+    reconciled       = ndb.FloatProperty(indexed=False)
+    incremental      = ndb.FloatProperty(indexed=False)
+    difference       = ndb.FloatProperty(indexed=False)
+
+class MoneySupplyPartial(ndb.Model):
+    """MoneySupplyPartial -- one page's share of a reconciliation, a child of its run"""
+    epochBalance          = ndb.FloatProperty(default=0.0, indexed=False)
+    DailyNetIncomingBFlow = ndb.IntegerProperty(default=0, indexed=False)
+    users                 = ndb.IntegerProperty(default=0, indexed=False)
+
+    @property
+    def supply(self):
+        return Supply(self.epochBalance, self.DailyNetIncomingBFlow, self.users)
+
+class RelationExpiryRun(ndb.Model):
+    """RelationExpiryRun -- one run ending the Relations whose endDate has passed"""
+    day              = ndb.DateProperty(required=True)
+    started          = ndb.DateTimeProperty(auto_now_add=True)
+    # batches expected, known once the fan-out is done
+    batches          = ndb.IntegerProperty(indexed=False)
+    finished         = ndb.DateTimeProperty()
+    expired          = ndb.IntegerProperty(indexed=False)
+    skipped          = ndb.IntegerProperty(indexed=False)#ended or changed meanwhile
+    seconds          = ndb.FloatProperty(indexed=False)#started to finished
+    taskSeconds      = ndb.FloatProperty(indexed=False)#summed over batch tasks
+
+class RelationExpiryPartial(ndb.Model):
+    """RelationExpiryPartial -- one batch's results, a child of its run"""
+    expired          = ndb.IntegerProperty(default=0, indexed=False)
+    skipped          = ndb.IntegerProperty(default=0, indexed=False)
+    seconds          = ndb.FloatProperty(default=0.0, indexed=False)
+    rpcs             = ndb.IntegerProperty(default=0, indexed=False)
+
 class BalanceHistoryForm(messages.Message):
     """BalanceHistory -- User Balance History outbound form message"""
     date             = messages.StringField(1)
@@ -104,8 +354,86 @@ class BalanceHistoryForm(messages.Message):
 class BalanceHistoryForms(messages.Message):
     """BalanceHistoryForms -- multiple BalanceHistory outbound form message"""
     items = messages.MessageField(BalanceHistoryForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+
+class BalanceHistoryPageForm(messages.Message):
+    """BalanceHistoryPageForm -- inbound BalanceHistory page query message"""
+    pageSize         = messages.IntegerField(1, variant=messages.Variant.INT32, default=100)
+    websafeCursor    = messages.StringField(2)
+    startDate        = messages.StringField(3)#inclusive ISO dates
+    endDate          = messages.StringField(4)
+    summary          = messages.BooleanField(5, default=False)#date and eodBalance only
+
+class BalanceHistoryPageForms(messages.Message):
+    """BalanceHistoryPageForms -- one page of BalanceHistory outbound form message"""
+    items            = messages.MessageField(BalanceHistoryForm, 1, repeated=True)
+    nextCursor       = messages.StringField(2)
+    more             = messages.BooleanField(3)
+
+class BalanceForm(messages.Message):
+    """BalanceForm -- current balance outbound form message"""
+    userId           = messages.StringField(1)
+    date             = messages.StringField(2)
+    eodBalance       = messages.FloatField(3)
+    DailyNetIncomingBFlow = messages.IntegerField(4, variant=messages.Variant.INT32)
+
+class MoneySupplyForm(messages.Message):
+    """MoneySupplyForm -- global money supply outbound form message"""
+    date             = messages.StringField(1)
+    supply           = messages.FloatField(2)#sum of every end of day balance
+    users            = messages.IntegerField(3)
+    basicIncome      = messages.FloatField(4)#issued on date
+    moneyTax         = messages.FloatField(5)#taxed on date
+    DailyNetIncomingBFlow = messages.IntegerField(6)#should always be 0
+
+class ProjectionForm(messages.Message):
+    """ProjectionForm -- inbound balance projection message"""
+    days             = messages.IntegerField(1, variant=messages.Variant.INT32, default=1460)
+
+class CacheStatForm(messages.Message):
+    """CacheStatForm -- one view's cache counters outbound form message"""
+    view             = messages.StringField(1)
+    hits             = messages.IntegerField(2)
+    misses           = messages.IntegerField(3)
+    hitRate          = messages.FloatField(4)
+    notModified      = messages.IntegerField(5)#answered from the client's etag
+
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm -- view cache counters outbound form message"""
+    items            = messages.MessageField(CacheStatForm, 1, repeated=True)
+
+class MetricStatForm(messages.Message):
+    """MetricStatForm -- one metric's percentiles over recent calls outbound form message"""
+    name             = messages.StringField(1)
+    p50              = messages.FloatField(2)
+    p90              = messages.FloatField(3)
+    p99              = messages.FloatField(4)
+    max              = messages.FloatField(5)
+    mean             = messages.FloatField(6)
+
+class EndpointStatForm(messages.Message):
+    """EndpointStatForm -- one API method's recent call stats outbound form message"""
+    endpoint         = messages.StringField(1)
+    calls            = messages.IntegerField(2)
+    errors           = messages.IntegerField(3)
+    metrics          = messages.MessageField(MetricStatForm, 4, repeated=True)
+
+class ServerStatsRequestForm(messages.Message):
+    """ServerStatsRequestForm -- inbound server stats query message"""
+    raw              = messages.BooleanField(1, default=False)#every recent call in the JSON
+
+class ServerStatsForm(messages.Message):
+    """ServerStatsForm -- per API method stats outbound form message"""
+    items            = messages.MessageField(EndpointStatForm, 1, repeated=True)
+    json             = messages.StringField(2)
 
 class UserIDForm(messages.Message):
     """UserID-- inbound (single) string message"""
     userId = messages.StringField(1, required=True)
+    etag = messages.StringField(2)#of the response the client holds
+
+class ConditionalForm(messages.Message):
+    """ConditionalForm -- inbound etag of the response the client holds message"""
+    etag = messages.StringField(1)
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""oauth.py
+
+Elastic Republic OAuth bearer token to user id lookup on Google's
+tokeninfo endpoint, cached per instance and in memcache; imported by
+getUserId only in "oauth" mode, so other requests don't load urlfetch
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+import endpoints
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_DEADLINE = 5          # seconds for all tokeninfo attempts together
+TOKEN_CACHE_SIZE = 1000         # tokens kept per instance
+TOKEN_DEFAULT_TTL = 300         # seconds, when tokeninfo has no expires_in
+TOKEN_NEGATIVE_TTL = 60         # seconds to remember a rejected token
+
+# token cache hit/miss counters for this instance
+TOKEN_CACHE_STATS = collections.Counter()
+
+
+class TtlLruCache(object):
+    """Thread-safe in-process LRU cache of (value, expires_at) pairs."""
+
+    def __init__(self, size):
+        self._size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached (value, expires_at), or None if missing or expired."""
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or item[1] <= time.time():
+                return None
+            # re-insert as most recently used
+            self._items[key] = item
+            return item
+
+    def set(self, key, item):
+        """Cache a (value, expires_at) pair, evicting the least recently used."""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = item
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+_token_cache = TtlLruCache(TOKEN_CACHE_SIZE)
+
+
+def _tokenCacheKey(token):
+    """Cache key for a bearer token; the token itself is never stored."""
+    return 'tokeninfo:' + hashlib.sha256(token).hexdigest()
+
+
+@ndb.tasklet
+def _fetchTokenInfoAsync(token):
+    """Look a bearer token up on the tokeninfo endpoint.
+
+    Returns its info, {} when tokeninfo rejects it, or None when
+    tokeninfo couldn't be reached within the deadline.
+    """
+    token_type = 'id_token'
+    if 'OAUTH_USER_ID' in os.environ:
+        token_type = 'access_token'
+    ctx = ndb.get_context()
+    deadline = time.time() + TOKENINFO_DEADLINE
+    wait = 1
+    for i in range(3):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            resp = yield ctx.urlfetch(TOKENINFO_URL % (token_type, token),
+                                      deadline=remaining)
+        except urlfetch.Error:
+            resp = None
+        if resp and resp.status_code == 200:
+            raise ndb.Return(json.loads(resp.content))
+        elif resp and resp.status_code == 400 and 'invalid_token' in resp.content:
+            if token_type == 'access_token':
+                # not an id token nor an access token
+                raise ndb.Return({})
+            token_type = 'access_token'
+        else:
+            # back off without holding the thread, within the deadline
+            yield ndb.sleep(max(0, min(wait, deadline - time.time())))
+            wait = wait + i
+    raise ndb.Return(None)
+
+
+@ndb.tasklet
+def getOAuthUserIdAsync():
+    """Get the user id for the request's bearer token, caching tokeninfo."""
+    auth = os.getenv('HTTP_AUTHORIZATION')
+    bearer, token = auth.split()
+    cache_key = _tokenCacheKey(token)
+
+    # tier 1: this instance
+    item = _token_cache.get(cache_key)
+    if item is not None:
+        TOKEN_CACHE_STATS['localHits'] += 1
+        raise ndb.Return(item[0])
+
+    # tier 2: memcache, shared by all instances
+    ctx = ndb.get_context()
+    item = yield ctx.memcache_get(cache_key)
+    if item is not None and item[1] > time.time():
+        TOKEN_CACHE_STATS['memcacheHits'] += 1
+        _token_cache.set(cache_key, item)
+        raise ndb.Return(item[0])
+
+    TOKEN_CACHE_STATS['misses'] += 1
+    info = yield _fetchTokenInfoAsync(token)
+    if info is None:
+        # unreachable isn't rejected: nothing is cached, the next call retries
+        TOKEN_CACHE_STATS['errors'] += 1
+        raise endpoints.InternalServerErrorException(
+            'Could not check the bearer token, try again')
+    user_id = info.get('user_id', '')
+    if user_id:
+        ttl = int(info.get('expires_in', TOKEN_DEFAULT_TTL))
+    else:
+        # negative cache so a rejected token doesn't refetch on every call
+        TOKEN_CACHE_STATS['failures'] += 1
+        ttl = TOKEN_NEGATIVE_TTL
+    item = (user_id, time.time() + ttl)
+    _token_cache.set(cache_key, item)
+    yield ctx.memcache_set(cache_key, item, time=ttl)
+    raise ndb.Return(user_id)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""recompute.py
+
+Elastic Republic backdated flow changes: a Profile's balance takes the
+change at once, in closed form, and its BalanceHistorys from the change
+on are rewritten a chunk of days per task, restartably
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from balances import balanceHistorysAsync
+from balances import getBalanceAsync
+from balances import missedBalanceHistorys
+from balances import putBalanceHistorysAsync
+from cache import bumpGenerationsAsync
+from ledger import Supply
+from ledger import flowBalance
+from models import BalanceRecompute
+
+RECOMPUTE_QUEUE = 'recompute'
+RECOMPUTE_URL = '/tasks/recompute'
+
+RECOMPUTE_CHUNK_DAYS = 120      # BalanceHistory days rewritten per transaction
+
+
+def _queueChunk(job_key):
+    """Queue a job's next chunk with the transaction that saves the job."""
+    taskqueue.add(url=RECOMPUTE_URL, queue_name=RECOMPUTE_QUEUE,
+                  params={'job': job_key.urlsafe()}, transactional=True)
+
+
+@ndb.tasklet
+def backdateFlowAsync(profile, flow, date, relation_keys):
+    """Change a Profile's flow from a past date on; call in a transaction.
+
+    The Profile's balance changes now and the caller saves it; days
+    already in its BalanceHistory are rewritten by a queued
+    BalanceRecompute, days not written yet are written up to the
+    change's. Returns the change in the money supply.
+    """
+    balance = yield getBalanceAsync(profile)
+    before = Supply.ofBalance(balance)
+    written_through = balance.date
+
+    if date > written_through:
+        #a balance from before the change: the days up to it are written
+        #now, the change's recording its relations, and the balance
+        #moves to its day
+        bal_hists = missedBalanceHistorys(profile.key, balance, date,
+                                          {date: (flow, relation_keys)})
+        yield putBalanceHistorysAsync(bal_hists)
+        balance = bal_hists[-1].balance
+        profile.MostRecentBalanceHistoryKey = bal_hists[-1].key
+    else:
+        # the days between the change and the balance each gain what the
+        # flow adds by then, flowBalance, rather than being replayed
+        balance = balance.withFlowFrom(date, flow)
+    profile.setBalanceSnapshot(balance)
+
+    if date <= written_through:
+        job = BalanceRecompute(parent=profile.key, fromDate=date, nextDate=date,
+                               throughDate=written_through,
+                               DailyNetIncomingBFlow=flow,
+                               relationsChangedKeys=relation_keys)
+        yield job.put_async()
+        _queueChunk(job.key)
+    raise ndb.Return(Supply.ofBalance(balance) - before)
+
+
+@ndb.transactional_tasklet
+def _recomputeChunkAsync(job_key):
+    """Rewrite a job's next chunk of days and move its progress marker past them."""
+    job = yield job_key.get_async()
+    if job is None:
+        #finished by an earlier run of this task
+        raise ndb.Return((0, False))
+
+    end = min(job.nextDate + datetime.timedelta(days=RECOMPUTE_CHUNK_DAYS - 1),
+              job.throughDate)
+    bal_hists = yield balanceHistorysAsync(job_key.parent(), job.nextDate, end)
+    for bal_hist in bal_hists:
+        bal_hist.eodBalance += flowBalance(job.DailyNetIncomingBFlow,
+                                           (bal_hist.date - job.fromDate).days + 1)
+        bal_hist.DailyNetIncomingBFlow += job.DailyNetIncomingBFlow
+        if bal_hist.date == job.fromDate:
+            bal_hist.relationsChangedKeys.extend(job.relationsChangedKeys)
+
+    #the rows and the marker commit together, so a retry starts where
+    #the last committed chunk ended
+    job.nextDate = end + datetime.timedelta(days=1)
+    more = job.nextDate <= job.throughDate
+    if more:
+        yield putBalanceHistorysAsync(bal_hists), job.put_async()
+        _queueChunk(job_key)
+    else:
+        yield putBalanceHistorysAsync(bal_hists), job_key.delete_async()
+    raise ndb.Return((len(bal_hists), more))
+
+
+def recomputeChunk(job_key):
+    """Apply one chunk of a backdated change; returns (days rewritten, more to do)."""
+    days, more = _recomputeChunkAsync(job_key).get_result()
+    #the rewritten days change the user's BalanceHistory view and its etag
+    if days:
+        bumpGenerationsAsync([job_key.parent().id()]).get_result()
+    return days, more
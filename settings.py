@@ -12,3 +12,11 @@ WEB_CLIENT_ID = '30999085566-7afq567jnhmbd95csrtbqfihpli8289p.apps.googleusercon
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# emails allowed to call the admin-only API methods
+ADMIN_EMAILS = ()
+
+# BalanceHistory storage: 'daily' saves one entity per day, 'monthly'
+# packs a month of days into one BalanceHistoryBlock; switch to
+# 'monthly' before running /tasks/migrate/pack_balance_history
+BALANCE_HISTORY_STORAGE = 'daily'
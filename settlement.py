@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""settlement.py
+
+Elastic Republic nightly ledger settlement: advances every Profile's
+BalanceHistory to the settlement day, fanned out over the task queue
+so user requests never pay for catch-up
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from balances import balanceHistorysAsync
+from balances import getBalanceAsync
+from balances import missedBalanceHistorys
+from balances import putBalanceHistorysAsync
+from cache import bumpGenerationsAsync
+from counters import FOLD_SHARDS_PER_TXN
+from counters import addMoneySupplyAsync
+from counters import getPendingFlowShardsAsync
+from counters import withPendingFlows
+from ledger import Supply
+from ledger import flowBalance
+from models import Profile
+from stats import RpcCounter
+
+SETTLEMENT_QUEUE = 'settlement'
+FANOUT_URL = '/tasks/settlement/fanout'
+SETTLE_URL = '/tasks/settlement/batch'
+
+SETTLEMENT_PAGE_SIZE = 1000     # Profile keys read per fan-out task
+SETTLEMENT_BATCH_SIZE = 100     # Profiles settled per settlement task
+SETTLEMENT_TXN_SIZE = 20        # Profiles per cross-group transaction (25 max)
+SETTLEMENT_TXN_ROWS = 500       # BalanceHistorys per transaction, past its first Profile
+
+
+def _addTasks(tasks):
+    """Add named tasks, skipping ones a retried task already added."""
+    queue = taskqueue.Queue(SETTLEMENT_QUEUE)
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+def startSettlement(day):
+    """Queue the first fan-out page of a settlement run for day."""
+    _addTasks([taskqueue.Task(url=FANOUT_URL,
+                              name='settle-%s-page-0' % day.isoformat(),
+                              params={'day': day.isoformat(), 'page': 0})])
+
+
+def fanOutSettlementPage(day, page, cursor=None):
+    """Queue settlement tasks for one page of Profile keys, then the next page."""
+    keys, next_cursor, more = Profile.query().fetch_page(
+        SETTLEMENT_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+
+    #task names make a retried fan-out page queue nothing twice
+    tasks = []
+    for i in range(0, len(keys), SETTLEMENT_BATCH_SIZE):
+        tasks.append(taskqueue.Task(
+            url=SETTLE_URL,
+            name='settle-%s-%d-%d' % (day.isoformat(), page, i // SETTLEMENT_BATCH_SIZE),
+            params={'day': day.isoformat(),
+                    'key': [k.urlsafe() for k in keys[i:i + SETTLEMENT_BATCH_SIZE]]}))
+
+    if more and next_cursor:
+        tasks.append(taskqueue.Task(
+            url=FANOUT_URL,
+            name='settle-%s-page-%d' % (day.isoformat(), page + 1),
+            params={'day': day.isoformat(), 'page': page + 1,
+                    'cursor': next_cursor.urlsafe()}))
+    _addTasks(tasks)
+    return len(keys)
+
+
+@ndb.transactional_tasklet(xg=True)
+def _advanceProfilesAsync(pending):
+    """Move each Profile's balance to the last of its settled BalanceHistorys."""
+    profiles = yield ndb.get_multi_async(pending.keys())
+    to_put, bal_hists = [], []
+    for profile in profiles:
+        if profile is None:
+            continue
+        marker, missed = pending[profile.key]
+        #the balance is the idempotency marker: if it changed since the rows
+        #were built, a retried task, a relation change or a backdated flow
+        #got there first, and none of the rows are written
+        if (profile.balanceSnapshot, profile.MostRecentBalanceHistoryKey) != marker:
+            continue
+        #a balance carried forward is the same share of the money
+        #supply, so the supply shards aren't written
+        profile.setBalanceSnapshot(missed[-1].balance)
+        profile.MostRecentBalanceHistoryKey = missed[-1].key
+        to_put.append(profile)
+        bal_hists.extend(missed)
+    yield ndb.put_multi_async(to_put), putBalanceHistorysAsync(bal_hists)
+    raise ndb.Return(len(to_put))
+
+
+def _settlementChunks(pending):
+    """Split pending Profiles into transactions bounded in Profiles and rows."""
+    chunk, rows = {}, 0
+    for key, (marker, missed) in pending.items():
+        if chunk and (len(chunk) == SETTLEMENT_TXN_SIZE or
+                      rows + len(missed) > SETTLEMENT_TXN_ROWS):
+            yield chunk
+            chunk, rows = {}, 0
+        chunk[key] = (marker, missed)
+        rows += len(missed)
+    if chunk:
+        yield chunk
+
+
+@ndb.transactional_tasklet(xg=True)
+def _foldIncomingFlowAsync(profile_key, shard_keys, day):
+    """Fold incoming flow shards into a Profile's BalanceHistory and settle it to day."""
+    entities = yield ndb.get_multi_async([profile_key] + shard_keys)
+    profile = entities[0]
+    shards = [s for s in entities[1:] if s and s.pending]
+    balance = yield getBalanceAsync(profile)
+    to_put = []
+    #the shards' flows move from the shards to the profile's balance
+    supply = -Supply.ofBalance(balance)
+    for shard in shards:
+        supply -= Supply.ofFlow(shard.date, shard.DailyNetIncomingBFlow)
+
+    #shards from days already written: add their flow to those days' rows
+    retro = [s for s in shards if s.date <= balance.date]
+    if retro:
+        bal_hists = yield balanceHistorysAsync(profile_key,
+                                               start=min(s.date for s in retro))
+        for bal_hist in bal_hists:
+            for shard in retro:
+                if shard.date <= bal_hist.date:
+                    bal_hist.eodBalance += flowBalance(shard.DailyNetIncomingBFlow,
+                                                       (bal_hist.date - shard.date).days + 1)
+                    bal_hist.DailyNetIncomingBFlow += shard.DailyNetIncomingBFlow
+                if shard.date == bal_hist.date:
+                    bal_hist.relationsChangedKeys.extend(shard.relationsChangedKeys)
+            to_put.append(bal_hist)
+        balance = withPendingFlows(balance, retro)
+
+    #later shards start on their day as the missed days are built
+    flow_changes = {}
+    for shard in shards:
+        if shard.date > balance.date:
+            flow, relation_keys = flow_changes.get(shard.date, (0, []))
+            flow_changes[shard.date] = (flow + shard.DailyNetIncomingBFlow,
+                                        relation_keys + shard.relationsChangedKeys)
+    bal_hists = missedBalanceHistorys(profile_key, balance, day, flow_changes)
+    if bal_hists:
+        balance = bal_hists[-1].balance
+        profile.MostRecentBalanceHistoryKey = bal_hists[-1].key
+        to_put.extend(bal_hists)
+    profile.setBalanceSnapshot(balance)
+    supply += Supply.ofBalance(balance)
+
+    #folded shards are never counted again
+    for shard in shards:
+        shard.pending = False
+    yield (ndb.put_multi_async([profile] + shards), putBalanceHistorysAsync(to_put),
+           addMoneySupplyAsync(supply))
+
+
+def _foldAndSettle(profile_key, shards, day):
+    """Fold a Profile's pending shards, oldest first, and settle it to day."""
+    shard_keys = [s.key for s in sorted(shards, key=lambda s: s.date)]
+    for i in range(0, len(shard_keys), FOLD_SHARDS_PER_TXN):
+        _foldIncomingFlowAsync(profile_key, shard_keys[i:i + FOLD_SHARDS_PER_TXN],
+                               day).get_result()
+
+
+def settleProfiles(profile_keys, day):
+    """Advance each Profile's BalanceHistory to day, returning how many moved."""
+    profiles = [p for p in ndb.get_multi(profile_keys) if p]
+    balances = [getBalanceAsync(p) for p in profiles]
+    #shards from the settlement day on can still be added to
+    shards = [getPendingFlowShardsAsync(p.key.id(), before=day) for p in profiles]
+
+    pending = {}
+    folded = 0
+    for profile, balance, user_shards in zip(profiles, balances, shards):
+        balance, user_shards = balance.get_result(), user_shards.get_result()
+        if user_shards:
+            #representatives with new incoming flow settle on their own
+            _foldAndSettle(profile.key, user_shards, day)
+            folded += 1
+            continue
+
+        bal_hists = missedBalanceHistorys(profile.key, balance, day)
+        if not bal_hists:
+            #already settled
+            continue
+        #a backdated change can alter the balance but not its date
+        marker = (profile.balanceSnapshot, profile.MostRecentBalanceHistoryKey)
+        pending[profile.key] = (marker, bal_hists)
+
+    #the missed rows are saved with the balance, transactionally, so a
+    #backdated flow committed since they were built can't be overwritten
+    futures = [_advanceProfilesAsync(chunk) for chunk in _settlementChunks(pending)]
+    settled = folded + sum(f.get_result() for f in futures)
+
+    #settled balances and history are new to the users' cached views
+    bumpGenerationsAsync([p.key.id() for p in profiles]).get_result()
+    return settled
+
+
+def settleBatch(profile_keys, day):
+    """Settle one task's batch of Profiles and log its throughput."""
+    start = time.time()
+    with RpcCounter() as rpcs:
+        settled = settleProfiles(profile_keys, day)
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info('Settled %d of %d profiles to %s in %.2fs: %.1f users/s, %.1f RPCs/user',
+                 settled, len(profile_keys), day, elapsed,
+                 len(profile_keys) / elapsed,
+                 float(rpcs.total) / max(len(profile_keys), 1))
+    return settled
@@ -240,14 +240,15 @@
         ];
 
         $scope.filtereableFields = [
-            {enumValue: 'CITY', displayName: 'City'},
-            {enumValue: 'TOPIC', displayName: 'Topic'},
-            {enumValue: 'MONTH', displayName: 'Start month'},
-            {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'}
+            {enumValue: 'REP_USER_ID', displayName: 'Representative'},
+            {enumValue: 'CONSTIT_USER_ID', displayName: 'Constituent'},
+            {enumValue: 'NAME', displayName: 'Name'},
+            {enumValue: 'DAILY_RATE', displayName: 'Daily rate'},
+            {enumValue: 'ACTIVE', displayName: 'Active (true/false)'}
         ]
 
         /**
-         * Possible operators.
+         * Possible operators; only Daily rate takes the range ones.
          *
          * @type {{displayName: string, enumValue: string}[]}
          */
@@ -256,8 +257,7 @@
             {displayName: '>', enumValue: 'GT'},
             {displayName: '>=', enumValue: 'GTEQ'},
             {displayName: '<', enumValue: 'LT'},
-            {displayName: '<=', enumValue: 'LTEQ'},
-            {displayName: '!=', enumValue: 'NE'}
+            {displayName: '<=', enumValue: 'LTEQ'}
         ];
 
         /**
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""stats.py
+
+Elastic Republic API call instrumentation
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import collections
+import functools
+import json
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+STATS_SAMPLES = 500     # most recent calls kept per endpoint, per instance
+
+# API call -> kind of RPC it's counted as; other calls count by service
+RPC_KINDS = {
+    'datastore_v3.Get': 'get',
+    'datastore_v3.Put': 'put',
+    'datastore_v3.Delete': 'delete',
+    'datastore_v3.RunQuery': 'query',
+    'datastore_v3.Next': 'query',
+    'datastore_v3.AllocateIds': 'allocate',
+    'datastore_v3.BeginTransaction': 'txn',
+    'datastore_v3.Commit': 'txn',
+    'datastore_v3.Rollback': 'txn',
+    'urlfetch.Fetch': 'urlfetch',
+}
+
+# per call metrics summarized by serverStats
+METRICS = ('ms', 'rpcs', 'get', 'put', 'delete', 'query', 'allocate', 'txn',
+           'memcache', 'urlfetch', 'entitiesRead', 'entitiesWritten', 'daysReplayed')
+
+_local = threading.local()
+
+_calls = collections.defaultdict(lambda: collections.deque(maxlen=STATS_SAMPLES))
+_calls_lock = threading.Lock()
+
+
+def _countRpc(service, call, request, response):
+    """apiproxy pre-call hook: count the call on this thread's counters."""
+    for counter in getattr(_local, 'counters', ()):
+        counter.calls['%s.%s' % (service, call)] += 1
+
+
+def _countRpcResult(service, call, request, response):
+    """apiproxy post-call hook: count the entities a Datastore call read or wrote."""
+    counters = getattr(_local, 'counters', ())
+    if not counters or service != 'datastore_v3':
+        return
+    read = written = 0
+    if call == 'Get':
+        read = sum(1 for e in response.entity_list() if e.has_entity())
+    elif call in ('RunQuery', 'Next'):
+        read = response.result_size()
+    elif call == 'Put':
+        written = request.entity_size()
+    elif call == 'Delete':
+        written = request.key_size()
+    for counter in counters:
+        counter.entitiesRead += read
+        counter.entitiesWritten += written
+
+
+def countDaysReplayed(days):
+    """Count BalanceHistory days built by catch-up on this thread's counters."""
+    for counter in getattr(_local, 'counters', ()):
+        counter.daysReplayed += days
+
+
+class RpcCounter(object):
+    """Count API calls made by this thread inside a with block."""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.entitiesRead = 0
+        self.entitiesWritten = 0
+        self.daysReplayed = 0
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+    @property
+    def byKind(self):
+        """Calls counted by RPC_KINDS kind."""
+        kinds = collections.Counter()
+        for call, count in self.calls.items():
+            kinds[RPC_KINDS.get(call, call.split('.')[0])] += count
+        return kinds
+
+    def __enter__(self):
+        # the hooks are keyed, so re-appending them is a no-op; appending here
+        # rather than at import also covers a testbed's fresh apiproxy
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('stats', _countRpc)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('stats', _countRpcResult)
+        if not hasattr(_local, 'counters'):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.counters.remove(self)
+
+
+def _record(name, seconds, rpcs, error):
+    """Keep one call's metrics among its endpoint's recent calls."""
+    call = dict(rpcs.byKind)
+    call.update(ms=seconds * 1000, rpcs=rpcs.total, error=error,
+                entitiesRead=rpcs.entitiesRead,
+                entitiesWritten=rpcs.entitiesWritten,
+                daysReplayed=rpcs.daysReplayed)
+    with _calls_lock:
+        _calls[name].append(call)
+
+
+def instrumented(method):
+    """Record wall time, RPCs and entities of each call to an API method."""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start, error = time.time(), True
+        with RpcCounter() as rpcs:
+            try:
+                result = method(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                _record(method.__name__, time.time() - start, rpcs, error)
+    return wrapper
+
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of an ordered list."""
+    return ordered[max(0, int(round(fraction * len(ordered))) - 1)]
+
+
+def serverStats():
+    """Summarize each endpoint's recent calls: percentiles per metric."""
+    with _calls_lock:
+        calls = dict((name, list(samples)) for name, samples in _calls.items())
+
+    summary = {}
+    for name, samples in calls.items():
+        metrics = {}
+        for metric in METRICS:
+            values = sorted(s.get(metric, 0) for s in samples)
+            metrics[metric] = {
+                'p50': float(_percentile(values, 0.50)),
+                'p90': float(_percentile(values, 0.90)),
+                'p99': float(_percentile(values, 0.99)),
+                'max': float(values[-1]),
+                'mean': float(sum(values)) / len(values),
+            }
+        summary[name] = {'calls': len(samples),
+                         'errors': sum(1 for s in samples if s['error']),
+                         'metrics': metrics}
+    return summary
+
+
+def statsJson(raw=False):
+    """This instance's stats as JSON, with every recent call when raw."""
+    dump = {'summary': serverStats()}
+    if raw:
+        with _calls_lock:
+            dump['calls'] = dict((name, list(samples)) for name, samples in _calls.items())
+    return json.dumps(dump, sort_keys=True)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""supply.py
+
+Elastic Republic money supply reconciliation: recomputes the supply from
+every Profile's balance and every pending flow shard, over cursor ranges
+summed in parallel on the task queue, and checks it against the sharded
+figure the API keeps up to date
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from balances import getBalanceAsync
+from counters import addMoneySupplyAsync
+from counters import getMoneySupplyAsync
+from ledger import NO_SUPPLY
+from ledger import Supply
+from models import IncomingFlowShard
+from models import MoneySupplyPartial
+from models import MoneySupplyReconciliation
+from models import Profile
+
+SUPPLY_QUEUE = 'supply'
+FANOUT_URL = '/tasks/supply/fanout'
+SUM_URL = '/tasks/supply/sum'
+
+SUPPLY_PAGE_SIZE = 500      # entities summed per task
+
+# kinds summed, and the run property counting each one's pages
+KINDS = ('Profile', 'IncomingFlowShard')
+PAGES_PROPERTY = {'Profile': 'profilePages', 'IncomingFlowShard': 'shardPages'}
+
+
+def _query(kind):
+    """Query for the entities of a kind that hold part of the supply."""
+    if kind == 'Profile':
+        return Profile.query()
+    return IncomingFlowShard.query(IncomingFlowShard.pending == True)
+
+
+def _addTasks(tasks):
+    """Add named tasks, skipping ones a retried task already added."""
+    try:
+        taskqueue.Queue(SUPPLY_QUEUE).add(tasks)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def startReconciliation(repair=False):
+    """Start a reconciliation run, returning its key.
+
+    With repair, the sharded supply is corrected by the difference
+    found; run it that way once to seed the supply from profiles saved
+    before it was kept, and when no relations are changing.
+    """
+    run_key = MoneySupplyReconciliation(repair=repair).put()
+    _addTasks([taskqueue.Task(url=FANOUT_URL,
+                              name='supply-%d-%s-page-0' % (run_key.id(), kind),
+                              params={'run': run_key.id(), 'kind': kind, 'page': 0})
+               for kind in KINDS])
+    return run_key
+
+
+def fanOutReconciliationPage(run_key, kind, page, cursor=None):
+    """Queue the sum of one cursor range of a kind, then the next range."""
+    keys, next_cursor, more = _query(kind).fetch_page(
+        SUPPLY_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+    more = more and next_cursor is not None
+
+    # the range runs from this page's cursor to the next one's
+    params = {'run': run_key.id(), 'kind': kind, 'page': page}
+    sum_params = dict(params)
+    if cursor:
+        sum_params['start'] = cursor.urlsafe()
+    if more:
+        sum_params['end'] = next_cursor.urlsafe()
+    tasks = [taskqueue.Task(url=SUM_URL,
+                            name='supply-%d-%s-sum-%d' % (run_key.id(), kind, page),
+                            params=sum_params)]
+    if more:
+        params.update(page=page + 1, cursor=next_cursor.urlsafe())
+        tasks.append(taskqueue.Task(url=FANOUT_URL,
+                                    name='supply-%d-%s-page-%d' % (run_key.id(), kind, page + 1),
+                                    params=params))
+    _addTasks(tasks)
+
+    if not more:
+        _setPagesAsync(run_key, kind, page + 1).get_result()
+        finishReconciliation(run_key)
+    return len(keys)
+
+
+@ndb.transactional_tasklet
+def _setPagesAsync(run_key, kind, pages):
+    """Record how many partial sums of a kind a run has."""
+    run = yield run_key.get_async()
+    setattr(run, PAGES_PROPERTY[kind], pages)
+    yield run.put_async()
+
+
+def sumReconciliationPage(run_key, kind, page, start=None, end=None):
+    """Sum one cursor range's share of the supply into a partial of the run."""
+    entities = _query(kind).fetch(start_cursor=start, end_cursor=end)
+    supply = NO_SUPPLY
+    if kind == 'Profile':
+        balances = [getBalanceAsync(p) for p in entities]
+        for balance in balances:
+            supply += Supply.ofBalance(balance.get_result())
+    else:
+        for shard in entities:
+            supply += Supply.ofFlow(shard.date, shard.DailyNetIncomingBFlow)
+
+    # keyed by range, so a retried task writes the same partial
+    epochBalance, flow, users = supply
+    MoneySupplyPartial(parent=run_key, id='%s-%d' % (kind, page),
+                       epochBalance=epochBalance, DailyNetIncomingBFlow=flow,
+                       users=users).put()
+    finishReconciliation(run_key)
+    return len(entities)
+
+
+def finishReconciliation(run_key):
+    """Compare the recomputed supply with the sharded one once every partial is in."""
+    run = run_key.get()
+    if run.finished or run.profilePages is None or run.shardPages is None:
+        return
+    partials = MoneySupplyPartial.query(ancestor=run_key).fetch()
+    if len(partials) < run.profilePages + run.shardPages:
+        return
+
+    reconciled = NO_SUPPLY
+    for partial in partials:
+        reconciled += partial.supply
+    today = datetime.date.today()
+
+    @ndb.tasklet
+    def txn():
+        run = yield run_key.get_async()
+        if run.finished:
+            #another partial finished the run first
+            raise ndb.Return(None)
+        incremental = yield getMoneySupplyAsync()
+        run.finished = datetime.datetime.now()
+        run.date = today
+        run.reconciled = reconciled.on(today)
+        run.incremental = incremental.on(today)
+        run.difference = run.reconciled - run.incremental
+        if run.repair:
+            yield addMoneySupplyAsync(reconciled - incremental)
+        yield run.put_async()
+        raise ndb.Return(run)
+
+    run = ndb.transaction_async(txn, xg=True).get_result()
+    if run:
+        logging.info('Money supply on %s: %.2f reconciled, %.2f incremental, '
+                     '%.2f difference%s', today, run.reconciled, run.incremental,
+                     run.difference, ' (repaired)' if run.repair else '')
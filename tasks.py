@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""tasks.py
+
+Elastic Republic admin, cron and push queue task handlers
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import datetime
+import logging
+
+import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from expiry import expireBatch
+from expiry import fanOutExpiryPage
+from expiry import startExpiry
+from migrations import backfillRelationActivePage
+from migrations import flattenBalanceHistoryPage
+from migrations import packBalanceHistoryPage
+from models import MoneySupplyReconciliation
+from models import RelationExpiryRun
+from recompute import recomputeChunk
+from settlement import fanOutSettlementPage
+from settlement import settleBatch
+from settlement import startSettlement
+from supply import fanOutReconciliationPage
+from supply import startReconciliation
+from supply import sumReconciliationPage
+
+
+def _cursorParam(request):
+    """Cursor from a task's 'cursor' param, None when not given."""
+    websafe_cursor = request.get('cursor')
+    return Cursor(urlsafe=websafe_cursor) if websafe_cursor else None
+
+
+def _runParam(request, run_class=MoneySupplyReconciliation):
+    """Run key, a MoneySupplyReconciliation's by default, from a task's 'run' param."""
+    return ndb.Key(run_class, int(request.get('run')))
+
+
+def _dayParam(request):
+    """Date from a task's ISO 'day' param."""
+    return datetime.datetime.strptime(request.get('day'), '%Y-%m-%d').date()
+
+
+class FlattenBalanceHistoryHandler(webapp2.RequestHandler):
+    """Migrate chained BalanceHistory keys a page per task."""
+
+    def get(self):
+        """Start (or resume from ?cursor=) the migration."""
+        taskqueue.add(url=self.request.path,
+                      params={'cursor': self.request.get('cursor')})
+        self.response.write('BalanceHistory key migration queued')
+
+    def post(self):
+        """Migrate one page then queue the next one."""
+        next_cursor, more, moved = flattenBalanceHistoryPage(_cursorParam(self.request))
+        logging.info('Flattened %d BalanceHistory keys', moved)
+
+        #a failed page is retried by the queue with the same cursor
+        if more and next_cursor:
+            taskqueue.add(url=self.request.path,
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            logging.info('BalanceHistory key migration done')
+
+
+class BackfillRelationActiveHandler(webapp2.RequestHandler):
+    """Index every Relation's active flag a page per task."""
+
+    def get(self):
+        """Start (or resume from ?cursor=) the backfill."""
+        taskqueue.add(url=self.request.path,
+                      params={'cursor': self.request.get('cursor')})
+        self.response.write('Relation active flag backfill queued')
+
+    def post(self):
+        """Backfill one page then queue the next one."""
+        next_cursor, more, saved = backfillRelationActivePage(_cursorParam(self.request))
+        logging.info('Backfilled active flag on %d Relations', saved)
+
+        if more and next_cursor:
+            taskqueue.add(url=self.request.path,
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            logging.info('Relation active flag backfill done')
+
+
+class PackBalanceHistoryHandler(webapp2.RequestHandler):
+    """Pack daily BalanceHistorys into monthly blocks a page of Profiles per task."""
+
+    def get(self):
+        """Start (or resume from ?cursor=) the migration."""
+        taskqueue.add(url=self.request.path,
+                      params={'cursor': self.request.get('cursor')})
+        self.response.write('BalanceHistory packing queued')
+
+    def post(self):
+        """Pack one page then queue the next one."""
+        next_cursor, more, packed = packBalanceHistoryPage(_cursorParam(self.request))
+        logging.info('Packed %d BalanceHistorys into blocks', packed)
+
+        if more and next_cursor:
+            taskqueue.add(url=self.request.path,
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            logging.info('BalanceHistory packing done')
+
+
+class StartSettlementHandler(webapp2.RequestHandler):
+    """Cron: settle every Profile's BalanceHistory up to today."""
+
+    def get(self):
+        startSettlement(datetime.date.today())
+        self.response.write('Settlement queued')
+
+
+class SettlementFanOutHandler(webapp2.RequestHandler):
+    """Queue settlement batches for one page of Profiles."""
+
+    def post(self):
+        count = fanOutSettlementPage(_dayParam(self.request),
+                                     int(self.request.get('page')),
+                                     _cursorParam(self.request))
+        logging.info('Queued settlement for %d profiles', count)
+
+
+class SettleBatchHandler(webapp2.RequestHandler):
+    """Settle one batch of Profiles."""
+
+    def post(self):
+        profile_keys = [ndb.Key(urlsafe=k) for k in self.request.get_all('key')]
+        settleBatch(profile_keys, _dayParam(self.request))
+
+
+class RecomputeBalanceHandler(webapp2.RequestHandler):
+    """Write one chunk of a backdated flow change to a Profile's BalanceHistorys."""
+
+    def post(self):
+        # the next chunk is queued by the transaction that wrote this one
+        days, more = recomputeChunk(ndb.Key(urlsafe=self.request.get('job')))
+        logging.info('Recomputed %d BalanceHistory days%s', days, '' if more else ', done')
+
+
+class StartReconciliationHandler(webapp2.RequestHandler):
+    """Cron: recompute the money supply and check the sharded figure (?repair=1 corrects it)."""
+
+    def get(self):
+        run_key = startReconciliation(repair=self.request.get('repair') == '1')
+        self.response.write('Money supply reconciliation %d queued' % run_key.id())
+
+
+class ReconciliationFanOutHandler(webapp2.RequestHandler):
+    """Queue the sum of one range of Profiles or flow shards."""
+
+    def post(self):
+        count = fanOutReconciliationPage(_runParam(self.request), self.request.get('kind'),
+                                         int(self.request.get('page')),
+                                         _cursorParam(self.request))
+        logging.info('Queued money supply sum of %d %ss', count, self.request.get('kind'))
+
+
+class ReconciliationSumHandler(webapp2.RequestHandler):
+    """Sum one range's share of the money supply."""
+
+    def post(self):
+        start, end = self.request.get('start'), self.request.get('end')
+        count = sumReconciliationPage(_runParam(self.request), self.request.get('kind'),
+                                      int(self.request.get('page')),
+                                      Cursor(urlsafe=start) if start else None,
+                                      Cursor(urlsafe=end) if end else None)
+        logging.info('Summed money supply of %d %ss', count, self.request.get('kind'))
+
+
+class StartExpiryHandler(webapp2.RequestHandler):
+    """Cron: end every active Relation whose endDate has passed."""
+
+    def get(self):
+        run_key = startExpiry(datetime.date.today())
+        self.response.write('Relation expiry %d queued' % run_key.id())
+
+
+class ExpiryFanOutHandler(webapp2.RequestHandler):
+    """Queue expiry batches for one page of expired Relations."""
+
+    def post(self):
+        count = fanOutExpiryPage(_runParam(self.request, RelationExpiryRun),
+                                 _dayParam(self.request),
+                                 int(self.request.get('page')),
+                                 int(self.request.get('batches')),
+                                 _cursorParam(self.request))
+        logging.info('Queued expiry of %d relations', count)
+
+
+class ExpireBatchHandler(webapp2.RequestHandler):
+    """End one batch of expired Relations."""
+
+    def post(self):
+        rel_keys = [ndb.Key(urlsafe=k) for k in self.request.get_all('key')]
+        expireBatch(_runParam(self.request, RelationExpiryRun),
+                    int(self.request.get('batch')), rel_keys, _dayParam(self.request))
+
+
+app = webapp2.WSGIApplication([
+    ('/tasks/migrate/flatten_balance_history', FlattenBalanceHistoryHandler),
+    ('/tasks/migrate/backfill_relation_active', BackfillRelationActiveHandler),
+    ('/tasks/migrate/pack_balance_history', PackBalanceHistoryHandler),
+    ('/tasks/settlement/start', StartSettlementHandler),
+    ('/tasks/settlement/fanout', SettlementFanOutHandler),
+    ('/tasks/settlement/batch', SettleBatchHandler),
+    ('/tasks/recompute', RecomputeBalanceHandler),
+    ('/tasks/supply/reconcile', StartReconciliationHandler),
+    ('/tasks/supply/fanout', ReconciliationFanOutHandler),
+    ('/tasks/supply/sum', ReconciliationSumHandler),
+    ('/tasks/expiry/start', StartExpiryHandler),
+    ('/tasks/expiry/fanout', ExpiryFanOutHandler),
+    ('/tasks/expiry/batch', ExpireBatchHandler),
+], debug=False)
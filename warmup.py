@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""warmup.py
+
+Elastic Republic /_ah/warmup handler: loads what the first API request
+on a new instance would otherwise pay for, before it takes traffic
+
+"""
+
+__author__ = 'mike.parziale@gmail.com (Michael Parziale)'
+
+import logging
+import time
+
+import webapp2
+from google.appengine.ext import ndb
+
+
+def warmUp():
+    """Import and build the API, prime caches and open service connections.
+
+    Returns the seconds each step took, in order.
+    """
+    timings = []
+
+    def step(name, func):
+        start = time.time()
+        func()
+        timings.append((name, time.time() - start))
+
+    def importApi():
+        # builds the endpoints service and the form converters at import
+        import elasticrepublic
+
+    def importTasks():
+        import tasks
+
+    def loadNumpy():
+        from ledger import loadNumpy
+        loadNumpy()
+
+    def openServices():
+        # one small RPC each, so their connections are set up
+        from models import Profile
+        ndb.get_multi([ndb.Key(Profile, 'warmup')])
+        ndb.get_context().memcache_get('warmup').get_result()
+
+    step('api', importApi)
+    step('tasks', importTasks)
+    step('numpy', loadNumpy)
+    step('services', openServices)
+    return timings
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Warm a new instance up before it serves requests."""
+
+    def get(self):
+        timings = warmUp()
+        logging.info('Warmed up in %.0fms: %s', sum(t for _, t in timings) * 1000,
+                     ', '.join('%s %.0fms' % (name, t * 1000) for name, t in timings))
+        self.response.write('Warm')
+
+
+app = webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
+], debug=False)